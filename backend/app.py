@@ -11,16 +11,19 @@ import io
 import sys
 import webbrowser
 import json
+import math
+from collections import OrderedDict
 from flask import Flask, request, jsonify, send_file, send_from_directory, redirect
 from flask_cors import CORS
-from models import db, Product, Partner, Order, OrderDetail, CashVoucher, CustomerPrice, AppSetting, ComboItem, PrintTemplate, User, BankAccount, BankTransaction
+from models import db, Product, Partner, Order, OrderDetail, CashVoucher, CustomerPrice, AppSetting, ComboItem, PrintTemplate, User, BankAccount, BankTransaction, StockMovement, StockCheckpoint, ProductLot, LotAllocation, Location, LocationStock, StockTransfer, StockTransferItem, Stocktake, StocktakeLine, PartnerLedgerEntry, PartnerDebtCycle, CashDailyBalance, FinancePeriodTotal, Shift, SalesHourly, ProductSalesDaily, DashboardCounter, ReconcileDirty
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import joinedload
-from datetime import datetime, timedelta, timezone
+from datetime import datetime, date, timedelta, timezone
 import re
 import unicodedata
-from sqlalchemy import event, inspect, extract
+from sqlalchemy import event, inspect, extract, bindparam, case, literal, union_all
 from sqlalchemy.engine import Engine
+from sqlalchemy.dialects import postgresql, sqlite
 from werkzeug.security import generate_password_hash, check_password_hash
 
 
@@ -69,6 +72,17 @@ def normalize_date_sqlite(date_str):
         pass
     return date_str
 
+def parse_expiry(value):
+    """Product.expiry_date is free text (dd/mm/yyyy, yyyy-mm-dd, ...); return a date or None."""
+    if not value:
+        return None
+    if isinstance(value, date):
+        return value
+    try:
+        return datetime.strptime(normalize_date_sqlite(value)[:10], '%Y-%m-%d').date()
+    except ValueError:
+        return None
+
 @event.listens_for(Engine, "connect")
 def set_sqlite_custom_func(dbapi_connection, connection_record):
     # Fix: Only register these functions for SQLite connections
@@ -378,12 +392,65 @@ def run_migrations():
                     conn.execute(db.text('ALTER TABLE product ADD COLUMN brand TEXT'))
                     app.logger.info("Added column 'brand' to product table")
                 
+                if 'avg_cost' not in columns:
+                    conn.execute(db.text('ALTER TABLE product ADD COLUMN avg_cost FLOAT DEFAULT 0'))
+                    # Best starting point for the moving average is the current cost price
+                    conn.execute(db.text('UPDATE product SET avg_cost = COALESCE(cost_price, 0)'))
+                    app.logger.info("Added column 'avg_cost' to product table")
+                
                 # Check order table
                 order_columns = [c['name'] for c in inspector.get_columns('order')]
                 if 'display_id' not in order_columns:
                     conn.execute(db.text('ALTER TABLE "order" ADD COLUMN display_id TEXT'))
                     app.logger.info("Added column 'display_id' to order table")
                 
+                if 'is_opening_balance' not in order_columns:
+                    conn.execute(db.text('ALTER TABLE "order" ADD COLUMN is_opening_balance BOOLEAN DEFAULT FALSE'))
+                    # Backfill: opening balances used to be recognisable only by their display_id
+                    conn.execute(db.text('UPDATE "order" SET is_opening_balance = :flag WHERE display_id IN (\'NODAU\', \'#NODAU\')'), {'flag': True})
+                    conn.execute(db.text('UPDATE "order" SET is_opening_balance = :flag WHERE is_opening_balance IS NULL'), {'flag': False})
+                    app.logger.info("Added column 'is_opening_balance' to order table")
+                conn.execute(db.text('CREATE INDEX IF NOT EXISTS ix_order_type_opening_date ON "order" (type, is_opening_balance, date)'))
+                conn.execute(db.text('CREATE INDEX IF NOT EXISTS ix_order_partner_opening_date ON "order" (partner_id, is_opening_balance, date)'))
+                if 'location_id' not in order_columns:
+                    conn.execute(db.text('ALTER TABLE "order" ADD COLUMN location_id INTEGER REFERENCES location(id)'))
+                    app.logger.info("Added column 'location_id' to order table")
+                sm_columns = [c['name'] for c in inspector.get_columns('stock_movement')]
+                if 'location_id' not in sm_columns:
+                    conn.execute(db.text('ALTER TABLE stock_movement ADD COLUMN location_id INTEGER'))
+                conn.execute(db.text('CREATE INDEX IF NOT EXISTS ix_stock_movement_kind_date ON stock_movement (kind, date)'))
+                
+                # Cost / name / unit snapshots on order lines (backfilled with today's values)
+                od_columns = [c['name'] for c in inspector.get_columns('order_detail')]
+                if 'unit_cost' not in od_columns:
+                    conn.execute(db.text('ALTER TABLE order_detail ADD COLUMN unit_cost FLOAT'))
+                    conn.execute(db.text('ALTER TABLE order_detail ADD COLUMN product_name VARCHAR(200)'))
+                    conn.execute(db.text('ALTER TABLE order_detail ADD COLUMN product_unit VARCHAR(20)'))
+                    conn.execute(db.text('''
+                        UPDATE order_detail SET
+                            product_name = COALESCE(product_name_override, (SELECT p.name FROM product p WHERE p.id = order_detail.product_id)),
+                            product_unit = (SELECT p.unit FROM product p WHERE p.id = order_detail.product_id),
+                            unit_cost = CASE
+                                WHEN (SELECT o.type FROM "order" o WHERE o.id = order_detail.order_id) = 'Purchase' THEN price
+                                WHEN (SELECT p.is_combo FROM product p WHERE p.id = order_detail.product_id) = :flag THEN
+                                    COALESCE((SELECT SUM(ci.quantity * COALESCE(cp.avg_cost, 0)) FROM combo_item ci
+                                              JOIN product cp ON cp.id = ci.product_id
+                                              WHERE ci.combo_id = order_detail.product_id), 0)
+                                ELSE COALESCE((SELECT p.avg_cost FROM product p WHERE p.id = order_detail.product_id), 0)
+                            END
+                    '''), {'flag': True})
+                    app.logger.info("Added snapshot columns to order_detail table")
+                if 'lot_code' not in od_columns:
+                    conn.execute(db.text('ALTER TABLE order_detail ADD COLUMN lot_code VARCHAR(50)'))
+                    conn.execute(db.text('ALTER TABLE order_detail ADD COLUMN lot_expiry DATE'))
+                if 'total_cost' not in order_columns:
+                    conn.execute(db.text('ALTER TABLE "order" ADD COLUMN total_cost FLOAT DEFAULT 0'))
+                    conn.execute(db.text('''
+                        UPDATE "order" SET total_cost = COALESCE(
+                            (SELECT SUM(d.quantity * d.unit_cost) FROM order_detail d WHERE d.order_id = "order".id), 0)
+                    '''))
+                    app.logger.info("Added column 'total_cost' to order table")
+                
                 # Check cash_voucher table
                 cv_columns = [c['name'] for c in inspector.get_columns('cash_voucher')]
                 if 'source' not in cv_columns:
@@ -391,12 +458,480 @@ def run_migrations():
                 if 'order_id' not in cv_columns:
                     conn.execute(db.text('ALTER TABLE cash_voucher ADD COLUMN order_id INTEGER'))
                 
+                # Opening balance of bank accounts: whatever the transactions don't explain today
+                ba_columns = [c['name'] for c in inspector.get_columns('bank_account')]
+                if 'opening_balance' not in ba_columns:
+                    conn.execute(db.text('ALTER TABLE bank_account ADD COLUMN opening_balance FLOAT DEFAULT 0'))
+                    conn.execute(db.text('''
+                        UPDATE bank_account SET opening_balance = COALESCE(balance, 0) - COALESCE(
+                            (SELECT SUM(CASE t.type WHEN 'Deposit' THEN t.amount WHEN 'Withdrawal' THEN -t.amount ELSE 0 END)
+                             FROM bank_transaction t WHERE t.account_id = bank_account.id), 0)
+                    '''))
+                    app.logger.info("Added column 'opening_balance' to bank_account table")
+                bt_columns = [c['name'] for c in inspector.get_columns('bank_transaction')]
+                if 'balance_after' not in bt_columns:
+                    conn.execute(db.text('ALTER TABLE bank_transaction ADD COLUMN balance_after FLOAT'))
+                    app.logger.info("Added column 'balance_after' to bank_transaction table")
+                conn.execute(db.text('CREATE INDEX IF NOT EXISTS ix_bank_transaction_account_date ON bank_transaction (account_id, date, id)'))
+
+                conn.execute(db.text('CREATE INDEX IF NOT EXISTS ix_partner_debt_balance ON partner (debt_balance)'))
+                # Deleting a settlement voucher used to switch its Debt order to payment_method 'Pending'
+                # while the order's debt stayed in Partner.debt_balance. Settlement vouchers only ever
+                # came from Debt orders, so every such order with a partner is a Debt order: give it its
+                # method back before the ledger backfill below reads Debt orders.
+                conn.execute(db.text('''
+                    UPDATE "order" SET payment_method = 'Debt'
+                    WHERE payment_method = 'Pending' AND partner_id IS NOT NULL
+                '''))
+
+                # Cashier shifts: documents created while a shift is open point to it
+                for table, cols in (('"order"', order_columns), ('cash_voucher', cv_columns), ('bank_transaction', bt_columns)):
+                    if 'shift_id' not in cols:
+                        conn.execute(db.text(f'ALTER TABLE {table} ADD COLUMN shift_id INTEGER REFERENCES shift(id)'))
+                        app.logger.info(f"Added column 'shift_id' to {table} table")
+                    conn.execute(db.text(f'CREATE INDEX IF NOT EXISTS ix_{table.strip(chr(34))}_shift_id ON {table} (shift_id)'))
+                
                 # Cleanup previous deletions if any
                 pass
                     
         except Exception as e:
             app.logger.error(f"Error creating/migrating database: {e}")
 
+        # Data backfills for tables introduced after the first release
+        try:
+            backfill_stock_movements()
+        except Exception as e:
+            db.session.rollback()
+            app.logger.error(f"Error backfilling stock journal: {e}")
+        try:
+            backfill_stock_checkpoints()
+        except Exception as e:
+            db.session.rollback()
+            app.logger.error(f"Error backfilling stock checkpoints: {e}")
+        try:
+            backfill_product_lots()
+        except Exception as e:
+            db.session.rollback()
+            app.logger.error(f"Error backfilling product lots: {e}")
+        try:
+            backfill_location_stock()
+        except Exception as e:
+            db.session.rollback()
+            app.logger.error(f"Error backfilling location stock: {e}")
+        try:
+            backfill_partner_ledger()
+        except Exception as e:
+            db.session.rollback()
+            app.logger.error(f"Error backfilling partner ledger: {e}")
+        try:
+            backfill_debt_cycles()
+        except Exception as e:
+            db.session.rollback()
+            app.logger.error(f"Error backfilling debt cycles: {e}")
+        try:
+            backfill_cash_days()
+        except Exception as e:
+            db.session.rollback()
+            app.logger.error(f"Error backfilling cash book: {e}")
+        try:
+            backfill_bank_balances()
+        except Exception as e:
+            db.session.rollback()
+            app.logger.error(f"Error backfilling bank balances: {e}")
+        try:
+            backfill_period_totals()
+        except Exception as e:
+            db.session.rollback()
+            app.logger.error(f"Error backfilling finance period totals: {e}")
+        try:
+            backfill_sales_rollups()
+        except Exception as e:
+            db.session.rollback()
+            app.logger.error(f"Error backfilling sales rollups: {e}")
+
+def backfill_stock_movements():
+    """
+    One-off journal rebuild for databases created before StockMovement existed:
+    one row per historical order line (combos exploded into components), then an
+    'Opening' row per product so that the journal sums to the current Product.stock.
+    """
+    if StockMovement.query.first() or not Product.query.first():
+        return
+
+    sign = case((Order.type == 'Sale', -1), else_=1)
+    retail = case((Order.type == 'Sale', 'Khách Lẻ'), else_='NCC Vãng Lai')
+    not_combo = db.or_(Product.is_combo == False, Product.is_combo == None)
+    cols = ['product_id', 'date', 'quantity', 'kind', 'reversal', 'order_id', 'ref', 'partner_name', 'combo_id', 'note', 'price']
+
+    simple = db.session.query(
+        OrderDetail.product_id, Order.date, sign * OrderDetail.quantity, Order.type, db.literal(False),
+        Order.id, Order.display_id, db.func.coalesce(Partner.name, retail), db.literal(None), db.literal(None), OrderDetail.price
+    ).select_from(OrderDetail)\
+     .join(Order, Order.id == OrderDetail.order_id)\
+     .join(Product, Product.id == OrderDetail.product_id)\
+     .outerjoin(Partner, Partner.id == Order.partner_id)\
+     .filter(Order.type.in_(['Sale', 'Purchase']), not_combo)
+    db.session.execute(StockMovement.__table__.insert().from_select(cols, simple.statement))
+
+    combos = db.session.query(
+        ComboItem.product_id, Order.date, sign * OrderDetail.quantity * ComboItem.quantity, Order.type, db.literal(False),
+        Order.id, Order.display_id, db.func.coalesce(Partner.name, retail), Product.id, Product.name, db.literal(0)
+    ).select_from(OrderDetail)\
+     .join(Order, Order.id == OrderDetail.order_id)\
+     .join(Product, Product.id == OrderDetail.product_id)\
+     .join(ComboItem, ComboItem.combo_id == Product.id)\
+     .outerjoin(Partner, Partner.id == Order.partner_id)\
+     .filter(Order.type.in_(['Sale', 'Purchase']), Product.is_combo == True)
+    db.session.execute(StockMovement.__table__.insert().from_select(cols, combos.statement))
+
+    first_date = db.session.query(db.func.min(StockMovement.date)).scalar()
+    opening_date = (first_date - timedelta(seconds=1)) if first_date else get_vn_time()
+    journaled = db.session.query(StockMovement.product_id, db.func.sum(StockMovement.quantity).label('qty'))\
+        .group_by(StockMovement.product_id).subquery()
+    opening = db.session.query(
+        Product.id, db.literal(opening_date), db.func.coalesce(Product.stock, 0) - db.func.coalesce(journaled.c.qty, 0),
+        db.literal('Opening'), db.literal(False)
+    ).select_from(Product)\
+     .outerjoin(journaled, journaled.c.product_id == Product.id)\
+     .filter(not_combo, db.func.coalesce(Product.stock, 0) - db.func.coalesce(journaled.c.qty, 0) != 0)
+    db.session.execute(StockMovement.__table__.insert().from_select(['product_id', 'date', 'quantity', 'kind', 'reversal'], opening.statement))
+    StockCheckpoint.query.delete() # the journal now reaches back into months they had closed
+    db.session.commit()
+    app.logger.info("Backfilled stock_movement journal from order history")
+
+def backfill_stock_checkpoints():
+    """Close the months that ended since the last start; the Posting closes them as it goes."""
+    if ensure_stock_checkpoints(get_vn_time().date()):
+        db.session.commit()
+        app.logger.info("Built stock checkpoints")
+
+def backfill_product_lots():
+    """Start lot tracking with one lot per stocked product, dated by its current expiry_date."""
+    if ProductLot.query.first():
+        return
+    now = get_vn_time()
+    rows = [
+        {'product_id': pid, 'expiry_date': parse_expiry(expiry), 'quantity': stock, 'received_date': now}
+        for pid, stock, expiry in db.session.query(Product.id, Product.stock, Product.expiry_date)
+            .filter(db.or_(Product.is_combo == False, Product.is_combo == None), Product.stock > 0)
+    ]
+    if rows:
+        db.session.bulk_insert_mappings(ProductLot, rows)
+        db.session.commit()
+        app.logger.info(f"Backfilled {len(rows)} product lots")
+
+def order_debt_delta(order_type, payment_method, total):
+    """Effect of an order on Partner.debt_balance: only Debt orders move the balance."""
+    if payment_method != 'Debt':
+        return 0
+    return total if order_type == 'Sale' else -total
+
+def voucher_debt_delta(v_type, amount):
+    """Receipt: customer pays us (balance down). Payment: we pay supplier (balance up)."""
+    if v_type == 'Receipt':
+        return -amount
+    if v_type == 'Payment':
+        return amount
+    return 0
+
+def rebuild_bank_balances(account_ids=None):
+    """Running balance_after of every transaction from a window SUM over (date, id)."""
+    delta = case((BankTransaction.type == 'Deposit', BankTransaction.amount),
+                 (BankTransaction.type == 'Withdrawal', -BankTransaction.amount), else_=0)
+    running = db.func.sum(delta).over(partition_by=BankTransaction.account_id,
+                                      order_by=(BankTransaction.date, BankTransaction.id))
+    query = db.session.query(BankTransaction.id, db.func.coalesce(BankAccount.opening_balance, 0) + running)\
+        .join(BankAccount, BankAccount.id == BankTransaction.account_id)
+    if account_ids is not None:
+        query = query.filter(BankTransaction.account_id.in_(account_ids))
+    rows = [{'b_id': tid, 'b_balance': balance} for tid, balance in query]
+    if rows:
+        table = BankTransaction.__table__
+        db.session.execute(table.update().where(table.c.id == bindparam('b_id')).values(balance_after=bindparam('b_balance')), rows)
+
+def backfill_bank_balances():
+    if not BankTransaction.query.filter(BankTransaction.balance_after == None).first():
+        return
+    rebuild_bank_balances()
+    db.session.commit()
+    app.logger.info("Backfilled bank running balances")
+
+def order_cash_delta(order_type, payment_method, total, is_opening_balance=False):
+    """Cash on hand effect of an order: only Cash orders, Sale brings money in."""
+    if payment_method != 'Cash' or is_opening_balance:
+        return 0
+    return total if order_type == 'Sale' else -total
+
+def voucher_cash_delta(v_type, amount):
+    if v_type == 'Receipt':
+        return amount
+    if v_type == 'Payment':
+        return -amount
+    return 0
+
+def rebuild_cash_days():
+    """Rewrite every daily cash checkpoint from Cash orders and vouchers (one grouped query each)."""
+    CashDailyBalance.query.delete()
+    order_day = db.func.date(Order.date)
+    voucher_day = db.func.date(CashVoucher.date)
+    order_amount = case((Order.type == 'Sale', Order.total_amount), else_=-Order.total_amount)
+    voucher_amount = case((CashVoucher.type == 'Receipt', CashVoucher.amount), (CashVoucher.type == 'Payment', -CashVoucher.amount), else_=0)
+    days = {}
+    for query in (
+        db.session.query(order_day, db.func.sum(case((order_amount > 0, order_amount), else_=0)), db.func.sum(case((order_amount < 0, -order_amount), else_=0)))
+          .filter(Order.payment_method == 'Cash', Order.is_opening_balance == False).group_by(order_day),
+        db.session.query(voucher_day, db.func.sum(case((voucher_amount > 0, voucher_amount), else_=0)), db.func.sum(case((voucher_amount < 0, -voucher_amount), else_=0)))
+          .group_by(voucher_day)
+    ):
+        for day, inflow, outflow in query:
+            day = day if isinstance(day, date) else date.fromisoformat(str(day)[:10])
+            row = days.setdefault(day, [0, 0])
+            row[0] += inflow or 0
+            row[1] += outflow or 0
+    closing, rows = 0, []
+    for day in sorted(days):
+        inflow, outflow = days[day]
+        closing += inflow - outflow
+        rows.append({'day': day, 'inflow': inflow, 'outflow': outflow, 'closing': closing})
+    if rows:
+        db.session.bulk_insert_mappings(CashDailyBalance, rows)
+
+def backfill_cash_days():
+    if CashDailyBalance.query.first():
+        return
+    if not Order.query.filter(Order.payment_method == 'Cash').first() and not CashVoucher.query.first():
+        return
+    rebuild_cash_days()
+    db.session.commit()
+    app.logger.info("Backfilled daily cash balances")
+
+def rebuild_period_totals():
+    """Rewrite FinancePeriodTotal from orders, vouchers and bank transactions, grouped by month."""
+    FinancePeriodTotal.query.delete()
+    totals = {}
+    def add(rows, metric=None):
+        for year, month, *rest in rows:
+            if year is None:
+                continue
+            name, amount = (metric, rest[0]) if metric else rest
+            if amount:
+                key = (f"{int(year):04d}-{int(month):02d}", name)
+                totals[key] = totals.get(key, 0) + amount
+
+    def by_month(col, *cols):
+        return db.session.query(extract('year', col), extract('month', col), *cols)
+
+    sales = by_month(Order.date, db.func.sum(Order.total_amount), db.func.sum(Order.total_cost))\
+        .filter(Order.type == 'Sale', Order.is_opening_balance == False)\
+        .group_by(extract('year', Order.date), extract('month', Order.date)).all()
+    add([(y, m, revenue) for y, m, revenue, _ in sales], 'revenue')
+    add([(y, m, cogs) for y, m, _, cogs in sales], 'cogs')
+    add(by_month(Order.date, db.func.sum(Order.total_amount))
+        .filter(Order.type == 'Purchase', Order.is_opening_balance == False)
+        .group_by(extract('year', Order.date), extract('month', Order.date)), 'purchases')
+    vouchers = by_month(CashVoucher.date, CashVoucher.type, db.func.sum(CashVoucher.amount))\
+        .filter(CashVoucher.partner_id == None)\
+        .group_by(extract('year', CashVoucher.date), extract('month', CashVoucher.date), CashVoucher.type)
+    add([(y, m, 'other_income' if t == 'Receipt' else f"expense:{t}", amount) for y, m, t, amount in vouchers])
+
+    order_cash = case((Order.type == 'Sale', Order.total_amount), else_=-Order.total_amount)
+    voucher_cash = case((CashVoucher.type == 'Receipt', CashVoucher.amount), (CashVoucher.type == 'Payment', -CashVoucher.amount), else_=0)
+    bank = case((BankTransaction.type == 'Deposit', BankTransaction.amount), (BankTransaction.type == 'Withdrawal', -BankTransaction.amount), else_=0)
+    for prefix, col, amount, filters in (('cash', Order.date, order_cash, [Order.payment_method == 'Cash', Order.is_opening_balance == False]),
+                                         ('cash', CashVoucher.date, voucher_cash, []),
+                                         ('bank', BankTransaction.date, bank, [])):
+        rows = by_month(col, db.func.sum(case((amount > 0, amount), else_=0)), db.func.sum(case((amount < 0, -amount), else_=0)))\
+            .filter(*filters).group_by(extract('year', col), extract('month', col)).all()
+        add([(y, m, inflow) for y, m, inflow, _ in rows], f'{prefix}_in')
+        add([(y, m, outflow) for y, m, _, outflow in rows], f'{prefix}_out')
+
+    if totals:
+        db.session.bulk_insert_mappings(FinancePeriodTotal, [
+            {'period': period, 'metric': metric, 'amount': amount} for (period, metric), amount in totals.items()])
+
+def backfill_period_totals():
+    if FinancePeriodTotal.query.first() or not (Order.query.first() or CashVoucher.query.first() or BankTransaction.query.first()):
+        return
+    rebuild_period_totals()
+    db.session.commit()
+    app.logger.info("Backfilled finance period totals")
+
+def rebuild_sales_rollups():
+    """Rewrite SalesHourly and ProductSalesDaily from orders and their lines."""
+    SalesHourly.query.delete()
+    ProductSalesDaily.query.delete()
+    parts = lambda col, *units: [extract(unit, col) for unit in units]
+
+    hour = parts(Order.date, 'year', 'month', 'day', 'hour')
+    quantities = db.session.query(OrderDetail.order_id, db.func.sum(OrderDetail.quantity).label('quantity'))\
+        .filter(OrderDetail.product_id != None).group_by(OrderDetail.order_id).subquery()
+    rows = db.session.query(*hour, Order.type, db.func.sum(Order.total_amount), db.func.sum(Order.total_cost),
+                            db.func.sum(db.func.coalesce(quantities.c.quantity, 0)), db.func.count(Order.id))\
+        .outerjoin(quantities, quantities.c.order_id == Order.id)\
+        .filter(Order.is_opening_balance == False, Order.date != None)\
+        .group_by(*hour, Order.type).all()
+    db.session.bulk_insert_mappings(SalesHourly, [
+        {'hour': datetime(int(y), int(m), int(d), int(h)), 'type': t, 'revenue': revenue or 0, 'cost': cost or 0,
+         'quantity': quantity or 0, 'order_count': count}
+        for y, m, d, h, t, revenue, cost, quantity, count in rows])
+
+    day = parts(Order.date, 'year', 'month', 'day')
+    rows = db.session.query(*day, Order.type, OrderDetail.product_id,
+                            db.func.sum(OrderDetail.quantity * OrderDetail.price),
+                            db.func.sum(OrderDetail.quantity * db.func.coalesce(OrderDetail.unit_cost, 0)),
+                            db.func.sum(OrderDetail.quantity), db.func.count(db.distinct(Order.id)))\
+        .join(Order, Order.id == OrderDetail.order_id)\
+        .filter(Order.is_opening_balance == False, Order.date != None, OrderDetail.product_id != None)\
+        .group_by(*day, Order.type, OrderDetail.product_id).all()
+    db.session.bulk_insert_mappings(ProductSalesDaily, [
+        {'day': date(int(y), int(m), int(d)), 'type': t, 'product_id': product_id, 'revenue': revenue or 0,
+         'cost': cost or 0, 'quantity': quantity or 0, 'order_count': count}
+        for y, m, d, t, product_id, revenue, cost, quantity, count in rows])
+
+def backfill_sales_rollups():
+    if SalesHourly.query.first() or not Order.query.filter(Order.is_opening_balance == False).first():
+        return
+    rebuild_sales_rollups()
+    db.session.commit()
+    app.logger.info("Backfilled sales rollups")
+
+def order_ledger_fields(order):
+    """PartnerLedgerEntry columns for a Debt order (works on ORM objects and query rows)."""
+    return {
+        'partner_id': order.partner_id,
+        'date': order.date,
+        'source': 'Order',
+        'order_id': order.id,
+        'ref': order.display_id,
+        'description': f"{'Mua hàng' if order.type == 'Sale' else 'Nhập hàng'} (Đơn {order.display_id})",
+        'amount': order_debt_delta(order.type, order.payment_method, order.total_amount or 0)
+    }
+
+def voucher_ledger_fields(v):
+    return {
+        'partner_id': v.partner_id,
+        'date': v.date,
+        'source': 'Voucher',
+        'voucher_id': v.id,
+        'ref': f"PT-{v.id}" if v.type == 'Receipt' else f"PC-{v.id}",
+        'description': v.note or ('Phiếu thu tiền' if v.type == 'Receipt' else 'Phiếu chi tiền'),
+        'amount': voucher_debt_delta(v.type, v.amount or 0)
+    }
+
+def rebuild_partner_ledger(partner_ids=None):
+    """
+    Rewrite ledger entries and running balances from Debt orders and vouchers in one
+    streaming pass. Used for the first backfill and after changes that bypass the Posting
+    (opening balances, imports, recalculation).
+    """
+    orders = db.session.query(Order.id, Order.partner_id, Order.date, Order.type, Order.payment_method,
+                              Order.total_amount, Order.display_id)\
+        .filter(Order.payment_method == 'Debt', Order.partner_id != None)
+    vouchers = db.session.query(CashVoucher.id, CashVoucher.partner_id, CashVoucher.date, CashVoucher.type,
+                                CashVoucher.amount, CashVoucher.note)\
+        .filter(CashVoucher.partner_id != None)
+    existing = PartnerLedgerEntry.query
+    if partner_ids is not None:
+        if not partner_ids:
+            return
+        orders = orders.filter(Order.partner_id.in_(partner_ids))
+        vouchers = vouchers.filter(CashVoucher.partner_id.in_(partner_ids))
+        existing = existing.filter(PartnerLedgerEntry.partner_id.in_(partner_ids))
+    existing.delete(synchronize_session=False)
+
+    rows = [order_ledger_fields(o) for o in orders] + [voucher_ledger_fields(v) for v in vouchers]
+    rows.sort(key=lambda r: (r['partner_id'], r['date'], r['source'], r.get('order_id') or r.get('voucher_id')))
+    balances = {}
+    for r in rows:
+        balances[r['partner_id']] = balances.get(r['partner_id'], 0) + r['amount']
+        r['balance_after'] = balances[r['partner_id']]
+    if rows:
+        db.session.bulk_insert_mappings(PartnerLedgerEntry, rows)
+    rebuild_debt_cycles(partner_ids)
+
+def at_or_after(date_col, id_col, date, entry_id):
+    """(date_col, id_col) >= (date, entry_id) for ledger positions."""
+    return db.or_(date_col > date, db.and_(date_col == date, id_col >= entry_id))
+
+def replay_debt_cycles(entries, open_cycle=None):
+    """
+    Walk ledger entries in (date, id) order for one partner. A Debt order that leaves a
+    non-zero balance opens a cycle; any entry that brings the balance under 1 closes it.
+    """
+    for e in entries:
+        if open_cycle is None and e.source == 'Order' and e.balance_after != 0:
+            open_cycle = PartnerDebtCycle(partner_id=e.partner_id, start_date=e.date, start_entry_id=e.id)
+            db.session.add(open_cycle)
+        if open_cycle is not None and abs(e.balance_after) < 1:
+            open_cycle.end_date, open_cycle.end_entry_id = e.date, e.id
+            open_cycle = None
+
+def recompute_debt_cycles(partner_id, date, entry_id):
+    """Redo cycles from ledger position (date, entry_id) onward; earlier cycles are kept."""
+    PartnerDebtCycle.query.filter(
+        PartnerDebtCycle.partner_id == partner_id,
+        at_or_after(PartnerDebtCycle.start_date, PartnerDebtCycle.start_entry_id, date, entry_id)
+    ).delete(synchronize_session=False)
+    # A cycle that began earlier but closed at or after the point is open again until replayed
+    open_cycle = PartnerDebtCycle.query.filter(PartnerDebtCycle.partner_id == partner_id, db.or_(
+        PartnerDebtCycle.end_date == None,
+        at_or_after(PartnerDebtCycle.end_date, PartnerDebtCycle.end_entry_id, date, entry_id)
+    )).first()
+    if open_cycle:
+        open_cycle.end_date, open_cycle.end_entry_id = None, None
+    entries = PartnerLedgerEntry.query.filter(
+        PartnerLedgerEntry.partner_id == partner_id,
+        at_or_after(PartnerLedgerEntry.date, PartnerLedgerEntry.id, date, entry_id)
+    ).order_by(PartnerLedgerEntry.date, PartnerLedgerEntry.id)\
+     .execution_options(populate_existing=True) # balances were shifted by bulk UPDATEs
+    replay_debt_cycles(entries, open_cycle)
+
+def rebuild_debt_cycles(partner_ids=None):
+    existing = PartnerDebtCycle.query
+    entries = PartnerLedgerEntry.query
+    if partner_ids is not None:
+        existing = existing.filter(PartnerDebtCycle.partner_id.in_(partner_ids))
+        entries = entries.filter(PartnerLedgerEntry.partner_id.in_(partner_ids))
+    existing.delete(synchronize_session=False)
+    current, batch = None, []
+    for e in entries.order_by(PartnerLedgerEntry.partner_id, PartnerLedgerEntry.date, PartnerLedgerEntry.id).yield_per(1000):
+        if e.partner_id != current:
+            replay_debt_cycles(batch)
+            current, batch = e.partner_id, []
+        batch.append(e)
+    replay_debt_cycles(batch)
+
+def backfill_partner_ledger():
+    if PartnerLedgerEntry.query.first():
+        return
+    rebuild_partner_ledger()
+    db.session.commit()
+    app.logger.info("Backfilled partner ledger")
+
+def backfill_debt_cycles():
+    if PartnerDebtCycle.query.first() or not PartnerLedgerEntry.query.first():
+        return
+    rebuild_debt_cycles()
+    db.session.commit()
+    app.logger.info("Backfilled partner debt cycles")
+
+def backfill_location_stock():
+    """Create the default location and give it all existing stock."""
+    default = Location.query.filter_by(is_default=True).first()
+    if not default:
+        default = Location(name='Cửa hàng', is_default=True)
+        db.session.add(default)
+        db.session.commit()
+    if LocationStock.query.first():
+        return
+    db.session.execute(LocationStock.__table__.insert().from_select(
+        ['product_id', 'location_id', 'quantity'],
+        db.session.query(Product.id, db.literal(default.id), Product.stock)
+          .filter(db.or_(Product.is_combo == False, Product.is_combo == None), Product.stock != 0).statement
+    ))
+    db.session.commit()
+    app.logger.info("Backfilled location_stock for the default location")
+
 # Run initial migration
 run_migrations()
 
@@ -495,6 +1030,98 @@ def upload_logo():
         file.save(os.path.join(LOGO_FOLDER, filename))
         return jsonify({'url': f'/uploads/logos/{filename}'})
 
+# --- Lots & Locations ---
+LOT_BATCH = 20
+
+def receive_lot(product, quantity, lot_code=None, expiry=None):
+    """Put stock into the lot matching (code, expiry), creating it if needed."""
+    lot_code = lot_code or None
+    expiry = parse_expiry(expiry) or parse_expiry(product.expiry_date)
+    lot = None
+    if product.id:
+        lot = ProductLot.query.filter(
+            ProductLot.product_id == product.id,
+            ProductLot.lot_code.is_(None) if lot_code is None else ProductLot.lot_code == lot_code,
+            ProductLot.expiry_date.is_(None) if expiry is None else ProductLot.expiry_date == expiry
+        ).first()
+    if lot is None:
+        lot = ProductLot(product=product, lot_code=lot_code, expiry_date=expiry, quantity=0, received_date=get_vn_time())
+        db.session.add(lot)
+    lot.quantity = (lot.quantity or 0) + quantity
+    return lot
+
+def consume_lots(product_id, quantity, order_id=None, changes=None):
+    """
+    Take stock out first-expiry-first-out (lots without expiry last). Lots are read
+    a few at a time through ix_product_lot_product_expiry, so a sale only touches the
+    lots it actually drains. Returns the quantity no lot could cover.
+    changes, if given, collects {lot id: [product_id, expiry, quantity before, after]}.
+    """
+    remaining = quantity
+    while remaining > 1e-9:
+        lots = ProductLot.query.filter(ProductLot.product_id == product_id, ProductLot.quantity > 0)\
+            .order_by(ProductLot.expiry_date.asc().nulls_last(), ProductLot.id.asc())\
+            .limit(LOT_BATCH).all()
+        if not lots:
+            break
+        for lot in lots:
+            take = min(lot.quantity, remaining)
+            lot.quantity -= take
+            if changes is not None:
+                changes.setdefault(lot.id, [product_id, lot.expiry_date, lot.quantity + take, None])[3] = lot.quantity
+            remaining -= take
+            if order_id:
+                db.session.add(LotAllocation(order_id=order_id, lot=lot, product_id=product_id, quantity=-take))
+            if remaining <= 1e-9:
+                break
+    return remaining
+
+def default_location_id():
+    loc = Location.query.filter_by(is_default=True).first()
+    return loc.id if loc else None
+
+def location_stock_map(product_ids, location_id):
+    """{product_id: quantity} at one location, one indexed query for a whole page."""
+    if not product_ids:
+        return {}
+    return dict(db.session.query(LocationStock.product_id, LocationStock.quantity)
+                .filter(LocationStock.location_id == location_id, LocationStock.product_id.in_(product_ids)).all())
+
+def adjust_location_stock(product, location_id, delta):
+    row = None
+    if product.id:
+        row = LocationStock.query.filter_by(product_id=product.id, location_id=location_id).first()
+    if row is None:
+        row = LocationStock(product=product, location_id=location_id, quantity=0)
+        db.session.add(row)
+    row.quantity = (row.quantity or 0) + delta
+
+def set_product_stock(product, new_stock, kind, note=None, location_id=None):
+    """
+    Set stock outside of an order (edit, import, stocktake) and journal the difference.
+    new_stock is the product total unless location_id is given, then it is that location's stock.
+    """
+    if location_id and product.id and not product.is_combo:
+        current = location_stock_map([product.id], location_id).get(product.id, 0)
+        diff = float(new_stock or 0) - float(current or 0)
+        new_stock = (product.stock or 0) + int(round(diff))
+    else:
+        diff = float(new_stock or 0) - float(product.stock or 0)
+        location_id = default_location_id()
+    product.stock = new_stock
+    invalidate_kpis('low_stock')
+    if product.id:
+        mark_reconcile_dirty('product', [product.id])
+    if diff and not product.is_combo:
+        invalidate_kpis('expiry')
+        db.session.add(StockMovement(product=product, date=get_vn_time(), quantity=diff, kind=kind, note=note, location_id=location_id))
+        if location_id:
+            adjust_location_stock(product, location_id, diff)
+        if diff > 0:
+            receive_lot(product, diff)
+        elif product.id:
+            consume_lots(product.id, -diff)
+
 # --- Products ---
 @app.route('/api/products', methods=['GET'])
 def get_products():
@@ -504,7 +1131,13 @@ def get_products():
     limit = request.args.get('limit', type=int)
     
     # Critical Fix: Optimize N+1 query for combo_items
-    query = Product.query.options(joinedload(Product.combo_items))
+    query = Product.query.options(joinedload(Product.combo_items).joinedload(ComboItem.product))
+    # ?location_id= reads stock at one location instead of the all-locations total
+    location_id = request.args.get('location_id', type=int)
+    stock_col = Product.stock
+    if location_id:
+        query = query.outerjoin(LocationStock, db.and_(LocationStock.product_id == Product.id, LocationStock.location_id == location_id))
+        stock_col = db.func.coalesce(LocationStock.quantity, 0)
     
     if search:
         s_norm = remove_accents(search)
@@ -520,23 +1153,14 @@ def get_products():
         query = query.filter(Product.brand == brand)
     
     if filter_type == 'out_of_stock':
-        query = query.filter(Product.stock <= 0)
+        query = query.filter(stock_col <= 0)
     elif filter_type == 'warning':
-        query = query.filter(Product.stock < 2 * Product.multiplier)
-    elif filter_type == 'expired':
-        today = datetime.now().strftime('%Y-%m-%d')
-        query = query.filter(Product.expiry_date != None, Product.expiry_date != '', db.func.normalize_date(Product.expiry_date) <= today)
-    elif filter_type == 'near_expiry':
-        from datetime import timedelta
-        today = datetime.now()
-        target_date = (today + timedelta(days=60)).strftime('%Y-%m-%d')
-        today_str = today.strftime('%Y-%m-%d')
-        query = query.filter(
-            Product.expiry_date != None, 
-            Product.expiry_date != '', 
-            db.func.normalize_date(Product.expiry_date) > today_str,
-            db.func.normalize_date(Product.expiry_date) <= target_date
-        )
+        query = query.filter(stock_col < 2 * Product.multiplier)
+    elif filter_type in ('expired', 'near_expiry'):
+        # Products with at least one stocked lot in the window
+        lot_ids = db.session.query(ProductLot.product_id)\
+            .filter(*expiring_lot_filters('expired' if filter_type == 'expired' else 'near'))
+        query = query.filter(Product.id.in_(lot_ids))
     elif filter_type == 'loss':
         query = query.filter(Product.sale_price < Product.cost_price, Product.is_combo == False)
 
@@ -551,7 +1175,7 @@ def get_products():
         'unit': Product.unit,
         'cost_price': Product.cost_price,
         'sale_price': Product.sale_price,
-        'stock': Product.stock,
+        'stock': stock_col,
         'expiry_date': Product.expiry_date
     }
     
@@ -573,9 +1197,14 @@ def get_products():
         pages = 1
         current_page = 1
 
+    stock_map = None
+    if location_id:
+        ids = {p.id for p in products} | {ci.product_id for p in products if p.is_combo for ci in p.combo_items}
+        stock_map = location_stock_map(list(ids), location_id)
+
     results = []
     for p in products:
-        d = p.to_dict()
+        d = p.to_dict(stock_map)
         if p.is_combo:
             d['combo_items'] = [i.to_dict() for i in p.combo_items]
         results.append(d)
@@ -600,14 +1229,16 @@ def create_product():
         secondary_unit=data.get('secondary_unit'),
         multiplier=data.get('multiplier', 1),
         cost_price=data.get('cost_price', 0),
+        avg_cost=data.get('cost_price', 0),
         sale_price=data.get('sale_price', 0),
-        stock=data.get('stock', 0),
+        stock=0,
         expiry_date=data.get('expiry_date'),
         active_ingredient=data.get('active_ingredient'),
         brand=data.get('brand'),
         is_combo=data.get('is_combo', False)
     )
     db.session.add(new_prod)
+    set_product_stock(new_prod, data.get('stock', 0), 'Opening')
     db.session.flush() # Get ID
 
     if data.get('is_combo') and 'combo_items' in data:
@@ -624,16 +1255,21 @@ def create_product():
 
 @app.route('/api/products/<int:id>', methods=['PUT'])
 def update_product(id):
-    prod = Product.query.get_or_404(id)
+    prod = db.get_or_404(Product, id)
     data = request.json
     prod.name = data.get('name', prod.name)
     prod.code = data.get('code', prod.code)
     prod.unit = data.get('unit', prod.unit)
     prod.secondary_unit = data.get('secondary_unit', prod.secondary_unit)
     prod.multiplier = data.get('multiplier', prod.multiplier)
-    prod.cost_price = data.get('cost_price', prod.cost_price)
+    invalidate_kpis('low_stock')
+    if 'cost_price' in data and float(data['cost_price'] or 0) != float(prod.cost_price or 0):
+        # A hand-entered cost is a correction of the valuation as well
+        prod.cost_price = data['cost_price']
+        prod.avg_cost = data['cost_price']
     prod.sale_price = data.get('sale_price', prod.sale_price)
-    prod.stock = data.get('stock', prod.stock)
+    if 'stock' in data:
+        set_product_stock(prod, data['stock'], 'Edit')
     prod.expiry_date = data.get('expiry_date', prod.expiry_date)
     prod.active_ingredient = data.get('active_ingredient', prod.active_ingredient)
     prod.brand = data.get('brand', prod.brand)
@@ -664,8 +1300,15 @@ def delete_product(id):
     if in_use:
         return jsonify({'error': 'Không thể xóa sản phẩm đã có lịch sử giao dịch'}), 400
     
-    prod = Product.query.get_or_404(id)
+    prod = db.get_or_404(Product, id)
+    StockMovement.query.filter_by(product_id=id).delete()
+    StockCheckpoint.query.filter_by(product_id=id).delete()
+    ProductLot.query.filter_by(product_id=id).delete()
+    LocationStock.query.filter_by(product_id=id).delete()
+    StocktakeLine.query.filter_by(product_id=id).delete()
+    ProductSalesDaily.query.filter_by(product_id=id).delete()
     db.session.delete(prod)
+    invalidate_kpis('low_stock', 'expiry')
     db.session.commit()
     return jsonify({'message': 'Deleted successfully'})
 
@@ -692,7 +1335,14 @@ def bulk_delete_products():
             return jsonify({'error': f'Có {in_use_count} sản phẩm đang có lịch sử giao dịch và không thể xóa.'}), 400
         
         # Delete if not in use
+        StockMovement.query.filter(StockMovement.product_id.in_(ids)).delete(synchronize_session=False)
+        StockCheckpoint.query.filter(StockCheckpoint.product_id.in_(ids)).delete(synchronize_session=False)
+        ProductLot.query.filter(ProductLot.product_id.in_(ids)).delete(synchronize_session=False)
+        LocationStock.query.filter(LocationStock.product_id.in_(ids)).delete(synchronize_session=False)
+        StocktakeLine.query.filter(StocktakeLine.product_id.in_(ids)).delete(synchronize_session=False)
+        ProductSalesDaily.query.filter(ProductSalesDaily.product_id.in_(ids)).delete(synchronize_session=False)
         deleted = Product.query.filter(Product.id.in_(ids)).delete(synchronize_session=False)
+        invalidate_kpis('low_stock', 'expiry')
         db.session.commit()
         return jsonify({'message': f'Đã xóa {deleted} sản phẩm thành công'})
     except Exception as e:
@@ -731,7 +1381,7 @@ def import_products():
             
             prod = Product.query.filter_by(name=name).first()
             if not prod:
-                prod = Product(name=name, unit=str(get_val(row, 'Đơn vị', 'Cái')))
+                prod = Product(name=name, unit=str(get_val(row, 'Đơn vị', 'Cái')), stock=0)
                 db.session.add(prod)
             
             prod.unit = str(get_val(row, 'Đơn vị', prod.unit))
@@ -742,13 +1392,16 @@ def import_products():
             if multiplier is not None: prod.multiplier = float(multiplier)
             
             cost_price = get_val(row, 'Giá vốn')
-            if cost_price is not None: prod.cost_price = float(cost_price)
+            if cost_price is not None:
+                if prod.avg_cost is None or float(cost_price) != float(prod.cost_price or 0):
+                    prod.avg_cost = float(cost_price)
+                prod.cost_price = float(cost_price)
             
             sale_price = get_val(row, 'Giá bán')
             if sale_price is not None: prod.sale_price = float(sale_price)
             
             stock = get_val(row, 'Tồn kho')
-            if stock is not None: prod.stock = int(float(stock))
+            if stock is not None: set_product_stock(prod, int(float(stock)), 'Import')
             
             expiry = get_val(row, 'Hạn sử dụng')
             if expiry is not None: prod.expiry_date = str(expiry)
@@ -761,6 +1414,7 @@ def import_products():
             
             count += 1
             
+        invalidate_kpis('low_stock')
         db.session.commit()
         return jsonify({'message': f'Imported {count} products successfully'})
 
@@ -813,72 +1467,725 @@ def get_product_orders(id):
 
 @app.route('/api/products/<int:id>/history', methods=['GET'])
 def get_product_history(id):
+    # Newest first, keyset-paginated over the (product_id, date, id) journal index.
+    # cursor = "<iso date>|<id>" of the last row of the previous page.
+    limit = min(request.args.get('limit', 50, type=int), 500)
+    cursor = request.args.get('cursor')
     try:
-        # Get all movements for this product
-        # 1. From Order Details
-        details = OrderDetail.query.filter_by(product_id=id).join(Order).order_by(Order.date.desc()).all()
+        query = StockMovement.query.filter(StockMovement.product_id == id)
+        if cursor:
+            c_date, c_id = cursor.rsplit('|', 1)
+            c_date = datetime.fromisoformat(c_date)
+            query = query.filter(db.or_(
+                StockMovement.date < c_date,
+                db.and_(StockMovement.date == c_date, StockMovement.id < int(c_id))
+            ))
+        rows = query.order_by(StockMovement.date.desc(), StockMovement.id.desc()).limit(limit + 1).all()
         
-        history = []
-        for d in details:
-            change_qty = 0
-            type_label = ''
-            
-            if d.order.type == 'Sale':
-                # Sale means Out
-                change_qty = -d.quantity
-                type_label = 'Bán hàng'
-            elif d.order.type == 'Purchase':
-                # Purchase means In
-                change_qty = d.quantity
-                type_label = 'Nhập hàng'
-                
-            # Handle Combos if necessary (Combos don't change stock directly? Wait, OrderDetail links to Product. 
-            # If product is Combo, its stock decreases. But usually we track components.
-            # If this request is for a Component Product, we must find Orders where this Component was part of a Combo.
-            
-            history.append({
-                'date': d.order.date.isoformat(),
-                'display_id': d.order.display_id,
-                'order_id': d.order.id,
-                'partner_name': d.order.partner.name if d.order.partner else ('Khách Lẻ' if d.order.type=='Sale' else 'NCC Vãng Lai'),
-                'type': type_label,
-                'quantity_change': change_qty,
-                'price': d.price
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        next_cursor = f"{rows[-1].date.isoformat()}|{rows[-1].id}" if has_more else None
+        return jsonify({
+            'items': [m.to_dict() for m in rows],
+            'next_cursor': next_cursor
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+# --- Inventory: stock as of a date ---
+def month_end(d):
+    """Last day of the month containing date d."""
+    first_of_next = (d.replace(day=1) + timedelta(days=32)).replace(day=1)
+    return first_of_next - timedelta(days=1)
+
+def day_after(d):
+    """Naive datetime at 00:00 of the day after date d (exclusive upper bound)."""
+    return datetime(d.year, d.month, d.day) + timedelta(days=1)
+
+def ensure_stock_checkpoints(up_to):
+    """
+    Build month-end checkpoints for every closed month up to `up_to`, without committing;
+    returns whether any were added. Each new month only replays that month's movements on
+    top of the previous checkpoint, so the cost is bounded by one month of journal rows.
+    A closed month never changes afterwards: the journal is append-only and every row is
+    dated when it is written (Posting._write_movements, set_product_stock), so no movement
+    can land before today. Deleting a product removes its checkpoints with its journal, and
+    the one-off journal backfill, which does write back-dated rows, drops all checkpoints.
+    """
+    today = get_vn_time().date()
+    last = db.session.query(db.func.max(StockCheckpoint.period_end)).scalar()
+    if last is None:
+        first_move = db.session.query(db.func.min(StockMovement.date)).scalar()
+        if not first_move:
+            return
+        period = month_end(first_move.date())
+    else:
+        period = month_end(last + timedelta(days=1))
+
+    created = False
+    while period <= up_to and period < today:
+        balances = {}
+        if last is not None:
+            balances = dict(db.session.query(StockCheckpoint.product_id, StockCheckpoint.quantity)
+                            .filter(StockCheckpoint.period_end == last).all())
+        moved = db.session.query(StockMovement.product_id, db.func.sum(StockMovement.quantity))\
+            .filter(StockMovement.date < day_after(period))
+        if last is not None:
+            moved = moved.filter(StockMovement.date >= day_after(last))
+        for pid, qty in moved.group_by(StockMovement.product_id).all():
+            balances[pid] = balances.get(pid, 0) + (qty or 0)
+
+        rows = [{'product_id': pid, 'period_end': period, 'quantity': qty} for pid, qty in balances.items() if qty]
+        if not rows:
+            # Nothing in stock at month end: a single zero row still marks the month as
+            # closed, otherwise MAX(period_end) stays behind and every call replays it
+            marker = next(iter(balances), None) or db.session.query(db.func.min(Product.id)).scalar()
+            if marker is None:
+                break
+            rows = [{'product_id': marker, 'period_end': period, 'quantity': 0}]
+        db.session.bulk_insert_mappings(StockCheckpoint, rows)
+        created = True
+        last = period
+        period = month_end(period + timedelta(days=1))
+    return created
+
+def stock_as_of(product_ids, as_of):
+    """
+    {product_id: stock at the end of day `as_of`} from the nearest checkpoint + movements since.
+    Read-only: checkpoints are written by the Posting and the startup backfill, and a lagging
+    checkpoint only means more movements are summed.
+    """
+    checkpoint = db.session.query(db.func.max(StockCheckpoint.period_end))\
+        .filter(StockCheckpoint.period_end <= as_of).scalar()
+
+    result = {pid: 0 for pid in product_ids}
+    if checkpoint:
+        for pid, qty in db.session.query(StockCheckpoint.product_id, StockCheckpoint.quantity)\
+                .filter(StockCheckpoint.period_end == checkpoint, StockCheckpoint.product_id.in_(product_ids)).all():
+            result[pid] = qty
+
+    moved = db.session.query(StockMovement.product_id, db.func.sum(StockMovement.quantity))\
+        .filter(StockMovement.product_id.in_(product_ids), StockMovement.date < day_after(as_of))
+    if checkpoint:
+        moved = moved.filter(StockMovement.date >= day_after(checkpoint))
+    for pid, qty in moved.group_by(StockMovement.product_id).all():
+        result[pid] += qty or 0
+    return result
+
+@app.route('/api/inventory/stock-as-of', methods=['GET'])
+def get_stock_as_of():
+    # ?date=YYYY-MM-DD (end of that day), optional search / brand / page / limit
+    try:
+        as_of = datetime.fromisoformat(request.args.get('date')).date() if request.args.get('date') else get_vn_time().date()
+    except ValueError:
+        return jsonify({'error': 'Invalid date'}), 400
+    search = request.args.get('search', '').lower()
+    brand = request.args.get('brand')
+    page = request.args.get('page', type=int)
+    limit = request.args.get('limit', type=int)
+
+    query = Product.query.filter(db.or_(Product.is_combo == False, Product.is_combo == None))
+    if search:
+        s_norm = remove_accents(search)
+        query = query.filter(db.func.remove_accents(Product.name).ilike(f'%{s_norm}%') | Product.code.ilike(f'%{search}%'))
+    if brand:
+        query = query.filter(Product.brand == brand)
+    query = query.order_by(Product.name.asc())
+
+    if page and limit:
+        pagination = query.paginate(page=page, per_page=limit, error_out=False)
+        products = pagination.items
+    else:
+        products = query.all()
+
+    stocks = stock_as_of([p.id for p in products], as_of)
+    items = [{
+        'id': p.id,
+        'name': p.name,
+        'code': p.code,
+        'unit': p.unit,
+        'brand': p.brand,
+        'stock': stocks.get(p.id, 0)
+    } for p in products]
+
+    if page and limit:
+        return jsonify({
+            'date': as_of.isoformat(),
+            'items': items,
+            'total': pagination.total,
+            'pages': pagination.pages,
+            'current_page': pagination.page
+        })
+    return jsonify({'date': as_of.isoformat(), 'items': items})
+
+@app.route('/api/inventory/checkpoints', methods=['POST'])
+def rebuild_stock_checkpoints():
+    # Rebuild from scratch (e.g. after restoring an old backup), then catch up to today
+    try:
+        data = request.json or {}
+        if data.get('rebuild'):
+            StockCheckpoint.query.delete()
+        ensure_stock_checkpoints(get_vn_time().date())
+        db.session.commit()
+        last = db.session.query(db.func.max(StockCheckpoint.period_end)).scalar()
+        return jsonify({'message': 'Checkpoints updated', 'last_period': last.isoformat() if last else None})
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/api/inventory/valuation', methods=['GET'])
+def get_inventory_valuation():
+    # Reads the maintained state only: value = stock on hand x weighted-average cost.
+    # ?group_by=product (default) | brand, plus search / brand / sort / page / limit
+    group_by = request.args.get('group_by', 'product')
+    search = request.args.get('search', '').lower()
+    brand = request.args.get('brand')
+    sort_by = request.args.get('sort_by', 'value')
+    sort_order = request.args.get('sort_order', 'desc')
+    page = request.args.get('page', type=int)
+    limit = request.args.get('limit', type=int)
+
+    on_hand = case((Product.stock > 0, Product.stock), else_=0)
+    value = on_hand * db.func.coalesce(Product.avg_cost, 0)
+    base_filters = [db.or_(Product.is_combo == False, Product.is_combo == None)]
+    if search:
+        s_norm = remove_accents(search)
+        base_filters.append(db.func.remove_accents(Product.name).ilike(f'%{s_norm}%') | Product.code.ilike(f'%{search}%'))
+    if brand:
+        base_filters.append(Product.brand == brand)
+
+    total_qty, total_value = db.session.query(db.func.sum(on_hand), db.func.sum(value)).filter(*base_filters).one()
+
+    if group_by == 'brand':
+        brand_col = db.func.coalesce(Product.brand, '')
+        query = db.session.query(
+            brand_col.label('brand'),
+            db.func.count(Product.id).label('products'),
+            db.func.sum(on_hand).label('quantity'),
+            db.func.sum(value).label('value')
+        ).filter(*base_filters).group_by(brand_col)
+        sort_map = {'brand': brand_col, 'quantity': db.func.sum(on_hand), 'value': db.func.sum(value)}
+        to_item = lambda r: {'brand': r.brand, 'products': r.products, 'quantity': r.quantity or 0, 'value': r.value or 0}
+    else:
+        query = db.session.query(
+            Product.id, Product.name, Product.unit, Product.brand,
+            on_hand.label('quantity'), Product.avg_cost, value.label('value')
+        ).filter(*base_filters)
+        sort_map = {'name': Product.name, 'quantity': on_hand, 'avg_cost': Product.avg_cost, 'value': value}
+        to_item = lambda r: {'id': r.id, 'name': r.name, 'unit': r.unit, 'brand': r.brand,
+                             'quantity': r.quantity or 0, 'avg_cost': r.avg_cost or 0, 'value': r.value or 0}
+
+    sort_col = sort_map.get(sort_by, sort_map['value'])
+    query = query.order_by(sort_col.desc() if sort_order == 'desc' else sort_col.asc())
+
+    summary = {'total_quantity': total_qty or 0, 'total_value': total_value or 0}
+    if page and limit:
+        total = query.order_by(None).count()
+        rows = query.offset((page - 1) * limit).limit(limit).all()
+        return jsonify({
+            **summary,
+            'items': [to_item(r) for r in rows],
+            'total': total,
+            'pages': (total + limit - 1) // limit,
+            'current_page': page
+        })
+    return jsonify({**summary, 'items': [to_item(r) for r in query.all()]})
+
+def expiring_lot_filters(status, days=60, today=None):
+    """Stocked lots that are expired (status='expired') or expire within `days` ('near')."""
+    today = today or get_vn_time().date()
+    filters = [ProductLot.quantity > 0, ProductLot.expiry_date != None]
+    if status == 'expired':
+        filters.append(ProductLot.expiry_date < today)
+    else:
+        filters += [ProductLot.expiry_date >= today, ProductLot.expiry_date <= today + timedelta(days=days)]
+    return filters
+
+def movement_location_filter(location_id):
+    """StockMovement rows at one location (NULL location_id means the default one)."""
+    if location_id == default_location_id():
+        return db.or_(StockMovement.location_id == location_id, StockMovement.location_id == None)
+    return StockMovement.location_id == location_id
+
+def last_supplier_subquery():
+    """Latest purchase (supplier, price) per product: ROW_NUMBER over purchase lines, rn = 1 is the latest."""
+    rn = db.func.row_number().over(partition_by=OrderDetail.product_id, order_by=(Order.date.desc(), Order.id.desc()))
+    return db.session.query(
+        OrderDetail.product_id.label('product_id'),
+        Order.partner_id.label('partner_id'),
+        OrderDetail.price.label('price'),
+        rn.label('rn')
+    ).join(Order, Order.id == OrderDetail.order_id)\
+     .filter(Order.type == 'Purchase', Order.is_opening_balance == False, Order.partner_id != None).subquery()
+
+@app.route('/api/inventory/reorder', methods=['GET'])
+def get_reorder_suggestions():
+    """
+    Replenishment from sales velocity. ?window=30 (days the velocity is measured over),
+    windows=7,30,90 (extra windows reported per product), cover_days=30 (stock to hold),
+    lead_days=7, location_id, supplier_id. Velocity comes from the stock journal, so combo
+    sales count against their components. Results are grouped by each product's last
+    supplier and shaped like held Purchase carts.
+    """
+    window = max(request.args.get('window', 30, type=int), 1)
+    windows = sorted({window} | {int(w) for w in request.args.get('windows', '').split(',') if w.strip().isdigit() and int(w) > 0})
+    cover_days = request.args.get('cover_days', 30, type=int)
+    lead_days = request.args.get('lead_days', 7, type=int)
+    location_id = request.args.get('location_id', type=int)
+    supplier_id = request.args.get('supplier_id', type=int)
+
+    now = get_vn_time()
+    cutoffs = {w: now - timedelta(days=w) for w in windows}
+    sold = lambda w: db.func.sum(case((StockMovement.date >= cutoffs[w], -StockMovement.quantity), else_=0))
+    velocity_q = db.session.query(StockMovement.product_id.label('product_id'), *[sold(w).label(f'sold_{w}') for w in windows])\
+        .filter(StockMovement.kind == 'Sale', StockMovement.date >= cutoffs[windows[-1]])
+    if location_id:
+        velocity_q = velocity_q.filter(movement_location_filter(location_id))
+    v = velocity_q.group_by(StockMovement.product_id).subquery()
+    ls = last_supplier_subquery()
+
+    stock_col = db.func.coalesce(LocationStock.quantity, 0) if location_id else Product.stock
+    query = db.session.query(Product, stock_col.label('on_hand'), ls.c.partner_id, ls.c.price, *[v.c[f'sold_{w}'] for w in windows])\
+        .join(v, v.c.product_id == Product.id)\
+        .outerjoin(ls, db.and_(ls.c.product_id == Product.id, ls.c.rn == 1))
+    if location_id:
+        query = query.outerjoin(LocationStock, db.and_(LocationStock.product_id == Product.id, LocationStock.location_id == location_id))
+    target = v.c[f'sold_{window}'] * (cover_days + lead_days) / float(window)
+    query = query.filter(db.or_(Product.is_combo == False, Product.is_combo == None), target > db.func.coalesce(stock_col, 0))
+    if supplier_id:
+        query = query.filter(ls.c.partner_id == supplier_id)
+
+    groups = {}
+    for row in query.all():
+        p = row[0]
+        on_hand = row.on_hand or 0
+        velocity = (getattr(row, f'sold_{window}') or 0) / float(window)
+        need = velocity * (cover_days + lead_days) - on_hand
+        multiplier = p.multiplier or 1
+        qty = math.ceil(need / multiplier) * multiplier if multiplier > 1 else math.ceil(need)
+        price = row.price if row.price is not None else (p.cost_price or 0)
+        group = groups.setdefault(row.partner_id, {'supplier_id': row.partner_id, 'cart': [], 'total': 0})
+        group['cart'].append({
+            # Same keys as a Purchase cart line
+            'product_id': p.id,
+            'product_name': p.name,
+            'unit': p.unit,
+            'secondary_unit': p.secondary_unit,
+            'multiplier': multiplier,
+            'price': price,
+            'quantity': qty,
+            'secondary_qty': qty / multiplier,
+            'stock': on_hand,
+            'active_ingredient': p.active_ingredient,
+            # Why it was suggested
+            'sold': {str(w): getattr(row, f'sold_{w}') or 0 for w in windows},
+            'velocity': velocity,
+            'days_of_cover': max(on_hand, 0) / velocity if velocity else None
+        })
+        group['total'] += qty * price
+
+    partners = {pt.id: pt for pt in Partner.query.filter(Partner.id.in_([k for k in groups if k])).all()} if groups else {}
+    result = []
+    for key, group in groups.items():
+        partner = partners.get(key)
+        group['partner'] = partner.to_dict() if partner else None
+        group['supplier_name'] = partner.name if partner else 'Chưa có nhà cung cấp'
+        group['cart'].sort(key=lambda i: (i['days_of_cover'] if i['days_of_cover'] is not None else 0))
+        result.append(group)
+    result.sort(key=lambda g: g['total'], reverse=True)
+    return jsonify({
+        'window': window,
+        'windows': windows,
+        'cover_days': cover_days,
+        'lead_days': lead_days,
+        'groups': result
+    })
+
+@app.route('/api/products/<int:id>/lots', methods=['GET'])
+def get_product_lots(id):
+    # FEFO order; ?all=true also lists lots that have been used up
+    query = ProductLot.query.filter(ProductLot.product_id == id)
+    if request.args.get('all', 'false').lower() != 'true':
+        query = query.filter(ProductLot.quantity > 0)
+    lots = query.order_by(ProductLot.expiry_date.asc().nulls_last(), ProductLot.id.asc()).all()
+    return jsonify([l.to_dict() for l in lots])
+
+@app.route('/api/lots/<int:id>', methods=['PUT'])
+def update_lot(id):
+    # Correct the lot code / expiry; quantities only move through orders and stock edits
+    lot = db.get_or_404(ProductLot, id)
+    data = request.json
+    try:
+        if 'lot_code' in data:
+            lot.lot_code = data['lot_code'] or None
+        if 'expiry_date' in data:
+            lot.expiry_date = parse_expiry(data['expiry_date'])
+            invalidate_kpis('expiry')
+        db.session.commit()
+        return jsonify(lot.to_dict())
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/api/inventory/expiring', methods=['GET'])
+def get_expiring_lots():
+    # ?status=near (default) | expired, days (default 60), page, limit
+    status = request.args.get('status', 'near')
+    days = request.args.get('days', 60, type=int)
+    page = request.args.get('page', 1, type=int)
+    limit = request.args.get('limit', 50, type=int)
+
+    query = ProductLot.query.options(joinedload(ProductLot.product))\
+        .filter(*expiring_lot_filters(status, days))\
+        .order_by(ProductLot.expiry_date.asc(), ProductLot.id.asc())
+    pagination = query.paginate(page=page, per_page=limit, error_out=False)
+    return jsonify({
+        'items': [l.to_dict() for l in pagination.items],
+        'total': pagination.total,
+        'pages': pagination.pages,
+        'current_page': pagination.page
+    })
+
+# --- Locations & Transfers ---
+@app.route('/api/locations', methods=['GET'])
+def get_locations():
+    return jsonify([l.to_dict() for l in Location.query.order_by(Location.is_default.desc(), Location.name.asc()).all()])
+
+@app.route('/api/locations', methods=['POST'])
+def create_location():
+    data = request.json
+    if not data.get('name'):
+        return jsonify({'error': 'Tên kho không được để trống'}), 400
+    loc = Location(name=data['name'], note=data.get('note'))
+    db.session.add(loc)
+    db.session.commit()
+    return jsonify(loc.to_dict()), 201
+
+@app.route('/api/locations/<int:id>', methods=['PUT'])
+def update_location(id):
+    loc = db.get_or_404(Location, id)
+    data = request.json
+    loc.name = data.get('name', loc.name)
+    loc.note = data.get('note', loc.note)
+    if data.get('is_default'):
+        Location.query.filter(Location.id != id).update({'is_default': False})
+        loc.is_default = True
+    db.session.commit()
+    return jsonify(loc.to_dict())
+
+@app.route('/api/locations/<int:id>', methods=['DELETE'])
+def delete_location(id):
+    loc = db.get_or_404(Location, id)
+    if loc.is_default:
+        return jsonify({'error': 'Không thể xóa kho mặc định'}), 400
+    in_use = LocationStock.query.filter(LocationStock.location_id == id, LocationStock.quantity != 0).first() \
+        or Order.query.filter_by(location_id=id).first() \
+        or StockTransfer.query.filter((StockTransfer.from_location_id == id) | (StockTransfer.to_location_id == id)).first()
+    if in_use:
+        return jsonify({'error': 'Kho còn tồn hoặc đã có chứng từ, không thể xóa'}), 400
+    LocationStock.query.filter_by(location_id=id).delete()
+    db.session.delete(loc)
+    db.session.commit()
+    return jsonify({'message': 'Deleted successfully'})
+
+@app.route('/api/products/<int:id>/stock-by-location', methods=['GET'])
+def get_product_stock_by_location(id):
+    rows = db.session.query(Location, LocationStock.quantity)\
+        .outerjoin(LocationStock, db.and_(LocationStock.location_id == Location.id, LocationStock.product_id == id))\
+        .order_by(Location.is_default.desc(), Location.name.asc()).all()
+    return jsonify([{**loc.to_dict(), 'stock': qty or 0} for loc, qty in rows])
+
+@app.route('/api/stock-transfers', methods=['GET'])
+def get_stock_transfers():
+    page = request.args.get('page', 1, type=int)
+    limit = request.args.get('limit', 20, type=int)
+    location_id = request.args.get('location_id', type=int)
+    query = StockTransfer.query
+    if location_id:
+        query = query.filter((StockTransfer.from_location_id == location_id) | (StockTransfer.to_location_id == location_id))
+    pagination = query.order_by(StockTransfer.date.desc(), StockTransfer.id.desc()).paginate(page=page, per_page=limit, error_out=False)
+    return jsonify({
+        'items': [t.to_dict() for t in pagination.items],
+        'total': pagination.total,
+        'pages': pagination.pages,
+        'current_page': pagination.page
+    })
+
+@app.route('/api/stock-transfers', methods=['POST'])
+def create_stock_transfer():
+    data = request.json
+    try:
+        from_id, to_id = data.get('from_location_id'), data.get('to_location_id')
+        if not from_id or not to_id or from_id == to_id:
+            return jsonify({'error': 'Chọn kho xuất và kho nhập khác nhau'}), 400
+        if not db.session.get(Location, from_id) or not db.session.get(Location, to_id):
+            return jsonify({'error': 'Kho không tồn tại'}), 400
+        items = [i for i in data.get('items', []) if float(i.get('quantity') or 0) > 0]
+        if not items:
+            return jsonify({'error': 'Phiếu chuyển kho chưa có sản phẩm'}), 400
+
+        local_now = get_vn_time()
+        start_of_day = local_now.replace(hour=0, minute=0, second=0, microsecond=0)
+        count_today = StockTransfer.query.filter(StockTransfer.date >= start_of_day).count()
+        transfer = StockTransfer(
+            display_id=f"CK{count_today + 1}.{local_now.strftime('%d/%m/%y')}",
+            date=local_now,
+            from_location_id=from_id,
+            to_location_id=to_id,
+            note=data.get('note')
+        )
+        for item in items:
+            if not db.session.get(Product, item['product_id']):
+                raise Exception(f"Product {item['product_id']} not found")
+            transfer.items.append(StockTransferItem(product_id=item['product_id'], quantity=float(item['quantity'])))
+        db.session.add(transfer)
+
+        posting = Posting()
+        posting.transfer_stock(transfer)
+        posting.commit()
+        return jsonify(transfer.to_dict()), 201
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/api/stock-transfers/<int:id>', methods=['DELETE'])
+def delete_stock_transfer(id):
+    transfer = db.get_or_404(StockTransfer, id)
+    try:
+        posting = Posting()
+        posting.transfer_stock(transfer, reverse=True)
+        db.session.delete(transfer)
+        posting.commit()
+        return jsonify({'message': 'Deleted successfully'})
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
+
+# --- Stocktake ---
+def stocktake_lines_query(st):
+    """Lines with system stock and variance in one query: live for drafts, frozen once completed."""
+    if st.status == 'Completed':
+        system = db.func.coalesce(StocktakeLine.system_qty, 0)
+        variance = db.func.coalesce(StocktakeLine.variance, 0)
+    else:
+        system = db.func.coalesce(LocationStock.quantity, 0)
+        variance = StocktakeLine.counted - system
+    query = db.session.query(
+        StocktakeLine.id, StocktakeLine.product_id, Product.name, Product.code, Product.unit,
+        StocktakeLine.counted, system.label('system_qty'), variance.label('variance'),
+        (variance * db.func.coalesce(Product.avg_cost, 0)).label('variance_value')
+    ).join(Product, Product.id == StocktakeLine.product_id)\
+     .filter(StocktakeLine.stocktake_id == st.id)
+    if st.status != 'Completed':
+        query = query.outerjoin(LocationStock, db.and_(LocationStock.product_id == StocktakeLine.product_id,
+                                                       LocationStock.location_id == st.location_id))
+    return query
+
+def resolve_count_items(items):
+    """[{product_id | code | name, quantity}] -> ({product_id: quantity}, [unmatched]) with one query per key type."""
+    not_combo = db.or_(Product.is_combo == False, Product.is_combo == None)
+    codes = {str(i['code']).strip() for i in items if not i.get('product_id') and i.get('code')}
+    names = {str(i['name']).strip() for i in items if not i.get('product_id') and not i.get('code') and i.get('name')}
+    by_code = dict(db.session.query(Product.code, Product.id).filter(not_combo, Product.code.in_(codes)).all()) if codes else {}
+    by_name = dict(db.session.query(Product.name, Product.id).filter(not_combo, Product.name.in_(names)).all()) if names else {}
+    counts, unmatched = {}, []
+    for i in items:
+        pid = i.get('product_id') or by_code.get(str(i.get('code') or '').strip()) or by_name.get(str(i.get('name') or '').strip())
+        if not pid:
+            unmatched.append(i.get('code') or i.get('name'))
+            continue
+        counts[int(pid)] = counts.get(int(pid), 0) + float(i.get('quantity') or 0)
+    return counts, unmatched
+
+def record_stocktake_counts(st, counts, mode='set'):
+    """Upsert counted quantities; mode='add' accumulates scans instead of overwriting."""
+    if not counts:
+        return
+    existing = dict(db.session.query(StocktakeLine.product_id, StocktakeLine.id)
+                    .filter(StocktakeLine.stocktake_id == st.id, StocktakeLine.product_id.in_(list(counts))).all())
+    updates = [{'b_id': existing[pid], 'b_qty': qty} for pid, qty in counts.items() if pid in existing]
+    if updates:
+        table = StocktakeLine.__table__
+        value = table.c.counted + bindparam('b_qty') if mode == 'add' else bindparam('b_qty')
+        db.session.execute(table.update().where(table.c.id == bindparam('b_id')).values(counted=value), updates)
+    db.session.bulk_insert_mappings(StocktakeLine, [
+        {'stocktake_id': st.id, 'product_id': pid, 'counted': qty} for pid, qty in counts.items() if pid not in existing
+    ])
+
+@app.route('/api/stocktakes', methods=['GET'])
+def get_stocktakes():
+    page = request.args.get('page', 1, type=int)
+    limit = request.args.get('limit', 20, type=int)
+    query = Stocktake.query
+    if request.args.get('status'):
+        query = query.filter(Stocktake.status == request.args.get('status'))
+    pagination = query.order_by(Stocktake.created_at.desc(), Stocktake.id.desc()).paginate(page=page, per_page=limit, error_out=False)
+    return jsonify({
+        'items': [st.to_dict() for st in pagination.items],
+        'total': pagination.total,
+        'pages': pagination.pages,
+        'current_page': pagination.page
+    })
+
+@app.route('/api/stocktakes', methods=['POST'])
+def create_stocktake():
+    data = request.json or {}
+    location_id = data.get('location_id') or default_location_id()
+    if not db.session.get(Location, location_id):
+        return jsonify({'error': 'Kho không tồn tại'}), 400
+    local_now = get_vn_time()
+    start_of_day = local_now.replace(hour=0, minute=0, second=0, microsecond=0)
+    count_today = Stocktake.query.filter(Stocktake.created_at >= start_of_day).count()
+    st = Stocktake(
+        display_id=f"KK{count_today + 1}.{local_now.strftime('%d/%m/%y')}",
+        location_id=location_id,
+        note=data.get('note'),
+        created_at=local_now
+    )
+    db.session.add(st)
+    db.session.commit()
+    return jsonify(st.to_dict()), 201
+
+@app.route('/api/stocktakes/<int:id>', methods=['GET'])
+def get_stocktake(id):
+    # ?only_diff=true, search, page, limit (default 50)
+    st = db.get_or_404(Stocktake, id)
+    page = request.args.get('page', 1, type=int)
+    limit = request.args.get('limit', 50, type=int)
+    search = request.args.get('search', '').lower()
+
+    lines = stocktake_lines_query(st).subquery()
+    summary = db.session.query(
+        db.func.count(lines.c.id),
+        db.func.sum(case((lines.c.variance != 0, 1), else_=0)),
+        db.func.sum(lines.c.variance),
+        db.func.sum(lines.c.variance_value)
+    ).one()
+
+    query = db.session.query(lines)
+    if request.args.get('only_diff', 'false').lower() == 'true':
+        query = query.filter(lines.c.variance != 0)
+    if search:
+        s_norm = remove_accents(search)
+        query = query.filter(db.func.remove_accents(lines.c.name).ilike(f'%{s_norm}%') | lines.c.code.ilike(f'%{search}%'))
+    total = query.count()
+    rows = query.order_by(lines.c.name.asc()).offset((page - 1) * limit).limit(limit).all()
+    return jsonify({
+        **st.to_dict(),
+        'summary': {
+            'lines': summary[0] or 0,
+            'lines_with_variance': summary[1] or 0,
+            'variance_quantity': summary[2] or 0,
+            'variance_value': summary[3] or 0
+        },
+        'items': [{
+            'product_id': r.product_id, 'name': r.name, 'code': r.code, 'unit': r.unit,
+            'counted': r.counted, 'system_qty': r.system_qty, 'variance': r.variance, 'variance_value': r.variance_value
+        } for r in rows],
+        'total': total,
+        'pages': (total + limit - 1) // limit,
+        'current_page': page
+    })
+
+@app.route('/api/stocktakes/<int:id>/counts', methods=['POST'])
+def post_stocktake_counts(id):
+    # {items: [{product_id | code | name, quantity}], mode: 'set' (counted) | 'add' (scanner)}
+    st = db.get_or_404(Stocktake, id)
+    if st.status != 'Draft':
+        return jsonify({'error': 'Phiếu kiểm kho đã hoàn tất'}), 400
+    data = request.json or {}
+    try:
+        counts, unmatched = resolve_count_items(data.get('items', []))
+        record_stocktake_counts(st, counts, data.get('mode', 'set'))
+        db.session.commit()
+        return jsonify({'message': f'Đã ghi nhận {len(counts)} sản phẩm', 'count': len(counts), 'unmatched': unmatched})
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/api/stocktakes/<int:id>/import', methods=['POST'])
+def import_stocktake_counts(id):
+    # Excel columns: 'Mã' and/or 'Tên sản phẩm', plus 'Số lượng'
+    st = db.get_or_404(Stocktake, id)
+    if st.status != 'Draft':
+        return jsonify({'error': 'Phiếu kiểm kho đã hoàn tất'}), 400
+    if 'file' not in request.files:
+        return jsonify({'error': 'No file part'}), 400
+    try:
+        import openpyxl
+        wb = openpyxl.load_workbook(request.files['file'], read_only=True, data_only=True)
+        rows = wb.active.iter_rows(values_only=True)
+        headers = [str(h).strip() if h is not None else '' for h in next(rows)]
+        col = lambda name: headers.index(name) if name in headers else None
+        i_code, i_name, i_qty = col('Mã'), col('Tên sản phẩm'), col('Số lượng')
+        if i_qty is None or (i_code is None and i_name is None):
+            return jsonify({'error': "File cần cột 'Số lượng' và 'Mã' hoặc 'Tên sản phẩm'"}), 400
+        items = []
+        for row in rows:
+            if row[i_qty] is None:
+                continue
+            items.append({
+                'code': row[i_code] if i_code is not None else None,
+                'name': row[i_name] if i_name is not None else None,
+                'quantity': row[i_qty]
             })
+        counts, unmatched = resolve_count_items(items)
+        record_stocktake_counts(st, counts, request.form.get('mode', 'set'))
+        db.session.commit()
+        return jsonify({'message': f'Đã nhập {len(counts)} sản phẩm', 'count': len(counts), 'unmatched': unmatched})
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
 
-        # Also need to check if this product is part of any Combos that were sold
-        # Find all combos that include this product
-        parent_combos = ComboItem.query.filter_by(product_id=id).all()
-        for ci in parent_combos:
-            combo_prod_id = ci.combo_id
-            # Find sales of this combo
-            combo_details = OrderDetail.query.filter_by(product_id=combo_prod_id).join(Order).all()
-            for cd in combo_details:
-                qty_deducted = cd.quantity * ci.quantity # Total items used
-                
-                type_label = 'Bán Combo'
-                if cd.order.type == 'Purchase': type_label = 'Nhập Combo' # Rare
-                
-                # If Sale, we lost stock
-                change = -qty_deducted if cd.order.type == 'Sale' else qty_deducted
-                
-                history.append({
-                    'date': cd.order.date.isoformat(),
-                    'display_id': cd.order.display_id,
-                    'order_id': cd.order.id,
-                    'partner_name': cd.order.partner.name if cd.order.partner else 'Khách Lẻ',
-                    'type': f"{type_label} ({cd.product.name})",
-                    'quantity_change': change,
-                    'price': 0 # Hard to attribute price
-                })
-        
-        # Sort combined history by date desc
-        history.sort(key=lambda x: x['date'], reverse=True)
-        
-        return jsonify(history)
+@app.route('/api/stocktakes/<int:id>/finalize', methods=['POST'])
+def finalize_stocktake(id):
+    # One transaction: freeze variances, adjust stock at the location, journal 'Stocktake' movements.
+    # zero_uncounted=true treats products in stock at the location but not counted as counted 0.
+    st = db.get_or_404(Stocktake, id)
+    if st.status != 'Draft':
+        return jsonify({'error': 'Phiếu kiểm kho đã hoàn tất'}), 400
+    data = request.json or {}
+    try:
+        if data.get('zero_uncounted'):
+            counted = db.session.query(StocktakeLine.product_id).filter(StocktakeLine.stocktake_id == st.id)
+            db.session.execute(StocktakeLine.__table__.insert().from_select(
+                ['stocktake_id', 'product_id', 'counted'],
+                db.session.query(db.literal(st.id), LocationStock.product_id, db.literal(0))
+                  .filter(LocationStock.location_id == st.location_id, LocationStock.quantity != 0,
+                          LocationStock.product_id.notin_(counted)).statement
+            ))
+
+        rows = stocktake_lines_query(st).all()
+        if rows:
+            table = StocktakeLine.__table__
+            db.session.execute(
+                table.update().where(table.c.id == bindparam('b_id')).values(system_qty=bindparam('b_system'), variance=bindparam('b_variance')),
+                [{'b_id': r.id, 'b_system': r.system_qty, 'b_variance': r.variance} for r in rows]
+            )
+
+        posting = Posting()
+        for r in rows:
+            if r.variance:
+                posting.adjust_stock(r.product_id, r.variance, 'Stocktake', location_id=st.location_id, ref=st.display_id)
+        st.status = 'Completed'
+        st.completed_at = get_vn_time()
+        posting.commit()
+        changed = sum(1 for r in rows if r.variance)
+        return jsonify({**st.to_dict(), 'adjusted': changed})
     except Exception as e:
+        db.session.rollback()
         return jsonify({'error': str(e)}), 400
 
+@app.route('/api/stocktakes/<int:id>', methods=['DELETE'])
+def delete_stocktake(id):
+    st = db.get_or_404(Stocktake, id)
+    if st.status == 'Completed':
+        return jsonify({'error': 'Không thể xóa phiếu kiểm kho đã hoàn tất'}), 400
+    StocktakeLine.query.filter_by(stocktake_id=st.id).delete()
+    db.session.delete(st)
+    db.session.commit()
+    return jsonify({'message': 'Deleted successfully'})
+
 # --- Combo Items ---
 @app.route('/api/combos/<int:combo_id>/items', methods=['GET'])
 def get_combo_items(combo_id):
@@ -974,18 +2281,20 @@ def create_partner():
         new_partner.type = 'Customer'
         
     db.session.add(new_partner)
-    db.session.commit()
+    db.session.flush()
     
     # Create Opening Balance Order if debt exists
     if new_partner.debt_balance != 0:
         create_opening_balance_order(new_partner.id, new_partner.debt_balance, new_partner.type)
-        
+    
+    invalidate_kpis('debt')
+    db.session.commit()
     return jsonify(new_partner.to_dict()), 201
 
 @app.route('/api/partners/<int:id>', methods=['PUT'])
 def update_partner(id):
     try:
-        partner = Partner.query.get_or_404(id)
+        partner = db.get_or_404(Partner, id)
         data = request.json
         
         partner.name = data.get('name', partner.name)
@@ -1006,7 +2315,9 @@ def update_partner(id):
         # Only update debt if it's explicitly provided in the request
         if 'debt_balance' in data:
             partner.debt_balance = float(data['debt_balance'])
+            mark_reconcile_dirty('partner', [partner.id])
             
+        invalidate_kpis('debt')
         db.session.commit()
         return jsonify(partner.to_dict())
     except Exception as e:
@@ -1026,8 +2337,9 @@ def delete_partner(id):
         if voucher_count > 0:
             return jsonify({'error': f'Không thể xóa đối tác vì đã có {voucher_count} phiếu thu/chi. Hãy xóa các phiếu này trong Quỹ tiền trước.'}), 400
         
-        partner = Partner.query.get_or_404(id)
+        partner = db.get_or_404(Partner, id)
         db.session.delete(partner)
+        invalidate_kpis('debt')
         db.session.commit()
         return jsonify({'message': 'Deleted successfully'})
     except Exception as e:
@@ -1050,12 +2362,126 @@ def bulk_delete_partners():
             return jsonify({'error': 'Có một số đối tác đã có lịch sử đơn hàng hoặc phiếu thu chi, không thể xóa hàng loạt.'}), 400
             
         deleted = Partner.query.filter(Partner.id.in_(ids)).delete(synchronize_session=False)
+        invalidate_kpis('debt')
         db.session.commit()
         return jsonify({'message': f'Đã xóa {deleted} đối tác thành công'})
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 400
 
+def partner_name_key(name):
+    """Accent-, case-, spacing- and punctuation-insensitive name used to block duplicates."""
+    return re.sub(r'[^a-z0-9]', '', remove_accents(name))
+
+def partner_phone_key(phone):
+    digits = re.sub(r'\D', '', phone or '')
+    if digits.startswith('84') and len(digits) > 10:
+        digits = '0' + digits[2:]
+    return digits if len(digits) >= 9 else None
+
+@app.route('/api/partners/duplicates', methods=['GET'])
+def find_duplicate_partners():
+    """
+    Groups of partners sharing a normalized name or phone. Candidates are blocked by key in
+    one pass (no pairwise comparison) and linked with union-find, so A~B by phone and B~C by
+    name end up in one group. Paginated over groups, largest first.
+    """
+    page = request.args.get('page', 1, type=int)
+    limit = request.args.get('limit', 50, type=int)
+    rows = db.session.query(Partner.id, Partner.name, Partner.phone).all()
+
+    parent = {r.id: r.id for r in rows}
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    first_by_key = {}
+    for r in rows:
+        keys = [('name', partner_name_key(r.name))]
+        phone = partner_phone_key(r.phone)
+        if phone:
+            keys.append(('phone', phone))
+        for key in keys:
+            if not key[1]:
+                continue
+            if key in first_by_key:
+                parent[find(r.id)] = find(first_by_key[key])
+            else:
+                first_by_key[key] = r.id
+
+    members = {}
+    for r in rows:
+        members.setdefault(find(r.id), []).append(r.id)
+    groups = sorted((ids for ids in members.values() if len(ids) > 1), key=lambda ids: (-len(ids), ids[0]))
+
+    total = len(groups)
+    start = (page - 1) * limit
+    page_groups = groups[start:start + limit]
+    page_ids = [pid for ids in page_groups for pid in ids]
+    partners = {p.id: p for p in Partner.query.filter(Partner.id.in_(page_ids)).all()} if page_ids else {}
+    return jsonify({
+        'items': [[partners[pid].to_dict() for pid in ids] for ids in page_groups],
+        'total': total,
+        'pages': (total + limit - 1) // limit,
+        'current_page': page
+    })
+
+@app.route('/api/partners/merge', methods=['POST'])
+def merge_partners():
+    """
+    Fold source_ids into target_id: orders, vouchers, bank transactions and customer prices
+    are repointed with set-based UPDATEs, the survivor takes over the sources' debt_balance
+    and its ledger is rebuilt, and the sources are deleted, all in one transaction.
+    """
+    data = request.json or {}
+    try:
+        target_id = int(data['target_id'])
+        source_ids = list({int(i) for i in data.get('source_ids', [])})
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'error': 'No IDs provided'}), 400
+    if not source_ids:
+        return jsonify({'error': 'No IDs provided'}), 400
+    if target_id in source_ids:
+        return jsonify({'error': 'Đối tác giữ lại không được nằm trong danh sách cần gộp'}), 400
+    target = db.get_or_404(Partner, target_id)
+    try:
+        sources = Partner.query.filter(Partner.id.in_(source_ids)).all()
+        if len(sources) != len(source_ids):
+            return jsonify({'error': 'Không tìm thấy đối tác cần gộp'}), 404
+
+        for model in (Order, CashVoucher, BankTransaction):
+            db.session.query(model).filter(model.partner_id.in_(source_ids))\
+                .update({model.partner_id: target.id}, synchronize_session=False)
+        # The survivor's own special price wins over a source's price for the same product
+        target_products = db.session.query(CustomerPrice.product_id).filter(CustomerPrice.partner_id == target.id)
+        CustomerPrice.query.filter(CustomerPrice.partner_id.in_(source_ids), CustomerPrice.product_id.in_(target_products))\
+            .delete(synchronize_session=False)
+        CustomerPrice.query.filter(CustomerPrice.partner_id.in_(source_ids))\
+            .update({CustomerPrice.partner_id: target.id}, synchronize_session=False)
+
+        for src in sources:
+            target.is_customer = target.is_customer or src.is_customer
+            target.is_supplier = target.is_supplier or src.is_supplier
+            target.phone = target.phone or src.phone
+            target.address = target.address or src.address
+            target.cccd = target.cccd or src.cccd
+        target.type = 'Both' if target.is_customer and target.is_supplier else ('Supplier' if target.is_supplier else 'Customer')
+
+        # Balances add up as stored (they may hold debt set by hand), only the ledger rows are rebuilt
+        target.debt_balance = (target.debt_balance or 0) + sum(src.debt_balance or 0 for src in sources)
+        rebuild_partner_ledger(source_ids + [target.id])
+        Partner.query.filter(Partner.id.in_(source_ids)).delete(synchronize_session=False)
+        mark_reconcile_dirty('partner', [target.id])
+        invalidate_kpis('debt')
+        result = {'partner': target.to_dict(), 'merged': len(source_ids)}
+        db.session.commit()
+        return jsonify(result)
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
+
 @app.route('/api/partners/import', methods=['POST'])
 def import_partners():
     if 'file' not in request.files:
@@ -1079,6 +2505,7 @@ def import_partners():
                 return default
 
         count = 0
+        ledger_partners = set()
         for row in ws.iter_rows(min_row=2):
             name = str(get_val(row, 'Tên đối tác', '')).strip()
             if not name or name == 'None' or name == '': continue
@@ -1130,8 +2557,8 @@ def import_partners():
                 # However, to avoid complexity, let's just flush.
                 db.session.flush() # Ensure partner.id is set
                 
-                # Check if 'NODAU' exists
-                existing_nodau = Order.query.filter_by(partner_id=partner.id, display_id='NODAU').first()
+                # Check if an opening balance order exists
+                existing_nodau = Order.query.filter_by(partner_id=partner.id, is_opening_balance=True).first()
                 if existing_nodau:
                     # Update it
                     is_positive = d_val > 0
@@ -1146,15 +2573,21 @@ def import_partners():
                         type=order_type,
                         payment_method='Debt',
                         display_id='NODAU',
+                        is_opening_balance=True,
                         total_amount=abs(d_val),
                         note='Nợ đầu kỳ (Import)',
                         amount_paid=0,
                         date=datetime.now()
                     )
                     db.session.add(new_nodau)
+                ledger_partners.add(partner.id)
             
             count += 1
             
+        db.session.flush()
+        rebuild_partner_ledger(list(ledger_partners))
+        mark_reconcile_dirty('partner', ledger_partners)
+        invalidate_kpis('debt')
         db.session.commit()
         
         return jsonify({'message': f'Đã nhập {count} đối tác thành công! Lịch sử công nợ đầu kỳ đã được ghi nhận.'})
@@ -1181,17 +2614,21 @@ def create_opening_balance_order(partner_id, amount, p_type=None):
         type=order_type,
         payment_method='Debt',
         display_id='#NODAU',
+        is_opening_balance=True,
         total_amount=abs_amount,
         note='Nợ đầu kỳ',
         amount_paid=0,
         date=datetime.now() # Should strictly consist with creation, but now is fine
     )
     db.session.add(order)
-    db.session.commit()
+    db.session.flush()
+    rebuild_partner_ledger([partner_id])
+    # Caller commits
+    return order
 
 @app.route('/api/partners/<int:id>/fix-opening-balance', methods=['POST'])
 def fix_opening_balance(id):
-    partner = Partner.query.get_or_404(id)
+    partner = db.get_or_404(Partner, id)
     data = request.json
     amount = data.get('amount') # The missing amount to record
     
@@ -1200,6 +2637,7 @@ def fix_opening_balance(id):
         
     try:
         create_opening_balance_order(id, float(amount))
+        db.session.commit()
         return jsonify({'message': 'Đã ghi nhận nợ đầu kỳ thành công'})
     except Exception as e:
         db.session.rollback()
@@ -1229,84 +2667,20 @@ def get_partner_template():
 
 @app.route('/api/partners/<int:id>/debt-cycles', methods=['GET'])
 def get_partner_debt_cycles(id):
-    # Fetch all orders and vouchers for the partner
-    orders = Order.query.filter_by(partner_id=id).order_by(Order.date.asc()).all()
-    vouchers = CashVoucher.query.filter_by(partner_id=id).order_by(CashVoucher.date.asc()).all()
-    
-    # Combine and sort by date
-    timeline = []
-    for o in orders:
-        timeline.append({'type': 'order', 'date': o.date, 'obj': o})
-    for v in vouchers:
-        timeline.append({'type': 'voucher', 'date': v.date, 'obj': v})
-    
-    timeline.sort(key=lambda x: x['date'])
-    
-    cycles = []
-    current_cycle = None
-    balance = 0
-    
-    for item in timeline:
-        if item['type'] == 'order':
-            o = item['obj']
-            # Debt increases based on type
-            # Sale: total - paid = debt to me (+)
-            # Purchase: total - paid = my debt to them (-)
-            # But let's simplify: absolute debt is what matters for "period"
-            # Actually, user says debt period starts with first debt order.
-            
-            # IMPORTANT: For Debt orders, we add the FULL total_amount to the balance.
-            # We ignore amount_paid here because the payment is recorded 
-            # via a separate Voucher by the Settlement/POS logic.
-            # This ensures symmetry (+Goods, -Payment) and avoids double-counting.
-            if o.payment_method == 'Debt':
-                if o.type == 'Sale':
-                    balance += o.total_amount
-                else:
-                    balance -= o.total_amount
-                
-            if o.payment_method == 'Debt' and current_cycle is None and balance != 0:
-                current_cycle = {
-                    'start_date': o.date.isoformat(),
-                    'end_date': None,
-                    'status': 'Đang còn nợ'
-                }
-        else:
-            v = item['obj']
-            if v.type == 'Receipt': # Customer pays us
-                balance -= v.amount
-            else: # We pay supplier
-                balance += v.amount
-        
-        # Use a small epsilon for float comparison
-        if current_cycle and abs(balance) < 1:
-            current_cycle['end_date'] = item['date'].isoformat()
-            current_cycle['status'] = 'Đã tất toán'
-            cycles.append(current_cycle)
-            current_cycle = None
-            
-    if current_cycle:
-        cycles.append(current_cycle)
-        
-    return jsonify(cycles)
+    # Cycles are maintained by the Posting as ledger entries are written
+    cycles = PartnerDebtCycle.query.filter_by(partner_id=id)\
+        .order_by(PartnerDebtCycle.start_date, PartnerDebtCycle.start_entry_id).all()
+    return jsonify([c.to_dict() for c in cycles])
 
 @app.route('/api/partners/<int:id>/recalculate-debt', methods=['POST'])
 def recalculate_partner_debt(id):
-    partner = Partner.query.get_or_404(id)
+    partner = db.get_or_404(Partner, id)
     try:
-        # Sum of all Debt orders
-        # Sale (+) / Purchase (-)
-        sale_debt = db.session.query(db.func.sum(Order.total_amount)).filter(Order.partner_id == id, Order.payment_method == 'Debt', Order.type == 'Sale').scalar() or 0
-        purchase_debt = db.session.query(db.func.sum(Order.total_amount)).filter(Order.partner_id == id, Order.payment_method == 'Debt', Order.type == 'Purchase').scalar() or 0
-        
-        # Sum of all vouchers
-        # Receipt (-) : Customer pays us
-        # Payment (+) : We pay supplier
-        receipts = db.session.query(db.func.sum(CashVoucher.amount)).filter(CashVoucher.partner_id == id, CashVoucher.type == 'Receipt').scalar() or 0
-        payments = db.session.query(db.func.sum(CashVoucher.amount)).filter(CashVoucher.partner_id == id, CashVoucher.type == 'Payment').scalar() or 0
-        
-        new_balance = (sale_debt - purchase_debt) - (receipts - payments)
+        # Debt orders: Sale (+) / Purchase (-); vouchers: Receipt (-) / Payment (+)
+        new_balance = expected_partner_balances([id]).get(id, 0)
         partner.debt_balance = new_balance
+        rebuild_partner_ledger([id])
+        invalidate_kpis('debt')
         db.session.commit()
         return jsonify({'message': 'Recalculated successfully', 'new_balance': new_balance})
     except Exception as e:
@@ -1315,91 +2689,35 @@ def recalculate_partner_debt(id):
 
 @app.route('/api/partners/<int:id>/ledger', methods=['GET'])
 def get_partner_ledger(id):
-    # Retrieve full ledger for partner
+    # Newest first, keyset-paginated over the stored (partner_id, date, id) ledger index.
+    # Each row carries its running balance; order details are fetched on demand via /api/orders/<id>.
+    limit = min(request.args.get('limit', 50, type=int), 500)
+    cursor = request.args.get('cursor')
     try:
-        partner = Partner.query.get_or_404(id)
-        
-        # 1. Get all Debt Orders
-        orders = Order.query.filter(
-            Order.partner_id == id, 
-            Order.payment_method == 'Debt'
-        ).all()
-        
-        # 2. Get all Vouchers
-        vouchers = CashVoucher.query.filter_by(partner_id=id).all()
-        
-        # 3. Combine into timeline
-        timeline = []
-        for o in orders:
-            timeline.append({
-                'date': o.date,
-                'type': 'Order',
-                'ref_id': o.display_id,
-                'desc': f"{'Mua hàng' if o.type == 'Sale' else 'Nhập hàng'} (Đơn {o.display_id})",
-                'obj': o,
-                'timestamp': o.date.timestamp()
-            })
-            
-        for v in vouchers:
-            desc = v.note
-            if not desc:
-                if v.type == 'Receipt': desc = 'Phiếu thu tiền'
-                else: desc = 'Phiếu chi tiền'
-            
-            timeline.append({
-                'date': v.date,
-                'type': 'Voucher',
-                'ref_id': f"PT-{v.id}" if v.type == 'Receipt' else f"PC-{v.id}",
-                'desc': desc,
-                'obj': v,
-                'timestamp': v.date.timestamp()
-            })
-            
-        # Sort by Date Ascending for Calculation
-        timeline.sort(key=lambda x: x['date'])
-        
-        ledger = []
-        balance = 0
-        
-        for item in timeline:
-            row = {
-                'date': item['date'].isoformat(),
-                'ref_id': item['ref_id'],
-                'desc': item['desc'],
-                'type': item['type'],
-                'increase': 0,
-                'decrease': 0,
-                'running_balance': 0,
-                'obj': item['obj'].to_dict()
-            }
-            
-            if item['type'] == 'Order':
-                o = item['obj']
-                if o.type == 'Sale':
-                    row['increase'] = o.total_amount
-                    balance += o.total_amount
-                else:
-                    row['decrease'] = o.total_amount
-                    balance -= o.total_amount
-            else:
-                v = item['obj']
-                if v.type == 'Receipt':
-                    row['decrease'] = v.amount
-                    balance -= v.amount
-                else: 
-                    row['increase'] = v.amount
-                    balance += v.amount
-            
-            row['running_balance'] = balance
-            ledger.append(row)
-            
-        # For display, reverse to show Newest first
-        ledger.reverse()
+        partner = db.get_or_404(Partner, id)
+        query = PartnerLedgerEntry.query.filter(PartnerLedgerEntry.partner_id == id)
+        if cursor:
+            c_date, c_id = cursor.rsplit('|', 1)
+            c_date = datetime.fromisoformat(c_date)
+            query = query.filter(db.or_(
+                PartnerLedgerEntry.date < c_date,
+                db.and_(PartnerLedgerEntry.date == c_date, PartnerLedgerEntry.id < int(c_id))
+            ))
+        rows = query.order_by(PartnerLedgerEntry.date.desc(), PartnerLedgerEntry.id.desc()).limit(limit + 1).all()
+        
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        next_cursor = f"{rows[-1].date.isoformat()}|{rows[-1].id}" if has_more else None
+        
+        current_balance = db.session.query(PartnerLedgerEntry.balance_after)\
+            .filter(PartnerLedgerEntry.partner_id == id)\
+            .order_by(PartnerLedgerEntry.date.desc(), PartnerLedgerEntry.id.desc()).limit(1).scalar()
         
         return jsonify({
             'partner': partner.to_dict(),
-            'ledger': ledger,
-            'current_balance': balance
+            'ledger': [e.to_dict() for e in rows],
+            'next_cursor': next_cursor,
+            'current_balance': current_balance or 0
         })
         
     except Exception as e:
@@ -1498,6 +2816,834 @@ def save_custom_price():
     db.session.commit()
     return jsonify(cp.to_dict())
 
+# --- Dashboard KPIs ---
+# Stored in DashboardCounter and moved by the Posting from the partner balances, product stock
+# and lot quantities it holds before and after its deltas (Posting._kpi_deltas). Writes outside
+# the Posting drop the affected rows instead (invalidate_kpis); the dashboard recomputes missing
+# or stale rows when it reads them.
+
+KPI_GROUPS = {
+    'debt': ('receivable', 'payable'),
+    'low_stock': ('low_stock',),
+    'expiry': ('expired', 'near_expiry')
+}
+EXPIRY_WARNING_DAYS = 60
+
+def debt_kpis(partner_ids=None):
+    """Receivables (customers owing us) and payables (what we owe suppliers), for all or some partners."""
+    if partner_ids is not None and not partner_ids:
+        return {'receivable': 0, 'payable': 0}
+    query = db.session.query(
+        db.func.sum(case((db.and_(Partner.is_customer == True, Partner.debt_balance > 0), Partner.debt_balance), else_=0)),
+        db.func.sum(case((db.and_(Partner.is_supplier == True, Partner.debt_balance < 0), -Partner.debt_balance), else_=0)))
+    if partner_ids is not None:
+        query = query.filter(Partner.id.in_(partner_ids))
+    receivable, payable = query.one()
+    return {'receivable': receivable or 0, 'payable': payable or 0}
+
+def low_stock_kpis(product_ids=None):
+    if product_ids is not None and not product_ids:
+        return {'low_stock': 0}
+    query = Product.query.filter(Product.stock < 2 * Product.multiplier)
+    if product_ids is not None:
+        query = query.filter(Product.id.in_(product_ids))
+    return {'low_stock': query.count()}
+
+def expiry_kpis(product_ids=None, today=None):
+    """Products with stocked lots that are expired / expire within EXPIRY_WARNING_DAYS."""
+    if product_ids is not None and not product_ids:
+        return {'expired': 0, 'near_expiry': 0}
+    today = today or get_vn_time().date()
+    def count(status):
+        query = db.session.query(db.func.count(db.distinct(ProductLot.product_id)))\
+            .filter(*expiring_lot_filters(status, EXPIRY_WARNING_DAYS, today))
+        if product_ids is not None:
+            query = query.filter(ProductLot.product_id.in_(product_ids))
+        return query.scalar() or 0
+    return {'expired': count('expired'), 'near_expiry': count('near')}
+
+KPI_COMPUTE = {'debt': debt_kpis, 'low_stock': low_stock_kpis, 'expiry': expiry_kpis}
+
+def bump_kpis(deltas):
+    """Add deltas onto the stored counters; rows that are missing stay missing."""
+    table = DashboardCounter.__table__
+    today = get_vn_time().date()
+    for key, delta in deltas.items():
+        if not delta:
+            continue
+        where = [table.c.key == key]
+        if key in KPI_GROUPS['expiry']:
+            where.append(table.c.as_of == today) # yesterday's counts are recomputed anyway
+        db.session.execute(table.update().where(*where).values(value=table.c.value + delta))
+
+def invalidate_kpis(*groups):
+    keys = [key for group in groups for key in KPI_GROUPS[group]]
+    DashboardCounter.query.filter(DashboardCounter.key.in_(keys)).delete(synchronize_session=False)
+
+def read_kpis(refresh=False):
+    """All counters, recomputing the groups that are missing, from another day (expiry) or refresh=True."""
+    today = get_vn_time().date()
+    rows = {r.key: r for r in DashboardCounter.query.all()}
+    values = {}
+    changed = False
+    for group, keys in KPI_GROUPS.items():
+        stale = refresh or any(key not in rows for key in keys) or \
+            (group == 'expiry' and any(rows[key].as_of != today for key in keys))
+        if not stale:
+            values.update({key: rows[key].value for key in keys})
+            continue
+        fresh = KPI_COMPUTE[group]()
+        for key, value in fresh.items():
+            row = rows.get(key) or DashboardCounter(key=key)
+            row.value = value
+            row.as_of = today if group == 'expiry' else None
+            db.session.add(row)
+        values.update(fresh)
+        changed = True
+    if changed:
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback() # another request stored them first
+    return values
+
+# --- Posting Engine ---
+# Every money-moving action (orders, vouchers, bank transactions) goes through one Posting.
+# Balance changes are collected in memory while the action is built, then applied as one
+# atomic "col = col + delta" UPDATE per partner / bank account / product right before the
+# single commit, so the write lock is only held for the final flush.
+
+# Shift column that collects the sales of each payment method (everything else: sales_other)
+SHIFT_SALES_COLUMNS = {'Cash': 'sales_cash', 'Transfer': 'sales_transfer', 'Debt': 'sales_debt'}
+
+def bank_balance_delta(t_type, amount):
+    if t_type == 'Deposit':
+        return amount
+    if t_type == 'Withdrawal':
+        return -amount
+    return 0
+
+def sync_order_amount_paid(order_id):
+    """
+    Recalculate a Debt order's amount_paid from its linked vouchers.
+    Vouchers in the settling direction (Receipt for a Sale, Payment for a Purchase,
+    swapped for returns) count positive, the opposite direction is a refund.
+    Does not commit: callers run it inside their Posting.
+    """
+    order = db.session.get(Order, order_id) if order_id else None
+    if not order or order.payment_method != 'Debt':
+        return
+
+    settling = 'Receipt' if (order.type == 'Sale') == ((order.total_amount or 0) >= 0) else 'Payment'
+    total_paid = db.session.query(
+        db.func.sum(case((CashVoucher.type == settling, CashVoucher.amount), else_=-CashVoucher.amount))
+    ).filter(CashVoucher.order_id == order_id, CashVoucher.type.in_(['Receipt', 'Payment'])).scalar() or 0
+    order.amount_paid = total_paid
+
+UPSERT_BATCH = 500 # rows per multi-row upsert, well under SQLite's bound-parameter limit
+
+class Posting:
+    """Unit of work for one business action. Call commit() exactly once at the end."""
+
+    def __init__(self):
+        self.partner_deltas = {}
+        self.bank_deltas = {}
+        self.stock_deltas = {}
+        self.location_deltas = {}
+        self.movements = []
+        self.lot_moves = []
+        self.ledger_adds = []
+        self.ledger_removes = []
+        self.cash_moves = [] # (date or None, document, delta); the day is resolved at flush
+        self.bank_adds = []
+        self.bank_removes = []
+        self.period_moves = [] # (date or None, document, metric, amount) for FinancePeriodTotal
+        self.shift_deltas = {} # {(shift_id, column): delta}
+        self.hourly_totals = {} # {(hour, type): [revenue, cost, quantity, orders]}
+        self.product_totals = {} # {(day, type, product_id): [revenue, cost, quantity, orders]}
+        self.lot_changes = {} # {lot id: [product_id, expiry, quantity before, after]} for the expiry KPIs
+        self._default_location = None
+        self.orders_to_sync = set()
+
+    @staticmethod
+    def _add(bucket, key, delta):
+        if key and delta:
+            bucket[key] = bucket.get(key, 0) + delta
+
+    def adjust_partner(self, partner_id, delta):
+        self._add(self.partner_deltas, partner_id, delta)
+
+    def adjust_bank(self, account_id, delta):
+        self._add(self.bank_deltas, account_id, delta)
+
+    def adjust_shift(self, shift_id, column, delta):
+        if shift_id:
+            self._add(self.shift_deltas, (shift_id, column), delta)
+
+    def shift_flow(self, shift_id, prefix, delta, reversal=False):
+        """Money in/out of a shift's drawer (prefix 'cash') or bank (prefix 'bank')."""
+        # A reversal takes back from the side it was booked on
+        if (delta > 0) != reversal:
+            self.adjust_shift(shift_id, f"{prefix}_in", delta)
+        else:
+            self.adjust_shift(shift_id, f"{prefix}_out", -delta)
+
+    def partner_balance(self, partner):
+        """Partner balance including the deltas this posting has not applied yet."""
+        return (partner.debt_balance or 0) + self.partner_deltas.get(partner.id, 0)
+
+    def location_of(self, order):
+        if order is not None and order.location_id:
+            return order.location_id
+        if self._default_location is None:
+            self._default_location = default_location_id()
+        return self._default_location
+
+    def move_stock(self, product, quantity, order_type, order=None, price=0, reversal=False, lot=None):
+        """
+        Sale takes stock out, Purchase brings it in. Combos move their components.
+        Every change is also journaled as a StockMovement row for the given order,
+        at the order's location (read now, so an edit can reverse the old location).
+        lot is the (code, expiry) a purchase line is received into.
+        """
+        if order_type == 'Sale':
+            direction = -1
+        elif order_type == 'Purchase':
+            direction = 1
+        else:
+            return
+        if product.is_combo:
+            for ci in product.combo_items:
+                self._journal(ci.product_id, direction * quantity * ci.quantity, order_type, order, 0, reversal, combo=product)
+        else:
+            if order_type == 'Purchase':
+                if reversal:
+                    self.receive_cost(product, -quantity, price, reverse=True)
+                else:
+                    self.receive_cost(product, quantity, price)
+            self._journal(product.id, direction * quantity, order_type, order, price, reversal, lot=lot)
+
+    def receive_cost(self, product, quantity, unit_price, reverse=False):
+        """
+        Keep Product.avg_cost as a running weighted-average cost.
+        Must run before the line's own stock delta is collected. A purchase blends
+        into the stock on hand, reverse=True takes a received lot back out. Sales and
+        returns move stock at the current average, so they leave it unchanged.
+        """
+        if quantity <= 0:
+            return
+        on_hand = max(float(product.stock or 0) + self.stock_deltas.get(product.id, 0), 0)
+        avg = product.avg_cost or 0
+        if not reverse:
+            product.avg_cost = (on_hand * avg + quantity * unit_price) / (on_hand + quantity)
+        elif on_hand - quantity > 0:
+            product.avg_cost = max((on_hand * avg - quantity * unit_price) / (on_hand - quantity), 0)
+
+    def _journal(self, product_id, quantity, kind, order, price, reversal, combo=None, lot=None, location_id=None, ref=None):
+        if not quantity:
+            return
+        location_id = location_id or self.location_of(order)
+        self._add(self.stock_deltas, product_id, quantity)
+        self._add(self.location_deltas, (product_id, location_id), quantity)
+        if not reversal and kind != 'Transfer': # reversals give lots back through release_lots()
+            self.lot_moves.append((product_id, quantity, order, lot))
+        self.movements.append({
+            'product_id': product_id,
+            'quantity': quantity,
+            'kind': kind,
+            'reversal': reversal,
+            'order': order, # id is resolved at flush time (new orders have none yet)
+            'partner_id': order.partner_id if order is not None else None,
+            'ref': order.display_id if order is not None else ref,
+            'combo_id': combo.id if combo is not None else None,
+            'note': combo.name if combo is not None else None,
+            'price': price,
+            'location_id': location_id
+        })
+
+    def adjust_stock(self, product_id, quantity, kind, location_id=None, ref=None):
+        """Stock change that belongs to no order (e.g. a stocktake), journaled like any other."""
+        self._journal(product_id, quantity, kind, None, 0, False, location_id=location_id, ref=ref)
+
+    def transfer_stock(self, transfer, reverse=False):
+        """Move a transfer's items between its locations; totals are unchanged. Combos move their components."""
+        sign = -1 if reverse else 1
+        for item in transfer.items:
+            product = item.product or db.session.get(Product, item.product_id)
+            parts = [(ci.product_id, ci.quantity) for ci in product.combo_items] if product.is_combo else [(product.id, 1)]
+            for product_id, per_unit in parts:
+                quantity = sign * item.quantity * per_unit
+                self._journal(product_id, -quantity, 'Transfer', None, 0, reverse, location_id=transfer.from_location_id, ref=transfer.display_id)
+                self._journal(product_id, quantity, 'Transfer', None, 0, reverse, location_id=transfer.to_location_id, ref=transfer.display_id)
+
+    def post_order(self, order, reverse=False):
+        """Stock and debt effect of a saved order; reverse=True undoes it."""
+        sign = -1 if reverse else 1
+        if reverse:
+            self.release_lots(order)
+        for d in order.details:
+            if d.product:
+                self.move_stock(d.product, sign * d.quantity, order.type, order, d.price, reversal=reverse,
+                                lot=(d.lot_code, d.lot_expiry))
+        self.post_order_debt(order, reverse)
+        self.post_order_totals(order, reverse)
+
+    def adjust_cash(self, doc, delta, reversal=False):
+        """Cash on hand change booked on the document's day (read now, or at flush for new rows)."""
+        if delta:
+            self.cash_moves.append((doc.date, doc, delta, reversal))
+            self.shift_flow(doc.shift_id, 'cash', delta, reversal)
+
+    def add_period(self, doc, metric, amount):
+        if amount:
+            self.period_moves.append((doc.date, doc, metric, amount))
+
+    def post_order_totals(self, order, reverse=False, details=None):
+        """Cash (Cash orders only), P&L and sales rollup side of an order.
+        details: the order's lines when they were written without going through order.details."""
+        sign = -1 if reverse else 1
+        delta = order_cash_delta(order.type, order.payment_method, order.total_amount or 0, order.is_opening_balance)
+        self.adjust_cash(order, sign * delta, reverse)
+        if not order.is_opening_balance:
+            if order.type == 'Sale':
+                self.add_period(order, 'revenue', sign * (order.total_amount or 0))
+                self.add_period(order, 'cogs', sign * (order.total_cost or 0))
+                method = SHIFT_SALES_COLUMNS.get(order.payment_method, 'sales_other')
+                self.adjust_shift(order.shift_id, method, sign * (order.total_amount or 0))
+                self.adjust_shift(order.shift_id, 'sales_count', sign)
+            else:
+                self.add_period(order, 'purchases', sign * (order.total_amount or 0))
+                self.adjust_shift(order.shift_id, 'purchases', sign * (order.total_amount or 0))
+            self.post_sales_rollup(order, sign, order.details if details is None else details)
+
+    def post_sales_rollup(self, order, sign, details):
+        when = order.date or get_vn_time()
+        hourly = self.hourly_totals.setdefault((when.replace(minute=0, second=0, microsecond=0), order.type), [0, 0, 0, 0])
+        hourly[0] += sign * (order.total_amount or 0)
+        hourly[1] += sign * (order.total_cost or 0)
+        hourly[3] += sign
+        seen = set()
+        for d in details:
+            if not d.product_id:
+                continue
+            hourly[2] += sign * d.quantity
+            product = self.product_totals.setdefault((when.date(), order.type, d.product_id), [0, 0, 0, 0])
+            product[0] += sign * d.quantity * d.price
+            product[1] += sign * d.quantity * (d.unit_cost or 0)
+            product[2] += sign * d.quantity
+            if d.product_id not in seen:
+                seen.add(d.product_id)
+                product[3] += sign
+
+    def post_voucher_totals(self, v, reverse=False):
+        """Vouchers without a partner are income / expenses rather than debt settlements."""
+        if not v.partner_id:
+            metric = 'other_income' if v.type == 'Receipt' else f"expense:{v.type}"
+            self.add_period(v, metric, -(v.amount or 0) if reverse else (v.amount or 0))
+
+    def post_order_debt(self, order, reverse=False):
+        """Debt side of an order: partner balance plus its ledger entry (Debt orders only)."""
+        sign = -1 if reverse else 1
+        self.adjust_partner(order.partner_id, sign * order_debt_delta(order.type, order.payment_method, order.total_amount or 0))
+        if reverse:
+            if order.id:
+                self.ledger_removes.append(('order', order.id))
+        elif order.partner_id and order.payment_method == 'Debt':
+            self.ledger_adds.append(order)
+
+    def release_lots(self, order):
+        """Undo the order's lot allocations: consumed stock goes back, received stock comes out."""
+        if not order.id:
+            return
+        allocations = LotAllocation.query.filter_by(order_id=order.id).all()
+        for a in allocations:
+            lot = a.lot
+            change = self.lot_changes.setdefault(lot.id, [lot.product_id, lot.expiry_date, lot.quantity, None])
+            lot.quantity = (lot.quantity or 0) - a.quantity
+            if lot.quantity < 0:
+                # Part of a received lot was sold already: take the rest from the other lots
+                shortfall, lot.quantity = -lot.quantity, 0
+                change[3] = 0
+                consume_lots(a.product_id, shortfall, changes=self.lot_changes)
+            else:
+                change[3] = lot.quantity
+            db.session.delete(a)
+
+    def add_voucher(self, sync_order=True, **fields):
+        v = CashVoucher(**fields)
+        db.session.add(v)
+        self.adjust_partner(v.partner_id, voucher_debt_delta(v.type, v.amount))
+        self.adjust_cash(v, voucher_cash_delta(v.type, v.amount))
+        self.post_voucher_totals(v)
+        if v.partner_id:
+            self.ledger_adds.append(v)
+        if v.order_id and sync_order:
+            self.orders_to_sync.add(v.order_id)
+        return v
+
+    def remove_voucher(self, v, sync_order=True):
+        self.adjust_partner(v.partner_id, -voucher_debt_delta(v.type, v.amount))
+        self.adjust_cash(v, -voucher_cash_delta(v.type, v.amount), reversal=True)
+        self.post_voucher_totals(v, reverse=True)
+        if v.id:
+            self.ledger_removes.append(('voucher', v.id))
+        if v.order_id and sync_order:
+            self.orders_to_sync.add(v.order_id)
+        db.session.delete(v)
+
+    def add_bank_transaction(self, **fields):
+        bt = BankTransaction(**fields)
+        db.session.add(bt)
+        self.adjust_bank(bt.account_id, bank_balance_delta(bt.type, bt.amount))
+        self.shift_flow(bt.shift_id, 'bank', bank_balance_delta(bt.type, bt.amount))
+        self.bank_adds.append(bt)
+        return bt
+
+    def remove_bank_transaction(self, bt):
+        self.adjust_bank(bt.account_id, -bank_balance_delta(bt.type, bt.amount))
+        self.shift_flow(bt.shift_id, 'bank', -bank_balance_delta(bt.type, bt.amount), reversal=True)
+        if bt.id:
+            self.bank_removes.append((bt.account_id, bt.date, bt.id, bank_balance_delta(bt.type, bt.amount)))
+        db.session.delete(bt)
+
+    @staticmethod
+    def _apply(model, column, deltas):
+        rows = [{'b_id': key, 'b_delta': delta} for key, delta in deltas.items() if delta]
+        if not rows:
+            return
+        table = model.__table__
+        db.session.execute(
+            table.update()
+                 .where(table.c.id == bindparam('b_id'))
+                 .values({column: db.func.coalesce(table.c[column], 0) + bindparam('b_delta')}),
+            rows
+        )
+
+    def _write_lots(self):
+        """
+        Receive and consume the collected lot moves of all products at once: one SELECT of their
+        lots, then one INSERT of new lots, one executemany UPDATE of the changed ones and one
+        INSERT of the order allocations, however many products the posting moved. Receipts go
+        first so a sale in the same posting can draw on them; sales drain lots first-expiry-first-out
+        (lots without expiry last), like consume_lots().
+        """
+        if not self.lot_moves:
+            return
+        moves = sorted(self.lot_moves, key=lambda m: m[1] < 0)
+        self.lot_moves = []
+        product_ids = list({m[0] for m in moves})
+        receiving = {m[0] for m in moves if m[1] > 0}
+        products = self._held(Product, receiving)
+
+        lots = {pid: [] for pid in product_ids} # lots as dicts; 'id' is None for lots created here
+        for i in range(0, len(product_ids), UPSERT_BATCH):
+            chunk = product_ids[i:i + UPSERT_BATCH]
+            query = db.session.query(ProductLot.id, ProductLot.product_id, ProductLot.lot_code, ProductLot.expiry_date, ProductLot.quantity)\
+                .filter(ProductLot.product_id.in_(chunk), db.or_(ProductLot.quantity > 0, ProductLot.product_id.in_(receiving & set(chunk))))
+            for lot_id, pid, code, expiry, quantity in query.order_by(ProductLot.id):
+                lots[pid].append({'id': lot_id, 'code': code, 'expiry': expiry, 'quantity': quantity or 0, 'before': quantity or 0})
+
+        allocations = [] # (order_id, lot dict, product_id, quantity)
+        for product_id, quantity, order, lot_key in moves:
+            order_id = order.id if order is not None else None
+            if quantity > 0:
+                code, expiry = lot_key or (None, None)
+                code = code or None
+                expiry = parse_expiry(expiry) or parse_expiry(products[product_id].expiry_date)
+                lot = next((l for l in lots[product_id] if l['code'] == code and l['expiry'] == expiry), None)
+                if lot is None:
+                    lot = {'id': None, 'code': code, 'expiry': expiry, 'quantity': 0, 'before': 0}
+                    lots[product_id].append(lot)
+                lot['quantity'] += quantity
+                if order_id:
+                    allocations.append((order_id, lot, product_id, quantity))
+                continue
+            remaining = -quantity
+            for lot in sorted((l for l in lots[product_id] if l['quantity'] > 0),
+                              key=lambda l: (l['expiry'] is None, l['expiry'] or date.min, l['id'] or math.inf)):
+                take = min(lot['quantity'], remaining)
+                lot['quantity'] -= take
+                remaining -= take
+                if order_id:
+                    allocations.append((order_id, lot, product_id, -take))
+                if remaining <= 1e-9:
+                    break
+
+        now = get_vn_time()
+        created = [(pid, lot, ProductLot(product_id=pid, lot_code=lot['code'], expiry_date=lot['expiry'],
+                                         quantity=lot['quantity'], received_date=now))
+                   for pid, product_lots in lots.items() for lot in product_lots if lot['id'] is None]
+        if created:
+            db.session.add_all([row for _, _, row in created])
+            db.session.flush()
+            for _, lot, row in created:
+                lot['id'] = row.id
+        changed = [(pid, lot) for pid, product_lots in lots.items() for lot in product_lots if lot['quantity'] != lot['before']]
+        fresh = {id(lot) for _, lot, _ in created} # inserted with their final quantity already
+        updates = [{'b_id': lot['id'], 'b_quantity': lot['quantity']} for _, lot in changed if id(lot) not in fresh]
+        if updates:
+            table = ProductLot.__table__
+            db.session.execute(table.update().where(table.c.id == bindparam('b_id')).values(quantity=bindparam('b_quantity')), updates)
+            for u in updates: # lots the session holds (e.g. from release_lots) must not keep the old quantity
+                held = db.session.identity_map.get(db.session.identity_key(ProductLot, u['b_id']))
+                if held is not None:
+                    db.session.expire(held, ['quantity'])
+        for pid, lot in changed:
+            self.lot_changes.setdefault(lot['id'], [pid, lot['expiry'], lot['before'], None])[3] = lot['quantity']
+        if allocations:
+            db.session.bulk_insert_mappings(LotAllocation, [
+                {'order_id': order_id, 'lot_id': lot['id'], 'product_id': pid, 'quantity': quantity}
+                for order_id, lot, pid, quantity in allocations])
+
+    @staticmethod
+    def _held(model, ids):
+        """{id: row} from the session's identity map, loading only the rows it does not hold yet."""
+        rows, missing = {}, []
+        for row_id in ids:
+            row = db.session.identity_map.get(db.session.identity_key(model, row_id))
+            if row is None or inspect(row).expired_attributes:
+                missing.append(row_id)
+            else:
+                rows[row_id] = row
+        if missing:
+            rows.update({row.id: row for row in model.query.filter(model.id.in_(missing))})
+        return rows
+
+    def _kpi_deltas(self, stock_deltas):
+        """
+        Dashboard counter changes worked out from the rows this posting holds, before the deltas
+        are applied: partner balances and product stock before / after, and the quantities of
+        the lots it changed. Only lots that are expired or near expiry and cross zero can move
+        the expiry counts; that rare case reads the product's other stocked lots.
+        """
+        deltas = {}
+        def add(key, value):
+            if value:
+                deltas[key] = deltas.get(key, 0) + value
+        partners = self._held(Partner, [pid for pid, delta in self.partner_deltas.items() if delta])
+        for pid, partner in partners.items():
+            old = partner.debt_balance
+            new = (old or 0) + self.partner_deltas[pid]
+            for balance, sign in ((old, -1), (new, 1)):
+                if balance is not None and partner.is_customer and balance > 0:
+                    add('receivable', sign * balance)
+                if balance is not None and partner.is_supplier and balance < 0:
+                    add('payable', -sign * balance)
+        for pid, product in self._held(Product, list(stock_deltas)).items():
+            low = lambda stock: stock is not None and product.multiplier is not None and stock < 2 * product.multiplier
+            add('low_stock', low((product.stock or 0) + stock_deltas[pid]) - low(product.stock))
+
+        today = get_vn_time().date()
+        def status(expiry):
+            if expiry is None or expiry > today + timedelta(days=EXPIRY_WARNING_DAYS):
+                return None
+            return 'expired' if expiry < today else 'near_expiry'
+        stocked = {} # {(product_id, status): [stocked before, stocked after]} over the changed lots
+        for product_id, expiry, before, after in self.lot_changes.values():
+            key = status(expiry)
+            if key:
+                flags = stocked.setdefault((product_id, key), [False, False])
+                flags[0] = flags[0] or (before or 0) > 0
+                flags[1] = flags[1] or (after or 0) > 0
+        moved = {key: flags for key, flags in stocked.items() if flags[0] != flags[1]}
+        if moved:
+            # A product keeps its status while any of its other lots in that status is stocked
+            others = db.session.query(ProductLot.product_id, ProductLot.expiry_date).filter(
+                ProductLot.product_id.in_({pid for pid, _ in moved}),
+                ProductLot.id.notin_(list(self.lot_changes)),
+                ProductLot.quantity > 0, ProductLot.expiry_date != None,
+                ProductLot.expiry_date <= today + timedelta(days=EXPIRY_WARNING_DAYS))
+            held = {(pid, status(expiry)) for pid, expiry in others}
+            for (pid, key), (was, now) in moved.items():
+                if (pid, key) not in held:
+                    add(key, int(now) - int(was))
+        self.lot_changes = {}
+        return deltas
+
+    def _apply_shifts(self):
+        """
+        Add the shift totals. A closed shift's Z report is final: changes to its documents
+        (edits, deletes) are booked on the open shift instead, or on no shift when there is none.
+        """
+        if not self.shift_deltas:
+            return
+        closed = {row.id for row in db.session.query(Shift.id).filter(
+            Shift.id.in_({shift_id for shift_id, _ in self.shift_deltas}), Shift.closed_at != None)}
+        current = current_shift_id({}) if closed else None
+        columns = {}
+        for (shift_id, column), delta in self.shift_deltas.items():
+            shift_id = current if shift_id in closed else shift_id
+            if shift_id:
+                bucket = columns.setdefault(column, {})
+                bucket[shift_id] = bucket.get(shift_id, 0) + delta
+        for column, deltas in columns.items():
+            self._apply(Shift, column, deltas)
+        self.shift_deltas = {}
+
+    def _apply_locations(self):
+        deltas = {key: delta for key, delta in self.location_deltas.items() if delta and key[1]}
+        if not deltas:
+            return
+        product_ids = {pid for pid, _ in deltas}
+        location_ids = {lid for _, lid in deltas}
+        existing = set(db.session.query(LocationStock.product_id, LocationStock.location_id)
+                       .filter(LocationStock.product_id.in_(product_ids), LocationStock.location_id.in_(location_ids)).all())
+        missing = [{'product_id': pid, 'location_id': lid, 'quantity': 0} for pid, lid in deltas if (pid, lid) not in existing]
+        if missing:
+            db.session.bulk_insert_mappings(LocationStock, missing)
+        table = LocationStock.__table__
+        db.session.execute(
+            table.update()
+                 .where(table.c.product_id == bindparam('b_pid'), table.c.location_id == bindparam('b_lid'))
+                 .values(quantity=db.func.coalesce(table.c.quantity, 0) + bindparam('b_delta')),
+            [{'b_pid': pid, 'b_lid': lid, 'b_delta': delta} for (pid, lid), delta in deltas.items()]
+        )
+
+    @staticmethod
+    def _shift_bank(account_id, date, tx_id, delta):
+        """Transactions after (date, tx_id) carry the change in their balance_after."""
+        if not delta:
+            return
+        table = BankTransaction.__table__
+        db.session.execute(table.update().where(
+            table.c.account_id == account_id,
+            db.or_(table.c.date > date, db.and_(table.c.date == date, table.c.id > tx_id))
+        ).values(balance_after=table.c.balance_after + delta))
+
+    def _write_bank_balances(self):
+        for account_id, date, tx_id, delta in self.bank_removes:
+            self._shift_bank(account_id, date, tx_id, -delta)
+            if delta:
+                self.period_moves.append((date, None, 'bank_in' if delta > 0 else 'bank_out', -abs(delta)))
+        for bt in self.bank_adds:
+            prev = db.session.query(BankTransaction.balance_after)\
+                .filter(BankTransaction.account_id == bt.account_id, BankTransaction.id != bt.id,
+                        db.or_(BankTransaction.date < bt.date, db.and_(BankTransaction.date == bt.date, BankTransaction.id < bt.id)))\
+                .order_by(BankTransaction.date.desc(), BankTransaction.id.desc()).limit(1).scalar()
+            if prev is None:
+                prev = db.session.query(BankAccount.opening_balance).filter(BankAccount.id == bt.account_id).scalar() or 0
+            delta = bank_balance_delta(bt.type, bt.amount)
+            bt.balance_after = prev + delta
+            self._shift_bank(bt.account_id, bt.date, bt.id, delta)
+            if delta:
+                self.period_moves.append((bt.date, None, 'bank_in' if delta > 0 else 'bank_out', abs(delta)))
+        self.bank_adds, self.bank_removes = [], []
+
+    def _apply_cash_days(self):
+        days = {}
+        for when, doc, delta, reversal in self.cash_moves:
+            when = when or doc.date or get_vn_time()
+            day = days.setdefault(when.date(), [0, 0])
+            # A reversal takes back from the side it was booked on
+            if (delta > 0) != reversal:
+                day[0] += delta
+                self.period_moves.append((when, None, 'cash_in', delta))
+            else:
+                day[1] -= delta
+                self.period_moves.append((when, None, 'cash_out', -delta))
+        self.cash_moves = []
+        if not days:
+            return
+        existing = {r.day for r in db.session.query(CashDailyBalance.day).filter(CashDailyBalance.day.in_(list(days)))}
+        for day in sorted(d for d in days if d not in existing):
+            # A new checkpoint starts from the closing of the day before it
+            prev = db.session.query(CashDailyBalance.closing).filter(CashDailyBalance.day < day)\
+                .order_by(CashDailyBalance.day.desc()).limit(1).scalar()
+            db.session.add(CashDailyBalance(day=day, inflow=0, outflow=0, closing=prev or 0))
+        db.session.flush()
+        table = CashDailyBalance.__table__
+        for day, (inflow, outflow) in days.items():
+            db.session.execute(table.update().where(table.c.day == day)
+                               .values(inflow=table.c.inflow + inflow, outflow=table.c.outflow + outflow))
+            if inflow - outflow:
+                db.session.execute(table.update().where(table.c.day >= day)
+                                   .values(closing=table.c.closing + inflow - outflow))
+
+    @staticmethod
+    def _add_totals(model, keys, values, totals):
+        """
+        Add {key tuple: value list} onto the model's rows keyed by the `keys` columns, creating
+        missing rows. One INSERT ... ON CONFLICT DO UPDATE on the keys' unique constraint per
+        UPSERT_BATCH rows; other dialects look the keys up first.
+        """
+        totals = {key: amounts for key, amounts in totals.items() if any(amounts)}
+        if not totals:
+            return
+        table = model.__table__
+        dialect = {'postgresql': postgresql, 'sqlite': sqlite}.get(db.engine.dialect.name)
+        if dialect:
+            rows = [dict(zip(keys, key), **dict(zip(values, amounts))) for key, amounts in totals.items()]
+            for i in range(0, len(rows), UPSERT_BATCH):
+                stmt = dialect.insert(table).values(rows[i:i + UPSERT_BATCH])
+                db.session.execute(stmt.on_conflict_do_update(
+                    index_elements=list(keys),
+                    set_={v: db.func.coalesce(table.c[v], 0) + stmt.excluded[v] for v in values}))
+            return
+        existing = set(db.session.query(*[table.c[k] for k in keys])
+                       .filter(table.c[keys[0]].in_({key[0] for key in totals})).all())
+        missing = [dict(zip(keys, key), **{v: 0 for v in values}) for key in totals if key not in existing]
+        if missing:
+            db.session.bulk_insert_mappings(model, missing)
+        db.session.execute(
+            table.update()
+                 .where(*[table.c[k] == bindparam(f'k_{k}') for k in keys])
+                 .values({v: db.func.coalesce(table.c[v], 0) + bindparam(f'v_{v}') for v in values}),
+            [dict(zip([f'k_{k}' for k in keys], key), **dict(zip([f'v_{v}' for v in values], amounts)))
+             for key, amounts in totals.items()]
+        )
+
+    def _apply_period_totals(self):
+        totals = {}
+        for when, doc, metric, amount in self.period_moves:
+            key = ((when or doc.date or get_vn_time()).strftime('%Y-%m'), metric)
+            totals[key] = [totals.get(key, [0])[0] + amount]
+        self.period_moves = []
+        self._add_totals(FinancePeriodTotal, ('period', 'metric'), ('amount',), totals)
+
+    def _apply_sales_rollups(self):
+        values = ('revenue', 'cost', 'quantity', 'order_count')
+        self._add_totals(SalesHourly, ('hour', 'type'), values, self.hourly_totals)
+        self._add_totals(ProductSalesDaily, ('day', 'type', 'product_id'), values, self.product_totals)
+        self.hourly_totals, self.product_totals = {}, {}
+
+    @staticmethod
+    def _shift_ledger(partner_id, date, entry_id, delta):
+        """Entries after (date, entry_id) carry the change in their running balance."""
+        if not delta:
+            return
+        table = PartnerLedgerEntry.__table__
+        db.session.execute(table.update().where(
+            table.c.partner_id == partner_id,
+            db.or_(table.c.date > date, db.and_(table.c.date == date, table.c.id > entry_id))
+        ).values(balance_after=table.c.balance_after + delta))
+
+    def _write_ledger(self):
+        # Earliest ledger position touched per partner; debt cycles are redone from there
+        touched = {}
+        def touch(entry):
+            pos = (entry.date, entry.id)
+            if entry.partner_id not in touched or pos < touched[entry.partner_id]:
+                touched[entry.partner_id] = pos
+        order_ids = [key for kind, key in self.ledger_removes if kind == 'order']
+        voucher_ids = [key for kind, key in self.ledger_removes if kind == 'voucher']
+        if order_ids or voucher_ids:
+            for e in PartnerLedgerEntry.query.filter(db.or_(PartnerLedgerEntry.order_id.in_(order_ids),
+                                                            PartnerLedgerEntry.voucher_id.in_(voucher_ids))).all():
+                self._shift_ledger(e.partner_id, e.date, e.id, -e.amount)
+                touch(e)
+                db.session.delete(e)
+            db.session.flush()
+        for doc in self.ledger_adds:
+            fields = voucher_ledger_fields(doc) if isinstance(doc, CashVoucher) else order_ledger_fields(doc)
+            if not fields['partner_id'] or not fields['amount']:
+                continue
+            # Balance of the latest entry at or before this date; new rows sort after same-date rows
+            prev = db.session.query(PartnerLedgerEntry.balance_after)\
+                .filter(PartnerLedgerEntry.partner_id == fields['partner_id'], PartnerLedgerEntry.date <= fields['date'])\
+                .order_by(PartnerLedgerEntry.date.desc(), PartnerLedgerEntry.id.desc()).limit(1).scalar()
+            entry = PartnerLedgerEntry(balance_after=(prev or 0) + fields['amount'], **fields)
+            db.session.add(entry)
+            db.session.flush()
+            self._shift_ledger(entry.partner_id, entry.date, entry.id, entry.amount)
+            touch(entry)
+        if touched:
+            for partner_id, (date, entry_id) in touched.items():
+                recompute_debt_cycles(partner_id, date, entry_id)
+        self.ledger_adds, self.ledger_removes = [], []
+
+    def _write_movements(self):
+        if not self.movements:
+            return
+        now = get_vn_time()
+        partner_ids = {m['partner_id'] for m in self.movements if m['partner_id']}
+        names = dict(db.session.query(Partner.id, Partner.name).filter(Partner.id.in_(partner_ids)).all()) if partner_ids else {}
+        rows = []
+        for m in self.movements:
+            order = m.pop('order')
+            partner_id = m.pop('partner_id')
+            partner_name = names.get(partner_id)
+            if order is not None and not partner_name:
+                partner_name = 'Khách Lẻ' if m['kind'] == 'Sale' else 'NCC Vãng Lai'
+            m.update(date=now, order_id=order.id if order is not None else None, partner_name=partner_name)
+            rows.append(m)
+        # Close the previous month before its first movement of a new one (one indexed MAX otherwise)
+        ensure_stock_checkpoints(now.date())
+        db.session.bulk_insert_mappings(StockMovement, rows)
+        self.movements = []
+
+    def flush(self):
+        """Write everything collected so far without committing."""
+        db.session.flush()
+        self._write_lots()
+        self._write_movements()
+        self._write_ledger()
+        self._apply_cash_days()
+        self._write_bank_balances()
+        self._apply_period_totals()
+        self._apply_sales_rollups()
+        for order_id in self.orders_to_sync:
+            sync_order_amount_paid(order_id)
+        self.orders_to_sync.clear()
+        stock_deltas = {pid: int(round(q)) for pid, q in self.stock_deltas.items() if int(round(q))}
+        kpi_deltas = self._kpi_deltas(stock_deltas)
+        self._apply(Partner, 'debt_balance', self.partner_deltas)
+        self._apply(BankAccount, 'balance', self.bank_deltas)
+        self._apply(Product, 'stock', stock_deltas)
+        self._apply_locations()
+        bump_kpis(kpi_deltas)
+        mark_reconcile_dirty('partner', self.partner_deltas)
+        mark_reconcile_dirty('bank', self.bank_deltas)
+        mark_reconcile_dirty('product', self.stock_deltas)
+        self._apply_shifts()
+        self.partner_deltas, self.bank_deltas, self.stock_deltas, self.location_deltas = {}, {}, {}, {}
+
+    def commit(self):
+        self.flush()
+        db.session.commit()
+
+def snapshot_detail(detail, product, order_type):
+    """Capture name, unit and unit cost on the line so reports never re-join Product."""
+    detail.product_name = detail.product_name_override or product.name
+    detail.product_unit = product.unit
+    if order_type == 'Purchase':
+        detail.unit_cost = detail.price
+    elif product.is_combo:
+        detail.unit_cost = sum((ci.product.avg_cost or 0) * ci.quantity for ci in product.combo_items if ci.product)
+    else:
+        detail.unit_cost = product.avg_cost or 0
+    return detail.quantity * detail.unit_cost
+
+def post_order_transfer(posting, order, data, total, note):
+    """Bank side of a 'Transfer' order: one BankTransaction for the amount paid (or the full total)."""
+    if data.get('payment_method') != 'Transfer' or not data.get('bank_account_id'):
+        return
+    acc_id = int(data['bank_account_id'])
+    if not db.session.get(BankAccount, acc_id):
+        return
+
+    upfront = float(data.get('amount_paid', 0))
+    # For Transfer, if amount_paid is 0, we assume the whole total is transferred
+    if upfront == 0:
+        upfront = total
+
+    t_type = 'Deposit' if data['type'] == 'Sale' else 'Withdrawal'
+    # Returns (negative totals) flow the other way
+    if data['type'] == 'Sale' and total < 0:
+        t_type = 'Withdrawal'
+    elif data['type'] == 'Purchase' and total < 0:
+        t_type = 'Deposit'
+
+    posting.add_bank_transaction(
+        account_id=acc_id,
+        amount=abs(upfront),
+        type=t_type,
+        note=note,
+        partner_id=data.get('partner_id'),
+        order_id=order.id,
+        shift_id=order.shift_id
+    )
+    order.amount_paid = upfront
+
 # --- Sales / Purchases (Order) ---
 @app.route('/api/orders', methods=['GET'])
 def get_orders():
@@ -1539,15 +3685,13 @@ def get_orders():
         else:
             query = query.filter(Order.partner_id == partner_id)
         
-        if debt_cycle:
-            # Simple fallback for debt_cycle if dates not provided
-            first_debt_order = Order.query.filter(
-                Order.partner_id == (None if partner_id == 0 else partner_id),
-                Order.payment_method == 'Debt',
-                Order.display_id.notin_(['NODAU', '#NODAU'])
-            ).order_by(Order.date.asc()).first()
-            if first_debt_order:
-                query = query.filter(Order.date >= first_debt_order.date)
+        if debt_cycle and partner_id:
+            # Orders of the current (latest) debt cycle
+            cycle_start = db.session.query(PartnerDebtCycle.start_date)\
+                .filter(PartnerDebtCycle.partner_id == partner_id)\
+                .order_by(PartnerDebtCycle.start_date.desc(), PartnerDebtCycle.start_entry_id.desc()).limit(1).scalar()
+            if cycle_start:
+                query = query.filter(Order.date >= cycle_start)
 
     if order_type:
         query = query.filter(Order.type == order_type)
@@ -1555,6 +3699,13 @@ def get_orders():
     if payment_method:
         query = query.filter(Order.payment_method == payment_method)
     
+    location_id = request.args.get('location_id', type=int)
+    if location_id:
+        if location_id == default_location_id():
+            query = query.filter(db.or_(Order.location_id == location_id, Order.location_id == None))
+        else:
+            query = query.filter(Order.location_id == location_id)
+    
     if product_id:
         query = query.join(OrderDetail).filter(OrderDetail.product_id == product_id).distinct()
     
@@ -1612,7 +3763,7 @@ def get_orders():
         query = query.order_by(sort_col.asc())
 
     if not partner_id and (not search_id or 'NODAU' not in search_id.upper()):
-        query = query.filter(Order.display_id.notin_(['NODAU', '#NODAU']))
+        query = query.filter(Order.is_opening_balance == False)
 
     if page and limit:
         # Flask-SQLAlchemy pagination
@@ -1629,7 +3780,7 @@ def get_orders():
 
 @app.route('/api/orders/<int:order_id>/status', methods=['PATCH'])
 def update_order_status(order_id):
-    order = Order.query.get_or_404(order_id)
+    order = db.get_or_404(Order, order_id)
     data = request.json
     if 'status' in data:
         order.status = data['status']
@@ -1659,142 +3810,85 @@ def create_order():
             display_id=display_id,
             total_amount=0, # will calc
             note=data.get('note'),
-            amount_paid=data.get('amount_paid', 0)
+            amount_paid=data.get('amount_paid', 0),
+            location_id=data.get('location_id') or None,
+            shift_id=current_shift_id(data)
         )
         
+        posting = Posting()
         total = 0
+        total_cost = 0
         for item in data['details']:
-            prod = Product.query.get(item['product_id'])
+            prod = db.session.get(Product, item['product_id'])
             if not prod:
                 raise Exception(f"Product {item['product_id']} not found")
             
-            # Inventory Management
-            if data['type'] == 'Sale':
-                if prod.is_combo:
-                    for ci in prod.combo_items:
-                        child = Product.query.get(ci.product_id)
-                        if child:
-                            child.stock = int(child.stock - (item['quantity'] * ci.quantity))
-                else:
-                    prod.stock = int(prod.stock - item['quantity'])
-            elif data['type'] == 'Purchase':
-                # Combos are usually not purchased directly, but if they are, we increase child stock
-                if prod.is_combo:
-                    for ci in prod.combo_items:
-                        child = Product.query.get(ci.product_id)
-                        if child:
-                            child.stock = int(child.stock + (item['quantity'] * ci.quantity))
-                else:
-                    prod.stock = int(prod.stock + item['quantity'])
-                # Update cost_price to the latest purchase price
-                prod.cost_price = item['price']
-            
             detail = OrderDetail(
                 product_id=prod.id,
                 product_name_override=item.get('product_name') or item.get('name'), # Support both keys
                 quantity=item['quantity'],
                 price=item['price']
             )
+            if data['type'] == 'Purchase':
+                detail.lot_code = item.get('lot_code') or None
+                detail.lot_expiry = parse_expiry(item.get('lot_expiry'))
+            # Snapshot cost before this line moves the average
+            total_cost += snapshot_detail(detail, prod, data['type'])
+            
+            # Inventory Management (combos move their components)
+            posting.move_stock(prod, item['quantity'], data['type'], new_order, item['price'],
+                               lot=(detail.lot_code, detail.lot_expiry))
+            if data['type'] == 'Purchase':
+                # Update cost_price to the latest purchase price
+                prod.cost_price = item['price']
+            
             new_order.details.append(detail)
             total += item['quantity'] * item['price']
         
         new_order.total_amount = total
+        new_order.total_cost = total_cost
         db.session.add(new_order)
+        posting.post_order_totals(new_order)
         db.session.flush() # ID is now available
         
         # Debt Management & Cash History connection
         if data.get('partner_id'):
-            partner = Partner.query.get(data['partner_id'])
+            partner = db.session.get(Partner, data['partner_id'])
             if partner:
-                new_order.old_debt = partner.debt_balance
-                # NEW LOGIC: Only 'Debt' orders affect balance. 
-                # Partial payments at POS do NOT reduce balance or create vouchers.
+                new_order.old_debt = posting.partner_balance(partner)
+                # Only 'Debt' orders affect balance. 
                 if data.get('payment_method') == 'Debt':
-                    if data['type'] == 'Sale':
-                        partner.debt_balance += total
-                        # If total < 0 (Return), amount_paid is what WE give back to CUSTOMER
-                        upfront = float(data.get('amount_paid', 0))
-                        if upfront > 0:
+                    posting.post_order_debt(new_order)
+                    # Upfront payment is recorded as a settlement voucher.
+                    # If total < 0 (Return), the money flows the other way.
+                    upfront = float(data.get('amount_paid', 0))
+                    if upfront > 0:
+                        if data['type'] == 'Sale':
                             if total >= 0:
-                                v_type = 'Receipt'
-                                v_note = f"Thanh toán trước cho đơn {display_id}"
-                                partner.debt_balance -= upfront
+                                v_type, v_note = 'Receipt', f"Thanh toán trước cho đơn {display_id}"
                             else:
-                                v_type = 'Payment'
-                                v_note = f"Chi trả tiền hàng cho đơn trả {display_id}"
-                                partner.debt_balance += upfront
-                            
-                            v = CashVoucher(
-                                partner_id=partner.id,
-                                amount=upfront,
-                                note=v_note,
-                                type=v_type,
-                                source='settlement',
-                                order_id=new_order.id
-                            )
-                            db.session.add(v)
-                    else:
-                        partner.debt_balance -= total
-                        # Purchase: upfront payment reduces the negative balance (we pay supplier)
-                        # If total < 0 (Return), upfront is what SUPPLIER gives back to US
-                        upfront = float(data.get('amount_paid', 0))
-                        if upfront > 0:
+                                v_type, v_note = 'Payment', f"Chi trả tiền hàng cho đơn trả {display_id}"
+                        else:
                             if total >= 0:
-                                v_type = 'Payment'
-                                v_note = f"Thanh toán trước cho đơn nhập {display_id}"
-                                partner.debt_balance += upfront
+                                v_type, v_note = 'Payment', f"Thanh toán trước cho đơn nhập {display_id}"
                             else:
-                                v_type = 'Receipt'
-                                v_note = f"Thu tiền hàng cho đơn nhập trả {display_id}"
-                                partner.debt_balance -= upfront
-
-                            v = CashVoucher(
-                                partner_id=partner.id,
-                                amount=upfront,
-                                note=v_note,
-                                type=v_type,
-                                source='settlement',
-                                order_id=new_order.id
-                            )
-                            db.session.add(v)
+                                v_type, v_note = 'Receipt', f"Thu tiền hàng cho đơn nhập trả {display_id}"
+                        
+                        posting.add_voucher(
+                            partner_id=partner.id,
+                            amount=upfront,
+                            note=v_note,
+                            type=v_type,
+                            source='settlement',
+                            order_id=new_order.id,
+                            shift_id=new_order.shift_id
+                        )
                 # Manual vouchers in Fund tab are now the ONLY way to reduce debt.
 
         # --- Bank Transaction Support ---
-        if data.get('payment_method') == 'Transfer' and data.get('bank_account_id'):
-            acc_id = int(data['bank_account_id'])
-            bank_acc = BankAccount.query.get(acc_id)
-            if bank_acc:
-                upfront = float(data.get('amount_paid', 0))
-                # For Transfer, if amount_paid is 0, we assume the whole total is transferred
-                if upfront == 0:
-                    upfront = total
-                
-                t_type = 'Deposit' if data['type'] == 'Sale' else 'Withdrawal'
-                # If Sale and total < 0 (Return), it's a Withdrawal from bank
-                if data['type'] == 'Sale' and total < 0:
-                    t_type = 'Withdrawal'
-                # If Purchase and total < 0 (Return), it's a Deposit to bank
-                elif data['type'] == 'Purchase' and total < 0:
-                    t_type = 'Deposit'
-
-                bt = BankTransaction(
-                    account_id=acc_id,
-                    amount=abs(upfront),
-                    type=t_type,
-                    note=f"Thanh toán đơn {display_id}",
-                    partner_id=data.get('partner_id'),
-                    order_id=new_order.id
-                )
-                
-                if t_type == 'Deposit':
-                    bank_acc.balance += abs(upfront)
-                else:
-                    bank_acc.balance -= abs(upfront)
-                
-                db.session.add(bt)
-                new_order.amount_paid = upfront # Update order state
+        post_order_transfer(posting, new_order, data, total, f"Thanh toán đơn {display_id}")
         
-        db.session.commit()
+        posting.commit()
         return jsonify(new_order.to_dict()), 201
 
     except Exception as e:
@@ -1803,163 +3897,70 @@ def create_order():
 
 @app.route('/api/orders/<int:id>', methods=['GET'])
 def get_order(id):
-    order = Order.query.get_or_404(id)
+    order = db.get_or_404(Order, id)
     return jsonify(order.to_dict())
 
 @app.route('/api/orders/<int:id>', methods=['DELETE'])
 def delete_order(id):
-    order = Order.query.get_or_404(id)
+    order = db.get_or_404(Order, id)
     try:
-        # 1. Reverse Inventory
-        for detail in order.details:
-            prod = Product.query.get(detail.product_id)
-            if prod:
-                if order.type == 'Sale':
-                    if prod.is_combo:
-                        for ci in prod.combo_items:
-                            child = Product.query.get(ci.product_id)
-                            if child:
-                                child.stock = int(child.stock + (detail.quantity * ci.quantity))
-                    else:
-                        prod.stock = int(prod.stock + detail.quantity)
-                elif order.type == 'Purchase':
-                    if prod.is_combo:
-                        for ci in prod.combo_items:
-                            child = Product.query.get(ci.product_id)
-                            if child:
-                                child.stock = int(child.stock - (detail.quantity * ci.quantity))
-                    else:
-                        prod.stock = int(prod.stock - detail.quantity)
-        
-        # 2. Reverse Partner Debt
-        partner = None
-        if order.partner_id:
-            partner = Partner.query.get(order.partner_id)
-            if partner:
-                if order.payment_method == 'Debt':
-                    if order.type == 'Sale':
-                        partner.debt_balance -= order.total_amount
-                    else:
-                        partner.debt_balance += order.total_amount
-        
-        # 3. Cleanup linked settlement vouchers
-        linked_vouchers = CashVoucher.query.filter_by(order_id=order.id).all()
-        for v in linked_vouchers:
-            if partner:
-                if v.type == 'Receipt':
-                    partner.debt_balance += v.amount
-                elif v.type == 'Payment':
-                    partner.debt_balance -= v.amount
-            db.session.delete(v)
-        
-        # 4. Cleanup linked bank transactions
-        linked_bank_ts = BankTransaction.query.filter_by(order_id=order.id).all()
-        for bt in linked_bank_ts:
-            bank_acc = BankAccount.query.get(bt.account_id)
-            if bank_acc:
-                if bt.type == 'Deposit':
-                    bank_acc.balance -= bt.amount
-                else:
-                    bank_acc.balance += bt.amount
-            db.session.delete(bt)
+        posting = Posting()
+        # 1. Reverse Inventory & Partner Debt
+        posting.post_order(order, reverse=True)
+        
+        # 2. Cleanup linked settlement vouchers
+        for v in CashVoucher.query.filter_by(order_id=order.id).all():
+            posting.remove_voucher(v, sync_order=False)
+        
+        # 3. Cleanup linked bank transactions
+        for bt in BankTransaction.query.filter_by(order_id=order.id).all():
+            posting.remove_bank_transaction(bt)
 
         db.session.delete(order)
-        db.session.commit()
+        posting.commit()
         return jsonify({'message': 'Order deleted and data reversed successfully'})
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 400
 
-def sync_order_amount_paid(order_id):
-    """
-    Recalculate order.amount_paid based on linked CashVouchers.
-    Only applies to Debt orders, as Cash orders do not typically have vouchers.
-    """
-    order = Order.query.get(order_id)
-    if not order: return
-
-    # If it's a Debt order, the amount_paid should be the sum of all settlement vouchers
-    if order.payment_method == 'Debt':
-        vouchers = CashVoucher.query.filter_by(order_id=order_id).all()
-        total_paid = 0
-        for v in vouchers:
-            # For Sale: Receipt (+) adds to paid amount, Payment (-) refunds it
-            if order.type == 'Sale':
-                if v.type == 'Receipt': total_paid += v.amount
-                elif v.type == 'Payment': total_paid -= v.amount
-            # For Purchase: Payment (+) adds to paid amount, Receipt (-) refunds it
-            elif order.type == 'Purchase':
-                if v.type == 'Payment': total_paid += v.amount
-                elif v.type == 'Receipt': total_paid -= v.amount
-        
-        order.amount_paid = total_paid
-        db.session.commit()
-
 @app.route('/api/orders/<int:id>', methods=['PUT'])
 def update_order(id):
-    order = Order.query.get_or_404(id)
+    order = db.get_or_404(Order, id)
     data = request.json
     try:
+        posting = Posting()
         # 1. Reverse Previous Inventory & Debt
+        posting.release_lots(order)
+        # Lines sent back without lot info keep the lot they were received into
+        old_lots = {d.product_id: (d.lot_code, d.lot_expiry) for d in order.details}
         for detail in order.details:
-            prod = Product.query.get(detail.product_id)
-            if prod:
-                if order.type == 'Sale':
-                    if prod.is_combo:
-                        for ci in prod.combo_items:
-                            child = Product.query.get(ci.product_id)
-                            if child:
-                                child.stock = int(child.stock + (detail.quantity * ci.quantity))
-                    else:
-                        prod.stock = int(prod.stock + detail.quantity)
-                elif order.type == 'Purchase':
-                    if prod.is_combo:
-                        for ci in prod.combo_items:
-                            child = Product.query.get(ci.product_id)
-                            if child:
-                                child.stock = int(child.stock - (detail.quantity * ci.quantity))
-                    else:
-                        prod.stock = int(prod.stock - detail.quantity)
+            if detail.product:
+                posting.move_stock(detail.product, -detail.quantity, order.type, order, detail.price, reversal=True)
+        posting.post_order_totals(order, reverse=True)
         
         old_debt = 0
         old_partner = None
         if order.partner_id:
-            old_partner = Partner.query.get(order.partner_id)
+            old_partner = db.session.get(Partner, order.partner_id)
             if old_partner:
-                if order.payment_method == 'Debt':
-                    if order.type == 'Sale':
-                        old_partner.debt_balance -= order.total_amount
-                    else:
-                        old_partner.debt_balance += order.total_amount
-                old_debt = old_partner.debt_balance
+                posting.post_order_debt(order, reverse=True)
+                old_debt = posting.partner_balance(old_partner)
         
         # IMPORTANT: If the payment method is changing AWAY from Debt, 
         # we MUST delete associated settlement vouchers because they no longer apply.
         if order.payment_method == 'Debt' and data.get('payment_method') != 'Debt':
-            linked_vouchers = CashVoucher.query.filter_by(order_id=order.id).all()
-            for v in linked_vouchers:
-                if old_partner:
-                    if v.type == 'Receipt':
-                        old_partner.debt_balance += v.amount
-                    else:
-                        old_partner.debt_balance -= v.amount
-                db.session.delete(v)
+            for v in CashVoucher.query.filter_by(order_id=order.id).all():
+                posting.remove_voucher(v)
         # Reverse Bank Transactions
-        old_bank_ts = BankTransaction.query.filter_by(order_id=order.id).all()
-        for bt in old_bank_ts:
-            bank_acc = BankAccount.query.get(bt.account_id)
-            if bank_acc:
-                if bt.type == 'Deposit':
-                    bank_acc.balance -= bt.amount
-                else:
-                    bank_acc.balance += bt.amount
-            db.session.delete(bt)
+        for bt in BankTransaction.query.filter_by(order_id=order.id).all():
+            posting.remove_bank_transaction(bt)
             
         # 2. Update Order with New Data
         # Clear existing details
         OrderDetail.query.filter_by(order_id=order.id).delete()
         
         order.partner_id = data.get('partner_id')
+        order.location_id = data.get('location_id', order.location_id) or None
         order.payment_method = data['payment_method']
         order.note = data.get('note')
         order.amount_paid = data.get('amount_paid', 0)
@@ -1974,30 +3975,13 @@ def update_order(id):
             order.date = local_now
         
         total = 0
+        total_cost = 0
+        details = []
         for item in data['details']:
-            prod = Product.query.get(item['product_id'])
+            prod = db.session.get(Product, item['product_id'])
             if not prod:
                 raise Exception(f"Product {item['product_id']} not found")
             
-            # Apply New Inventory
-            if data['type'] == 'Sale':
-                if prod.is_combo:
-                    for ci in prod.combo_items:
-                        child = Product.query.get(ci.product_id)
-                        if child:
-                            child.stock = int(child.stock - (item['quantity'] * ci.quantity))
-                else:
-                    prod.stock = int(prod.stock - item['quantity'])
-            elif data['type'] == 'Purchase':
-                if prod.is_combo:
-                    for ci in prod.combo_items:
-                        child = Product.query.get(ci.product_id)
-                        if child:
-                            child.stock = int(child.stock + (item['quantity'] * ci.quantity))
-                else:
-                    prod.stock = int(prod.stock + item['quantity'])
-                prod.cost_price = item['price']
-            
             detail = OrderDetail(
                 order_id=order.id,
                 product_id=prod.id,
@@ -2005,52 +3989,39 @@ def update_order(id):
                 quantity=item['quantity'],
                 price=item['price']
             )
+            if data['type'] == 'Purchase':
+                old_code, old_expiry = old_lots.get(prod.id, (None, None))
+                detail.lot_code = item.get('lot_code', old_code) or None
+                detail.lot_expiry = parse_expiry(item.get('lot_expiry')) or old_expiry
+            total_cost += snapshot_detail(detail, prod, data['type'])
+            
+            # Apply New Inventory
+            posting.move_stock(prod, item['quantity'], data['type'], order, item['price'],
+                               lot=(detail.lot_code, detail.lot_expiry))
+            if data['type'] == 'Purchase':
+                prod.cost_price = item['price']
+            
             db.session.add(detail)
+            details.append(detail)
             total += item['quantity'] * item['price']
         
         order.total_amount = total
+        order.total_cost = total_cost
+        posting.post_order_totals(order, details=details)
         
         # 3. Apply New Debt
         if order.partner_id:
-            partner = Partner.query.get(order.partner_id)
+            partner = db.session.get(Partner, order.partner_id)
             if partner:
-                order.old_debt = partner.debt_balance
-                if order.payment_method == 'Debt':
-                    if order.type == 'Sale':
-                        partner.debt_balance += total
-                    else:
-                        partner.debt_balance -= total
+                order.old_debt = posting.partner_balance(partner)
+                posting.post_order_debt(order)
 
         # Handle New Bank Transaction
-        if data.get('payment_method') == 'Transfer' and data.get('bank_account_id'):
-            acc_id = int(data['bank_account_id'])
-            bank_acc = BankAccount.query.get(acc_id)
-            if bank_acc:
-                upfront = float(data.get('amount_paid', 0))
-                if upfront == 0:
-                    upfront = total
-                
-                t_type = 'Deposit' if data['type'] == 'Sale' else 'Withdrawal'
-                if data['type'] == 'Sale' and total < 0: t_type = 'Withdrawal'
-                elif data['type'] == 'Purchase' and total < 0: t_type = 'Deposit'
-
-                bt = BankTransaction(
-                    account_id=acc_id,
-                    amount=abs(upfront),
-                    type=t_type,
-                    note=f"Cập nhật đơn {order.display_id}",
-                    partner_id=data.get('partner_id'),
-                    order_id=order.id
-                )
-                if t_type == 'Deposit': bank_acc.balance += abs(upfront)
-                else: bank_acc.balance -= abs(upfront)
-                db.session.add(bt)
-                order.amount_paid = upfront
+        post_order_transfer(posting, order, data, total, f"Cập nhật đơn {order.display_id}")
 
-        db.session.commit()
-        
         # Enforce consistency: amount_paid must match vouchers
-        sync_order_amount_paid(order.id)
+        posting.orders_to_sync.add(order.id)
+        posting.commit()
         
         order_dict = order.to_dict()
         order_dict['old_debt'] = old_debt
@@ -2072,7 +4043,8 @@ def create_bank_account():
         bank_name=data['bank_name'],
         account_number=data['account_number'],
         account_holder=data.get('account_holder'),
-        balance=data.get('balance', 0)
+        balance=data.get('balance', 0),
+        opening_balance=data.get('balance', 0)
     )
     db.session.add(new_acc)
     db.session.commit()
@@ -2080,19 +4052,25 @@ def create_bank_account():
 
 @app.route('/api/bank-accounts/<int:id>', methods=['PUT'])
 def update_bank_account(id):
-    acc = BankAccount.query.get_or_404(id)
+    acc = db.get_or_404(BankAccount, id)
     data = request.json
     acc.bank_name = data.get('bank_name', acc.bank_name)
     acc.account_number = data.get('account_number', acc.account_number)
     acc.account_holder = data.get('account_holder', acc.account_holder)
     if 'balance' in data:
-        acc.balance = float(data['balance'])
+        # A manual balance correction is booked as a change of the opening balance
+        new_balance = float(data['balance'])
+        diff = new_balance - (acc.balance or 0)
+        acc.opening_balance = (acc.opening_balance or 0) + diff
+        acc.balance = new_balance
+        BankTransaction.query.filter(BankTransaction.account_id == acc.id)\
+            .update({BankTransaction.balance_after: BankTransaction.balance_after + diff}, synchronize_session=False)
     db.session.commit()
     return jsonify(acc.to_dict())
 
 @app.route('/api/bank-accounts/<int:id>', methods=['DELETE'])
 def delete_bank_account(id):
-    acc = BankAccount.query.get_or_404(id)
+    acc = db.get_or_404(BankAccount, id)
     db.session.delete(acc)
     db.session.commit()
     return jsonify({'message': 'Deleted successfully'})
@@ -2106,29 +4084,24 @@ def create_bank_transaction():
     note = data.get('note', '')
     partner_id = data.get('partner_id')
     
-    acc = BankAccount.query.get_or_404(account_id)
+    db.get_or_404(BankAccount, account_id)
     
-    transaction = BankTransaction(
+    posting = Posting()
+    transaction = posting.add_bank_transaction(
         account_id=account_id,
         amount=amount,
         type=t_type,
         note=note,
-        partner_id=partner_id
+        partner_id=partner_id,
+        shift_id=current_shift_id(data)
     )
-    
-    if t_type == 'Deposit':
-        acc.balance += amount
-    elif t_type == 'Withdrawal':
-        acc.balance -= amount
-    
-    db.session.add(transaction)
-    db.session.commit()
+    posting.commit()
     return jsonify(transaction.to_dict()), 201
 
 @app.route('/api/bank-transactions', methods=['GET'])
 def get_bank_transactions():
     account_id = request.args.get('account_id', type=int)
-    query = BankTransaction.query
+    query = BankTransaction.query.options(joinedload(BankTransaction.account), joinedload(BankTransaction.partner))
     if account_id:
         query = query.filter(BankTransaction.account_id == account_id)
     
@@ -2143,6 +4116,173 @@ def get_bank_transactions():
     transactions = query.order_by(BankTransaction.date.desc()).all()
     return jsonify([t.to_dict() for t in transactions])
 
+def bank_balance_as_of(account, as_of):
+    """Balance after the last transaction at or before as_of: one read of the (account, date, id) index."""
+    balance = db.session.query(BankTransaction.balance_after)\
+        .filter(BankTransaction.account_id == account.id, BankTransaction.date <= as_of)\
+        .order_by(BankTransaction.date.desc(), BankTransaction.id.desc()).limit(1).scalar()
+    return balance if balance is not None else (account.opening_balance or 0)
+
+@app.route('/api/bank-accounts/<int:id>/statement', methods=['GET'])
+def get_bank_statement(id):
+    # Newest first, keyset-paginated; cursor = "<iso date>|<id>" of the last row of the previous page.
+    # ?as_of=YYYY-MM-DD adds the closing balance of that day.
+    account = db.get_or_404(BankAccount, id)
+    limit = min(request.args.get('limit', 50, type=int), 500)
+    cursor = request.args.get('cursor')
+    try:
+        query = BankTransaction.query.options(joinedload(BankTransaction.account), joinedload(BankTransaction.partner))\
+            .filter(BankTransaction.account_id == id)
+        if cursor:
+            c_date, c_id = cursor.rsplit('|', 1)
+            c_date = datetime.fromisoformat(c_date)
+            query = query.filter(db.or_(
+                BankTransaction.date < c_date,
+                db.and_(BankTransaction.date == c_date, BankTransaction.id < int(c_id))
+            ))
+        rows = query.order_by(BankTransaction.date.desc(), BankTransaction.id.desc()).limit(limit + 1).all()
+        
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        result = {
+            'items': [t.to_dict() for t in rows],
+            'next_cursor': f"{rows[-1].date.isoformat()}|{rows[-1].id}" if has_more else None,
+            'balance': account.balance
+        }
+        as_of = request.args.get('as_of')
+        if as_of:
+            result['as_of'] = as_of
+            result['balance_as_of'] = bank_balance_as_of(account, datetime.combine(date.fromisoformat(as_of[:10]), datetime.max.time()))
+        return jsonify(result)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+# Header aliases seen in bank exports (accents and case are ignored)
+STATEMENT_COLUMNS = {
+    'date': ('ngay', 'ngay giao dich', 'ngay gd', 'ngay hieu luc', 'date', 'transaction date'),
+    'amount': ('so tien', 'amount'),
+    'credit': ('ghi co', 'so tien ghi co', 'tien vao', 'credit'),
+    'debit': ('ghi no', 'so tien ghi no', 'tien ra', 'debit'),
+    'description': ('noi dung', 'mo ta', 'dien giai', 'noi dung giao dich', 'description')
+}
+
+def parse_statement_amount(value):
+    if value is None or value == '':
+        return 0
+    if isinstance(value, (int, float)):
+        return float(value)
+    # VND has no decimals: "1.250.000", "1,250,000 đ", "-500000"
+    digits = re.sub(r'[^\d\-]', '', str(value))
+    return float(digits) if digits not in ('', '-') else 0
+
+def read_statement_lines(file):
+    """Rows of a CSV/XLSX bank statement as {'row', 'date', 'amount' (+ in / - out), 'description'}."""
+    if file.filename.lower().endswith('.csv'):
+        import csv
+        text = file.read().decode('utf-8-sig')
+        rows = list(csv.reader(io.StringIO(text), delimiter=';' if text.count(';') > text.count(',') else ','))
+    else:
+        import openpyxl
+        wb = openpyxl.load_workbook(file, read_only=True, data_only=True)
+        rows = list(wb.active.iter_rows(values_only=True))
+    if not rows:
+        return []
+    headers = [remove_accents(str(h or '')).strip() for h in rows[0]]
+    col = {key: next((headers.index(a) for a in aliases if a in headers), None) for key, aliases in STATEMENT_COLUMNS.items()}
+    if col['date'] is None or (col['amount'] is None and col['credit'] is None and col['debit'] is None):
+        raise ValueError("File cần cột 'Ngày' và 'Số tiền' (hoặc 'Ghi có' / 'Ghi nợ')")
+    cell = lambda row, key: row[col[key]] if col[key] is not None and col[key] < len(row) else None
+
+    lines = []
+    for i, row in enumerate(rows[1:], start=2):
+        raw_date = cell(row, 'date')
+        day = raw_date.date() if isinstance(raw_date, datetime) else parse_expiry(str(raw_date).split()[0] if raw_date else None)
+        if col['amount'] is not None:
+            amount = parse_statement_amount(cell(row, 'amount'))
+        else:
+            amount = parse_statement_amount(cell(row, 'credit')) - abs(parse_statement_amount(cell(row, 'debit')))
+        if not day or not amount:
+            continue
+        lines.append({'row': i, 'date': day, 'amount': amount, 'description': str(cell(row, 'description') or '').strip()})
+    return lines
+
+@app.route('/api/bank-accounts/<int:id>/statement/import', methods=['POST'])
+def import_bank_statement(id):
+    """
+    Match statement lines to the account's transactions: same direction and amount (hash key),
+    date within ?window_days (binary search over date-sorted candidates), ties broken by an
+    order code or transaction id in the line's description. create_missing=true books the
+    unmatched lines as new transactions in one commit.
+    """
+    import bisect
+    account = db.get_or_404(BankAccount, id)
+    if 'file' not in request.files:
+        return jsonify({'error': 'No file part'}), 400
+    window = timedelta(days=request.form.get('window_days', 2, type=int))
+    create_missing = request.form.get('create_missing', 'false').lower() == 'true'
+    try:
+        lines = read_statement_lines(request.files['file'])
+        if not lines:
+            return jsonify({'matched': [], 'unmatched': [], 'ambiguous': [], 'created': 0})
+
+        start = datetime.combine(min(l['date'] for l in lines) - window, datetime.min.time())
+        end = datetime.combine(max(l['date'] for l in lines) + window, datetime.max.time())
+        existing = db.session.query(BankTransaction.id, BankTransaction.date, BankTransaction.type,
+                                    BankTransaction.amount, Order.display_id)\
+            .outerjoin(Order, Order.id == BankTransaction.order_id)\
+            .filter(BankTransaction.account_id == id, BankTransaction.date.between(start, end))\
+            .order_by(BankTransaction.date, BankTransaction.id).all()
+        index = {} # (signed amount) -> date-sorted candidates
+        for t in existing:
+            signed = round(bank_balance_delta(t.type, t.amount or 0))
+            index.setdefault(signed, []).append(t)
+        day_keys = {key: [t.date.date() for t in txs] for key, txs in index.items()}
+
+        used = set()
+        matched, unmatched, ambiguous = [], [], []
+        for line in sorted(lines, key=lambda l: l['date']):
+            key = round(line['amount'])
+            txs = index.get(key, [])
+            lo = bisect.bisect_left(day_keys.get(key, []), line['date'] - window)
+            hi = bisect.bisect_right(day_keys.get(key, []), line['date'] + window)
+            candidates = [t for t in txs[lo:hi] if t.id not in used]
+            if len(candidates) > 1:
+                desc = line['description'].upper()
+                by_ref = [t for t in candidates if (t.display_id and t.display_id.upper() in desc) or f"#{t.id}" in desc]
+                if len(by_ref) == 1:
+                    candidates = by_ref
+                else:
+                    # Closest date wins only when it is unique
+                    gaps = sorted(abs((t.date.date() - line['date']).days) for t in candidates)
+                    if gaps[0] != gaps[1]:
+                        candidates = [min(candidates, key=lambda t: abs((t.date.date() - line['date']).days))]
+            out = dict(line, date=line['date'].isoformat())
+            if len(candidates) == 1:
+                used.add(candidates[0].id)
+                matched.append(dict(out, transaction_id=candidates[0].id))
+            elif candidates:
+                ambiguous.append(dict(out, candidates=[t.id for t in candidates]))
+            else:
+                unmatched.append(out)
+
+        created = 0
+        if create_missing and unmatched:
+            posting = Posting()
+            for line in unmatched:
+                posting.add_bank_transaction(
+                    account_id=account.id,
+                    amount=abs(line['amount']),
+                    type='Deposit' if line['amount'] > 0 else 'Withdrawal',
+                    date=datetime.fromisoformat(line['date']).replace(hour=12),
+                    note=line['description'] or 'Nhập từ sao kê'
+                )
+            posting.commit()
+            created = len(unmatched)
+        return jsonify({'matched': matched, 'unmatched': unmatched, 'ambiguous': ambiguous, 'created': created})
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
+
 # --- Dashboard ---
 
 @app.route('/api/dashboard-stats', methods=['GET'])
@@ -2170,86 +4310,43 @@ def dashboard_stats():
     
     # helper for range filter
     def apply_filters(q):
-        if filter_year: q = q.filter(extract('year', Order.date) == int(filter_year))
-        if filter_month: q = q.filter(extract('month', Order.date) == int(filter_month))
-        if filter_day: q = q.filter(extract('day', Order.date) == int(filter_day))
+        if filter_year: q = q.filter(extract('year', SalesHourly.hour) == int(filter_year))
+        if filter_month: q = q.filter(extract('month', SalesHourly.hour) == int(filter_month))
+        if filter_day: q = q.filter(extract('day', SalesHourly.hour) == int(filter_day))
         return q
 
-    # Revenue is simple sum from Order table (Exclude NODAU)
-    revenue = apply_filters(db.session.query(func.sum(Order.total_amount))
-                            .filter(Order.type == 'Sale', Order.display_id.notin_(['NODAU', '#NODAU']))).scalar() or 0
-    
-    # For Profit, we MUST handle combos to match reports.
-    # To keep dashboard fast, we'll join Orders with Details and Products.
-    # But wait, the combo cost logic in report_products iterates children.
-    # In SQL, we can get cost of non-combos + cost of combo components via separate sums or a smart join.
-    
-    # 1. Simple parts of sales (non-combo)
-    cost_simple = apply_filters(db.session.query(func.sum(OrderDetail.quantity * Product.cost_price))
-        .join(Order, Order.id == OrderDetail.order_id)
-        .join(Product, OrderDetail.product_id == Product.id)
-        .filter(Order.type == 'Sale', Product.is_combo == False)).scalar() or 0
-    
-    # 2. Combo parts
-    from sqlalchemy.orm import aliased
-    ComponentProduct = aliased(Product)
-    ComboProduct = aliased(Product)
-    
-    cost_combo = apply_filters(db.session.query(func.sum(OrderDetail.quantity * ComboItem.quantity * ComponentProduct.cost_price))
-        .join(Order, Order.id == OrderDetail.order_id)
-        .join(ComboProduct, OrderDetail.product_id == ComboProduct.id)
-        .join(ComboItem, ComboProduct.id == ComboItem.combo_id)
-        .join(ComponentProduct, ComboItem.product_id == ComponentProduct.id)
-        .filter(Order.type == 'Sale', ComboProduct.is_combo == True)).scalar() or 0
-
-    profit = revenue - (cost_simple + cost_combo)
+    # Revenue and cost come from the hourly sales rollup (at most 24 rows a day)
+    revenue, cost = apply_filters(db.session.query(func.sum(SalesHourly.revenue), func.sum(SalesHourly.cost))
+                                  .filter(SalesHourly.type == 'Sale')).one()
+    revenue = revenue or 0
+    profit = revenue - (cost or 0)
     
     # --- 2. Debt (Unfiltered - All Time) ---
-    all_partners = Partner.query.filter(Partner.debt_balance != 0).all()
-    # total_customer_debt: Sum of all positive balances (Receivables) for partners marked as customers
-    total_customer_debt = sum(p.debt_balance for p in all_partners if p.is_customer and p.debt_balance > 0)
-    # total_supplier_debt: Sum of all absolute negative balances (Payables) for partners marked as suppliers
-    total_supplier_debt = sum(abs(p.debt_balance) for p in all_partners if p.is_supplier and p.debt_balance < 0)
+    # Totals and warning counts are stored counters (?refresh=1 recomputes them)
+    kpis = read_kpis(refresh=request.args.get('refresh') in ('1', 'true'))
+    total_customer_debt = kpis['receivable']
+    total_supplier_debt = kpis['payable']
 
-    # Lists filtered by type AND appropriate balance sign
-    customers_with_debt = sorted([p for p in all_partners if p.is_customer and p.debt_balance > 0], key=lambda x: x.debt_balance, reverse=True)[:10]
-    suppliers_with_debt = sorted([p for p in all_partners if p.is_supplier and p.debt_balance < 0], key=lambda x: abs(x.debt_balance), reverse=True)[:10]
+    # Top 10 each way straight off the debt_balance index
+    customers_with_debt = Partner.query.filter(Partner.is_customer == True, Partner.debt_balance > 0)\
+        .order_by(Partner.debt_balance.desc()).limit(10).all()
+    suppliers_with_debt = Partner.query.filter(Partner.is_supplier == True, Partner.debt_balance < 0)\
+        .order_by(Partner.debt_balance.asc()).limit(10).all()
 
     # --- 3. 7-Day Revenue Chart ---
     today_dt = get_vn_time()
     seven_days_ago = today_dt - timedelta(days=7)
     
-    # Daily Revenue
-    daily_revs = db.session.query(
-        db.func.date(Order.date).label('day'),
-        func.sum(Order.total_amount).label('rev')
-    ).filter(Order.type == 'Sale', Order.date >= seven_days_ago, Order.display_id.notin_(['NODAU', '#NODAU']))\
-     .group_by(db.func.date(Order.date)).all()
-    
-    # Daily Cost (Simple)
-    daily_costs_simple = db.session.query(
-        db.func.date(Order.date).label('day'),
-        func.sum(OrderDetail.quantity * Product.cost_price).label('cost')
-    ).join(Order, Order.id == OrderDetail.order_id)\
-     .join(Product, OrderDetail.product_id == Product.id)\
-     .filter(Order.type == 'Sale', Order.date >= seven_days_ago, Product.is_combo == False)\
-     .group_by(db.func.date(Order.date)).all()
-     
-    # Daily Cost (Combo)
-    daily_costs_combo = db.session.query(
-        db.func.date(Order.date).label('day'),
-        func.sum(OrderDetail.quantity * ComboItem.quantity * ComponentProduct.cost_price).label('cost')
-    ).join(Order, Order.id == OrderDetail.order_id)\
-     .join(ComboProduct, OrderDetail.product_id == ComboProduct.id)\
-     .join(ComboItem, ComboProduct.id == ComboItem.combo_id)\
-     .join(ComponentProduct, ComboItem.product_id == ComponentProduct.id)\
-     .filter(Order.type == 'Sale', Order.date >= seven_days_ago, ComboProduct.is_combo == True)\
-     .group_by(db.func.date(Order.date)).all()
+    # Daily Revenue & Cost
+    daily_rows = db.session.query(
+        db.func.date(SalesHourly.hour).label('day'),
+        func.sum(SalesHourly.revenue).label('rev'),
+        func.sum(SalesHourly.cost).label('cost')
+    ).filter(SalesHourly.type == 'Sale', SalesHourly.hour >= seven_days_ago.replace(minute=0, second=0, microsecond=0))\
+     .group_by(db.func.date(SalesHourly.hour)).all()
     
-    rev_map = {str(d.day): d.rev for d in daily_revs}
-    cost_map = {str(d.day): d.cost for d in daily_costs_simple}
-    for d in daily_costs_combo:
-        cost_map[str(d.day)] = cost_map.get(str(d.day), 0) + d.cost
+    rev_map = {str(d.day): d.rev or 0 for d in daily_rows}
+    cost_map = {str(d.day): d.cost or 0 for d in daily_rows}
     
     last_7_days = [(today_dt - timedelta(days=i)).date() for i in range(6, -1, -1)] 
     chart_labels = [d.strftime('%d/%m') for d in last_7_days]
@@ -2264,37 +4361,17 @@ def dashboard_stats():
 
     # --- 4. Product Warnings (Expiry & Low Stock) ---
     today = today_dt.date()
-    near_expiry_count = 0
-    expired_count = 0
-    
-    # Optimize stock warning: use SQL for counting
-    low_stock_count = Product.query.filter(Product.stock < 2 * Product.multiplier).count()
+    # Optimize stock warning: use SQL for counting (?location_id= for one location)
+    location_id = request.args.get('location_id', type=int)
+    if location_id:
+        low_stock_count = Product.query.outerjoin(LocationStock, db.and_(LocationStock.product_id == Product.id, LocationStock.location_id == location_id))\
+            .filter(db.func.coalesce(LocationStock.quantity, 0) < 2 * Product.multiplier).count()
+    else:
+        low_stock_count = int(kpis['low_stock'])
     
-    products_with_expiry = Product.query.filter(Product.expiry_date != None).all()
-    for p in products_with_expiry:
-        # Expiry logic: Near expiry <= 90 days, Expired < 0 days
-        try:
-            # Handle multiple date formats
-            exp_date = None
-            date_str = str(p.expiry_date).strip()
-            
-            # Try parsing commonly used formats
-            for fmt in ('%d/%m/%Y', '%Y-%m-%d', '%Y-%m-%d %H:%M:%S', '%d-%m-%Y'):
-                try:
-                    exp_date = datetime.strptime(date_str, fmt).date()
-                    break
-                except ValueError:
-                    continue
-            
-            if exp_date:
-                delta = (exp_date - today).days
-                
-                if delta < 0:
-                    expired_count += 1
-                elif delta <= 60: # Changed from 90 to 60 as per user request
-                    near_expiry_count += 1
-        except (ValueError, TypeError):
-            pass # Ignore invalid dates
+    # Expiry: distinct products with stocked lots expired / expiring within 60 days
+    expired_count = int(kpis['expired'])
+    near_expiry_count = int(kpis['near_expiry'])
 
     return jsonify({
         'revenue': revenue,
@@ -2315,15 +4392,6 @@ def dashboard_stats():
         'low_stock': low_stock_count
     })
 
-def sync_order_amount_paid(order_id):
-    if not order_id: return
-    order = Order.query.get(order_id)
-    if order:
-        # Sum all vouchers for this order
-        total_paid = db.session.query(db.func.sum(CashVoucher.amount)).filter(CashVoucher.order_id == order_id).scalar() or 0
-        order.amount_paid = total_paid
-        db.session.commit()
-
 @app.route('/api/vouchers', methods=['POST'])
 def create_voucher():
     data = request.json
@@ -2332,34 +4400,75 @@ def create_voucher():
     note = data.get('note', '')
     v_type = data.get('type', 'Payment')
     
-    partner = Partner.query.get(partner_id) if partner_id else None
-    
-    voucher = CashVoucher(
+    # Receipt reduces customer debt, Payment reduces supplier debt;
+    # a linked order gets its amount_paid re-synced in the same commit.
+    posting = Posting()
+    voucher = posting.add_voucher(
         partner_id=partner_id,
         amount=amount,
         note=note,
         type=v_type,
         source=data.get('source', 'manual'),
-        order_id=data.get('order_id')
+        order_id=data.get('order_id'),
+        shift_id=current_shift_id(data)
     )
-    
-    if partner and v_type in ['Payment', 'Receipt']:
-        # Receipt: Reducing Customer Debt (balance -= amount)
-        # Payment: Reducing Supplier Debt (balance += amount towards 0)
-        if v_type == 'Receipt':
-            partner.debt_balance -= amount
-        else:
-            partner.debt_balance += amount
-        
-    db.session.add(voucher)
-    db.session.commit()
-    
-    # Sync amount_paid if linked to an order
-    if voucher.order_id:
-        sync_order_amount_paid(voucher.order_id)
+    posting.commit()
         
     return jsonify(voucher.to_dict()), 201
 
+@app.route('/api/partners/<int:id>/settle', methods=['POST'])
+def settle_partner_debt(id):
+    """
+    Spread one payment over the partner's open Debt orders: oldest first, or only ?order_ids
+    in that order. type=Receipt (default) settles sales, Payment settles purchases.
+    Each order gets its settlement voucher; anything left over stays as an unlinked voucher.
+    """
+    db.get_or_404(Partner, id)
+    data = request.json or {}
+    try:
+        amount = float(data.get('amount', 0))
+        v_type = data.get('type', 'Receipt')
+        if amount <= 0 or v_type not in ('Receipt', 'Payment'):
+            return jsonify({'error': 'Số tiền hoặc loại phiếu không hợp lệ'}), 400
+
+        paid = db.func.coalesce(Order.amount_paid, 0)
+        query = Order.query.filter(
+            Order.partner_id == id,
+            Order.payment_method == 'Debt',
+            Order.type == ('Sale' if v_type == 'Receipt' else 'Purchase'),
+            Order.total_amount > paid
+        )
+        if data.get('order_ids'):
+            query = query.filter(Order.id.in_(data['order_ids']))
+        orders = query.order_by(Order.date, Order.id).all()
+
+        posting = Posting()
+        note = data.get('note')
+        shift_id = current_shift_id(data)
+        remaining = amount
+        settled = []
+        for order in orders:
+            if remaining <= 0:
+                break
+            pay = min(remaining, order.total_amount - (order.amount_paid or 0))
+            # amount_paid is set here for the whole batch instead of a re-sync per order
+            posting.add_voucher(sync_order=False, partner_id=id, amount=pay, type=v_type, source='settlement',
+                                order_id=order.id, shift_id=shift_id, note=note or f"Thanh toán đơn {order.display_id}")
+            order.amount_paid = (order.amount_paid or 0) + pay
+            order.status = 'Completed' if order.amount_paid >= order.total_amount - 1 else 'Pending'
+            remaining -= pay
+            settled.append({'id': order.id, 'display_id': order.display_id, 'paid': pay,
+                            'amount_paid': order.amount_paid, 'status': order.status})
+        if remaining > 0:
+            posting.add_voucher(partner_id=id, amount=remaining, type=v_type, source='settlement',
+                                shift_id=shift_id, note=note or 'Thanh toán chưa phân bổ')
+        posting.commit()
+        return jsonify({'orders': settled, 'unallocated': remaining,
+                        'debt_balance': db.session.get(Partner, id).debt_balance}), 201
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
+
 @app.route('/api/vouchers', methods=['GET'])
 def get_vouchers():
     partner_id = request.args.get('partner_id', type=int)
@@ -2415,33 +4524,20 @@ def get_vouchers():
 @app.route('/api/vouchers/<int:id>', methods=['DELETE'])
 def delete_voucher(id):
     try:
-        voucher = CashVoucher.query.get_or_404(id)
-        # Reverse debt change if applicable
-        if voucher.partner_id:
-            partner = Partner.query.get(voucher.partner_id)
-            if partner:
-                if voucher.type == 'Receipt':
-                    partner.debt_balance += voucher.amount
-                elif voucher.type == 'Payment':
-                    partner.debt_balance -= voucher.amount
-        
+        voucher = db.get_or_404(CashVoucher, id)
+        posting = Posting()
         
-        # REVERSION LOGIC: If this was a settlement voucher, revert the order to 'Pending'
+        # REVERSION LOGIC: If this was a settlement voucher, the order is unpaid again.
+        # Its payment method is kept: the order's debt, ledger entry and cash were posted
+        # for that method, and only the Posting may move them.
         if voucher.source == 'settlement' and voucher.order_id:
-            order = Order.query.get(voucher.order_id)
+            order = db.session.get(Order, voucher.order_id)
             if order:
-                order.payment_method = 'Pending'
-                order.amount_paid = 0
-                # We don't touch inventory/debt balance here because the Voucher deletion 
-                # already handled the debt balance reversal above, and moving to 'Pending'
-                # doesn't affect stock (it was already subtracted/added during create_order).
+                order.status = 'Pending'
         
-        db.session.delete(voucher)
-        db.session.commit()
-        
-        # Sync amount_paid if linked to an order
-        if voucher.order_id:
-            sync_order_amount_paid(voucher.order_id)
+        # Reverse debt change and re-sync amount_paid of the linked order
+        posting.remove_voucher(voucher)
+        posting.commit()
             
         return jsonify({'message': 'Voucher deleted successfully'})
     except Exception as e:
@@ -2450,6 +4546,202 @@ def delete_voucher(id):
 
 
 
+@app.route('/api/cash-book', methods=['GET'])
+def get_cash_book():
+    """
+    Sổ quỹ tiền mặt: Cash orders and vouchers between start_date and end_date (whole days,
+    default today) with a running balance. The opening balance is the stored closing of the
+    last day before the range, so only the range itself is read.
+    With ?limit= the book is keyset-paginated oldest first: cursor = "<iso date>|<source>|<id>"
+    of the last row of the previous page. A page reads only its own rows; its opening is the
+    closing of the day before the cursor's day plus that day's entries up to the cursor, and
+    the range totals come from the daily checkpoints.
+    """
+    limit = request.args.get('limit', type=int)
+    cursor = request.args.get('cursor')
+    try:
+        today = get_vn_time().date()
+        start = date.fromisoformat(request.args['start_date'][:10]) if request.args.get('start_date') else today
+        end = date.fromisoformat(request.args['end_date'][:10]) if request.args.get('end_date') else today
+        start_dt = datetime.combine(start, datetime.min.time())
+        end_dt = datetime.combine(end, datetime.max.time())
+
+        def closing_before(day):
+            return db.session.query(CashDailyBalance.closing).filter(CashDailyBalance.day < day)\
+                .order_by(CashDailyBalance.day.desc()).limit(1).scalar() or 0
+
+        def timeline(from_dt, to_dt):
+            orders = db.select(
+                Order.id.label('id'), Order.date.label('date'), literal('Order').label('source'),
+                Order.type.label('type'), Order.display_id.label('ref'), Order.note.label('note'),
+                Partner.name.label('partner_name'),
+                case((Order.type == 'Sale', Order.total_amount), else_=-Order.total_amount).label('amount')
+            ).outerjoin(Partner, Partner.id == Order.partner_id)\
+             .where(Order.payment_method == 'Cash', Order.is_opening_balance == False, Order.date.between(from_dt, to_dt))
+            vouchers = db.select(
+                CashVoucher.id.label('id'), CashVoucher.date.label('date'), literal('Voucher').label('source'),
+                CashVoucher.type.label('type'), literal(None).label('ref'), CashVoucher.note.label('note'),
+                Partner.name.label('partner_name'),
+                case((CashVoucher.type == 'Receipt', CashVoucher.amount), (CashVoucher.type == 'Payment', -CashVoucher.amount), else_=0).label('amount')
+            ).outerjoin(Partner, Partner.id == CashVoucher.partner_id)\
+             .where(CashVoucher.date.between(from_dt, to_dt))
+            return union_all(orders, vouchers).subquery()
+
+        opening = closing_before(start)
+        balance = opening
+        if limit:
+            limit = min(limit, 500)
+            timeline_rows = timeline(start_dt, end_dt)
+            query = db.select(timeline_rows)
+            if cursor:
+                c_date, c_source, c_id = cursor.rsplit('|', 2)
+                c_date, c_id = datetime.fromisoformat(c_date), int(c_id)
+                def after_cursor(t):
+                    return db.or_(t.c.date > c_date, db.and_(t.c.date == c_date, db.or_(
+                        t.c.source > c_source, db.and_(t.c.source == c_source, t.c.id > c_id))))
+                query = query.where(after_cursor(timeline_rows))
+                # Page opening: closing of the previous day plus this day's entries up to the cursor
+                same_day = timeline(datetime.combine(c_date.date(), datetime.min.time()), c_date)
+                balance = closing_before(c_date.date()) + (db.session.execute(
+                    db.select(db.func.sum(same_day.c.amount)).where(db.not_(after_cursor(same_day)))).scalar() or 0)
+            rows = db.session.execute(query.order_by(timeline_rows.c.date, timeline_rows.c.source, timeline_rows.c.id)
+                                      .limit(limit + 1)).all()
+            has_more = len(rows) > limit
+            rows = rows[:limit]
+        else:
+            timeline_rows = timeline(start_dt, end_dt)
+            rows = db.session.execute(db.select(timeline_rows)
+                                      .order_by(timeline_rows.c.date, timeline_rows.c.source, timeline_rows.c.id)).all()
+
+        entries = []
+        inflow = outflow = 0
+        for r in rows:
+            amount = r.amount or 0
+            balance += amount
+            if amount > 0:
+                inflow += amount
+            else:
+                outflow -= amount
+            if r.source == 'Order':
+                desc = f"{'Bán hàng' if r.type == 'Sale' else 'Nhập hàng'} (Đơn {r.ref})"
+                ref = r.ref
+            else:
+                desc = r.note or ('Phiếu thu tiền' if r.type == 'Receipt' else 'Phiếu chi tiền')
+                ref = f"PT-{r.id}" if r.type == 'Receipt' else f"PC-{r.id}"
+            entries.append({
+                'id': r.id,
+                'date': r.date.isoformat(),
+                'type': r.source,
+                'ref_id': ref,
+                'desc': desc,
+                'partner_name': r.partner_name,
+                'order_id': r.id if r.source == 'Order' else None,
+                'voucher_id': r.id if r.source == 'Voucher' else None,
+                'increase': amount if amount > 0 else 0,
+                'decrease': -amount if amount < 0 else 0,
+                'running_balance': balance
+            })
+
+        if limit:
+            inflow, outflow = db.session.query(db.func.coalesce(db.func.sum(CashDailyBalance.inflow), 0),
+                                               db.func.coalesce(db.func.sum(CashDailyBalance.outflow), 0))\
+                .filter(CashDailyBalance.day.between(start, end)).one()
+            last = rows[-1] if rows else None
+            return jsonify({
+                'opening_balance': opening,
+                'inflow': inflow,
+                'outflow': outflow,
+                'closing_balance': opening + inflow - outflow,
+                'items': entries,
+                'next_cursor': f"{last.date.isoformat()}|{last.source}|{last.id}" if has_more else None
+            })
+        return jsonify({
+            'opening_balance': opening,
+            'inflow': inflow,
+            'outflow': outflow,
+            'closing_balance': balance,
+            'total': len(entries),
+            'items': entries
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+# --- Shifts ---
+def current_shift_id(data):
+    """Open shift a new document belongs to: data['shift_id'], else the open shift of
+    data['terminal'], else the only open shift. None when there is no such shift."""
+    query = db.session.query(Shift.id).filter(Shift.closed_at == None)
+    if data.get('shift_id'):
+        return query.filter(Shift.id == int(data['shift_id'])).scalar()
+    if data.get('terminal'):
+        query = query.filter(Shift.terminal == data['terminal'])
+    ids = [row.id for row in query.limit(2)]
+    return ids[0] if len(ids) == 1 else None
+
+@app.route('/api/shifts/open', methods=['POST'])
+def open_shift():
+    data = request.json or {}
+    terminal = data.get('terminal') or None
+    if Shift.query.filter(Shift.closed_at == None, Shift.terminal == terminal).first():
+        return jsonify({'error': 'Máy này đang có ca chưa đóng'}), 400
+    user = db.session.get(User, data['user_id']) if data.get('user_id') else None
+    shift = Shift(
+        user_id=user.id if user else None,
+        cashier=user.display_name or user.username if user else data.get('cashier'),
+        terminal=terminal,
+        opened_at=get_vn_time(),
+        opening_float=float(data.get('opening_float') or 0),
+        note=data.get('note')
+    )
+    db.session.add(shift)
+    db.session.commit()
+    return jsonify(shift.to_dict()), 201
+
+@app.route('/api/shifts/current', methods=['GET'])
+def get_current_shift():
+    shift_id = current_shift_id({'terminal': request.args.get('terminal')})
+    return jsonify(db.session.get(Shift, shift_id).to_dict() if shift_id else None)
+
+@app.route('/api/shifts', methods=['GET'])
+def get_shifts():
+    page = request.args.get('page', 1, type=int)
+    limit = request.args.get('limit', 20, type=int)
+    query = Shift.query
+    if request.args.get('terminal'):
+        query = query.filter(Shift.terminal == request.args['terminal'])
+    if request.args.get('user_id'):
+        query = query.filter(Shift.user_id == request.args.get('user_id', type=int))
+    pagination = query.order_by(Shift.opened_at.desc(), Shift.id.desc()).paginate(page=page, per_page=limit, error_out=False)
+    return jsonify({
+        'items': [s.to_dict() for s in pagination.items],
+        'total': pagination.total,
+        'pages': pagination.pages,
+        'current_page': pagination.page
+    })
+
+@app.route('/api/shifts/<int:id>/report', methods=['GET'])
+def get_shift_report(id):
+    """X report (shift still open) or Z report (closed): the shift's maintained totals."""
+    return jsonify(db.get_or_404(Shift, id).to_dict())
+
+@app.route('/api/shifts/<int:id>/close', methods=['POST'])
+def close_shift(id):
+    """Close the shift with the counted drawer cash; the response is the Z report."""
+    data = request.json or {}
+    shift = db.get_or_404(Shift, id)
+    if shift.closed_at:
+        return jsonify({'error': 'Ca đã đóng'}), 400
+    try:
+        shift.counted_cash = float(data['counted_cash']) if data.get('counted_cash') is not None else shift.expected_cash
+        shift.closed_at = get_vn_time()
+        if data.get('note'):
+            shift.note = data['note']
+        db.session.commit()
+        return jsonify(shift.to_dict())
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
+
 # --- Settings ---
 @app.route('/api/print-templates', methods=['GET'])
 def get_print_templates():
@@ -2500,7 +4792,7 @@ def create_print_template():
 
 @app.route('/api/print-templates/<int:id>', methods=['PUT'])
 def update_print_template(id):
-    template = PrintTemplate.query.get_or_404(id)
+    template = db.get_or_404(PrintTemplate, id)
     data = request.json
     template.name = data.get('name', template.name)
     template.module = data.get('module', template.module)
@@ -2518,7 +4810,7 @@ def update_print_template(id):
 
 @app.route('/api/print-templates/<int:id>', methods=['DELETE'])
 def delete_print_template(id):
-    template = PrintTemplate.query.get_or_404(id)
+    template = db.get_or_404(PrintTemplate, id)
     db.session.delete(template)
     db.session.commit()
     return jsonify({'message': 'Template deleted successfully'})
@@ -2537,7 +4829,16 @@ def report_products():
     page = request.args.get('page', type=int)
     limit = request.args.get('limit', type=int)
     
-    query = OrderDetail.query.join(Order).join(Product).options(joinedload(OrderDetail.product)).filter(Order.type == 'Sale')
+    # Grouped in SQL over the line snapshots; Product is only joined for the brand filter
+    name_col = db.func.coalesce(OrderDetail.product_name_override, OrderDetail.product_name)
+    query = db.session.query(
+        OrderDetail.product_id,
+        db.func.max(name_col).label('name'),
+        db.func.max(OrderDetail.product_unit).label('unit'),
+        db.func.sum(OrderDetail.quantity).label('quantity'),
+        db.func.sum(OrderDetail.quantity * OrderDetail.price).label('revenue'),
+        db.func.sum(OrderDetail.quantity * db.func.coalesce(OrderDetail.unit_cost, 0)).label('cost')
+    ).join(Order, Order.id == OrderDetail.order_id).filter(Order.type == 'Sale')
     # Date filtering
     if year:
         query = query.filter(db.func.strftime('%Y', Order.date) == str(year))
@@ -2551,38 +4852,19 @@ def report_products():
         query = query.filter(db.func.strftime('%d', Order.date) == str(day).zfill(2))
     
     if brand:
-        query = query.filter(Product.brand == brand)
+        query = query.join(Product, Product.id == OrderDetail.product_id).filter(Product.brand == brand)
         
-    details = query.all()
     report = {}
-    for d in details:
-        pid = d.product_id
-        if pid not in report:
-            p_name = d.product_name_override or (d.product.name if d.product else 'Sản phẩm đã xóa')
-            p_unit = d.product.unit if d.product else 'ĐV'
-            report[pid] = {
-                'id': pid,
-                'name': p_name,
-                'unit': p_unit,
-                'quantity': 0,
-                'revenue': 0,
-                'cost': 0,
-                'profit': 0
-            }
-        report[pid]['quantity'] += d.quantity
-        report[pid]['revenue'] += d.quantity * d.price
-        
-        # Calculate cost
-        current_cost = 0
-        if d.product:
-            if d.product.is_combo:
-                combo_cost = sum(ci.quantity * ci.product.cost_price for ci in d.product.combo_items if ci.product)
-                current_cost = d.quantity * combo_cost
-            else:
-                current_cost = d.quantity * (d.product.cost_price or 0)
-        
-        report[pid]['cost'] += current_cost
-        report[pid]['profit'] = report[pid]['revenue'] - report[pid]['cost']
+    for r in query.group_by(OrderDetail.product_id).all():
+        report[r.product_id] = {
+            'id': r.product_id,
+            'name': r.name or 'Sản phẩm đã xóa',
+            'unit': r.unit or 'ĐV',
+            'quantity': r.quantity or 0,
+            'revenue': r.revenue or 0,
+            'cost': r.cost or 0,
+            'profit': (r.revenue or 0) - (r.cost or 0)
+        }
     
     report_list = list(report.values())
     
@@ -2629,7 +4911,13 @@ def report_partners():
     limit = request.args.get('limit', type=int)
     
     o_type = 'Sale' if p_type == 'Customer' else 'Purchase'
-    query = Order.query.filter(Order.type == o_type, Order.display_id.notin_(['NODAU', '#NODAU']))
+    # Count, revenue and cost all live on the Order row, so this is a single-table aggregate
+    query = db.session.query(
+        Order.partner_id,
+        db.func.count(Order.id).label('count'),
+        db.func.sum(Order.total_amount).label('total_amount'),
+        db.func.sum(Order.total_amount - db.func.coalesce(Order.total_cost, 0)).label('profit')
+    ).filter(Order.type == o_type, Order.is_opening_balance == False)
     # Date filtering
     if year:
         query = query.filter(db.func.strftime('%Y', Order.date) == str(year))
@@ -2642,34 +4930,20 @@ def report_partners():
     if day:
         query = query.filter(db.func.strftime('%d', Order.date) == str(day).zfill(2))
         
-    orders = query.all()
+    rows = query.group_by(Order.partner_id).all()
+    partner_ids = [r.partner_id for r in rows if r.partner_id]
+    names = dict(db.session.query(Partner.id, Partner.name).filter(Partner.id.in_(partner_ids)).all()) if partner_ids else {}
+    retail_name = 'KHÁCH LẺ' if p_type == 'Customer' else 'NCC VÃNG LAI'
+    
     report = {}
-    for o in orders:
-        pid = o.partner_id or 0 # 0 for retail
-        pname = o.partner.name if o.partner else ('KHÁCH LẺ' if p_type == 'Customer' else 'NCC VÃNG LAI')
-        
+    for r in rows:
+        pid = r.partner_id or 0 # 0 for retail
         if pid not in report:
-            report[pid] = {
-                'name': pname,
-                'id': pid,
-                'count': 0,
-                'total_amount': 0,
-                'profit': 0 # only relevant for sales
-            }
-        
-        report[pid]['count'] += 1
-        report[pid]['total_amount'] += o.total_amount
-        
-        if o_type == 'Sale':
-            order_profit = 0
-            for d in o.details:
-                if d.product:
-                    if d.product.is_combo:
-                        combo_cost = sum(ci.quantity * ci.product.cost_price for ci in d.product.combo_items if ci.product)
-                        order_profit += d.quantity * (d.price - combo_cost)
-                    else:
-                        order_profit += d.quantity * (d.price - (d.product.cost_price or 0))
-            report[pid]['profit'] += order_profit
+            report[pid] = {'name': names.get(r.partner_id, retail_name), 'id': pid, 'count': 0, 'total_amount': 0, 'profit': 0}
+        report[pid]['count'] += r.count
+        report[pid]['total_amount'] += r.total_amount or 0
+        if o_type == 'Sale': # only relevant for sales
+            report[pid]['profit'] += r.profit or 0
             
     report_list = list(report.values())
     
@@ -2702,6 +4976,516 @@ def report_partners():
         
     return jsonify(report_list)
 
+# Reports computed from the whole debt book are cached per ledger version: any posting
+# adds or removes ledger rows, which moves (count, max id), and a partner merge hands rows
+# to another partner, which moves SUM(partner_id) even when the rebuilt rows get their old
+# ids back. The cache is per process and only a speed-up: every read checks the version in
+# the database, so a worker never serves a result another worker's write has outdated.
+# Least recently used keys are dropped.
+REPORT_CACHE_SIZE = 32
+_report_cache = OrderedDict()
+_report_cache_lock = threading.Lock()
+
+def ledger_version():
+    return tuple(db.session.query(db.func.count(PartnerLedgerEntry.id), db.func.max(PartnerLedgerEntry.id),
+                                  db.func.sum(PartnerLedgerEntry.partner_id)).one())
+
+def cached_report(key, version, compute):
+    with _report_cache_lock:
+        hit = _report_cache.get(key)
+        if hit and hit[0] == version:
+            _report_cache.move_to_end(key)
+            return hit[1]
+    value = compute()
+    with _report_cache_lock:
+        _report_cache[key] = (version, value)
+        _report_cache.move_to_end(key)
+        while len(_report_cache) > REPORT_CACHE_SIZE:
+            _report_cache.popitem(last=False)
+    return value
+
+AGING_BUCKETS = (('current', 30), ('d30', 60), ('d60', 90), ('d90', None))
+
+def age_partner_debts(as_of):
+    """
+    FIFO-match every partner's ledger in one streaming pass over the (partner_id, date, id)
+    index: entries of the opposite sign settle the oldest open documents first. What is left
+    is the outstanding balance split by document age.
+    """
+    def bucket_row(partner_id, open_items):
+        total = sum(amount for _, amount in open_items)
+        if abs(total) < 1:
+            return None
+        row = {'partner_id': partner_id, 'kind': 'receivable' if total > 0 else 'payable',
+               'total': abs(total), 'oldest_date': open_items[0][0].isoformat()}
+        for key, _ in AGING_BUCKETS:
+            row[key] = 0
+        for date, amount in open_items:
+            age = (as_of - date).days
+            key = next(k for k, limit in AGING_BUCKETS if limit is None or age <= limit)
+            row[key] += abs(amount)
+        return row
+
+    rows, current, open_items = [], None, []
+    entries = db.session.query(PartnerLedgerEntry.partner_id, PartnerLedgerEntry.date, PartnerLedgerEntry.amount)\
+        .filter(PartnerLedgerEntry.date <= as_of)\
+        .order_by(PartnerLedgerEntry.partner_id, PartnerLedgerEntry.date, PartnerLedgerEntry.id)
+    for partner_id, date, amount in entries.yield_per(2000):
+        if partner_id != current:
+            row = bucket_row(current, open_items) if open_items else None
+            if row: rows.append(row)
+            current, open_items = partner_id, []
+        amount = amount or 0
+        # Settle against open items of the opposite sign, oldest first
+        while amount and open_items and (open_items[0][1] > 0) != (amount > 0):
+            item_date, open_amount = open_items[0]
+            if abs(open_amount) > abs(amount):
+                open_items[0] = (item_date, open_amount + amount)
+                amount = 0
+            else:
+                amount += open_amount
+                open_items.pop(0)
+        if amount:
+            open_items.append((date, amount))
+    row = bucket_row(current, open_items) if open_items else None
+    if row: rows.append(row)
+    return rows
+
+@app.route('/api/reports/debt-aging', methods=['GET'])
+def report_debt_aging():
+    """
+    Receivables (?type=receivable, default) or payables (?type=payable) by age of the open
+    documents: current (0-30 days), d30 (31-60), d60 (61-90), d90 (over 90).
+    Also: as_of (YYYY-MM-DD), search, sort_by, sort_order, page, limit.
+    """
+    kind = request.args.get('type', 'receivable')
+    search = request.args.get('search', '').lower()
+    sort_by = request.args.get('sort_by', 'total')
+    sort_order = request.args.get('sort_order', 'desc')
+    page = request.args.get('page', 1, type=int)
+    limit = request.args.get('limit', 50, type=int)
+    try:
+        as_of_arg = request.args.get('as_of')
+        as_of = datetime.fromisoformat(as_of_arg).replace(hour=23, minute=59, second=59) if as_of_arg else get_vn_time()
+        day = as_of.date().isoformat()
+        rows = cached_report(('debt-aging', day), ledger_version(), lambda: age_partner_debts(as_of))
+
+        names = dict(db.session.query(Partner.id, Partner.name).all())
+        items = [dict(r, name=names.get(r['partner_id'], '')) for r in rows if r['kind'] == kind]
+        summary = {key: sum(r[key] for r in items) for key, _ in AGING_BUCKETS}
+        summary['total'] = sum(r['total'] for r in items)
+        if search:
+            s_norm = remove_accents(search)
+            items = [r for r in items if s_norm in remove_accents(r['name'])]
+
+        if sort_by not in ('name', 'total', 'oldest_date') + tuple(k for k, _ in AGING_BUCKETS):
+            sort_by = 'total'
+        key = (lambda r: r['name'].lower()) if sort_by == 'name' else (lambda r: r[sort_by])
+        items.sort(key=key, reverse=(sort_order == 'desc'))
+
+        total = len(items)
+        start = (page - 1) * limit
+        return jsonify({
+            'items': items[start:start + limit],
+            'total': total,
+            'pages': (total + limit - 1) // limit,
+            'current_page': page,
+            'summary': summary,
+            'as_of': day
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+def sales_version():
+    """Changes whenever a sale is created, edited, deleted or moved to another partner."""
+    return tuple(db.session.query(db.func.count(Order.id), db.func.max(Order.id), db.func.sum(Order.total_amount),
+                                  db.func.sum(db.func.coalesce(Order.partner_id, 0)))
+                 .filter(Order.type == 'Sale').one())
+
+def rfm_segment(r, f):
+    if r >= 4 and f >= 4: return 'VIP'
+    if r >= 3 and f >= 3: return 'Trung thành'
+    if r >= 4: return 'Khách mới'
+    if r <= 2 and f >= 4: return 'Không thể để mất'
+    if r <= 2 and f >= 2: return 'Có nguy cơ rời bỏ'
+    if r <= 2: return 'Đã rời bỏ'
+    return 'Cần quan tâm'
+
+RFM_MIN_POPULATION = 5
+
+def compute_customer_rfm():
+    """
+    Recency / frequency / monetary per customer and 1-5 scores in one grouped query.
+    A score is ceil(5 * CUME_DIST), so equal values (recency counted in days) share a
+    score and the best value always scores 5. Below RFM_MIN_POPULATION customers the
+    quantiles are too coarse to call anyone at risk: scores are kept at 3 or above.
+    """
+    per_customer = db.session.query(
+        Order.partner_id.label('partner_id'),
+        db.func.max(Order.date).label('last_order'),
+        db.func.count(Order.id).label('frequency'),
+        db.func.sum(Order.total_amount).label('monetary')
+    ).filter(Order.type == 'Sale', Order.is_opening_balance == False, Order.partner_id != None)\
+     .group_by(Order.partner_id).subquery()
+    rows = db.session.query(
+        per_customer,
+        db.func.cume_dist().over(order_by=db.func.date(per_customer.c.last_order)).label('r'),
+        db.func.cume_dist().over(order_by=per_customer.c.frequency).label('f'),
+        db.func.cume_dist().over(order_by=db.func.coalesce(per_customer.c.monetary, 0)).label('m')
+    ).order_by(per_customer.c.partner_id).all()
+    floor = 3 if len(rows) < RFM_MIN_POPULATION else 1
+    score = lambda cume: min(max(math.ceil(round(cume * 5, 9)), floor), 5)
+    now = get_vn_time()
+    result = []
+    for row in rows:
+        r, f, m = score(row.r), score(row.f), score(row.m)
+        result.append({
+            'partner_id': row.partner_id,
+            'last_order': row.last_order.isoformat(),
+            'recency_days': (now - row.last_order).days,
+            'frequency': row.frequency,
+            'monetary': row.monetary or 0,
+            'r': r, 'f': f, 'm': m,
+            'score': f"{r}{f}{m}",
+            'segment': rfm_segment(r, f)
+        })
+    return result
+
+@app.route('/api/reports/customer-rfm', methods=['GET'])
+def report_customer_rfm():
+    """
+    RFM segmentation of customers: 1-5 quantile scores for recency, frequency and monetary
+    value plus a segment label. Cached until the next sale changes.
+    Also: segment, search, sort_by, sort_order, page, limit.
+    """
+    segment = request.args.get('segment')
+    search = request.args.get('search', '').lower()
+    sort_by = request.args.get('sort_by', 'monetary')
+    sort_order = request.args.get('sort_order', 'desc')
+    page = request.args.get('page', 1, type=int)
+    limit = request.args.get('limit', 50, type=int)
+    try:
+        rows = cached_report(('customer-rfm', get_vn_time().date()), sales_version(), compute_customer_rfm)
+
+        names = dict(db.session.query(Partner.id, Partner.name).all())
+        items = [dict(r, name=names.get(r['partner_id'], '')) for r in rows]
+        segments = {}
+        for r in items:
+            segments[r['segment']] = segments.get(r['segment'], 0) + 1
+        if segment:
+            items = [r for r in items if r['segment'] == segment]
+        if search:
+            s_norm = remove_accents(search)
+            items = [r for r in items if s_norm in remove_accents(r['name'])]
+
+        if sort_by not in ('name', 'last_order', 'recency_days', 'frequency', 'monetary', 'score'):
+            sort_by = 'monetary'
+        key = (lambda r: r['name'].lower()) if sort_by == 'name' else (lambda r: r[sort_by])
+        items.sort(key=key, reverse=(sort_order == 'desc'))
+
+        total = len(items)
+        start = (page - 1) * limit
+        return jsonify({
+            'items': items[start:start + limit],
+            'total': total,
+            'pages': (total + limit - 1) // limit,
+            'current_page': page,
+            'segments': segments
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/api/reports/financial-statement', methods=['GET'])
+def report_financial_statement():
+    """
+    P&L (revenue, COGS, gross margin, expenses by voucher type, net profit) and cash flow
+    (cash and bank, in and out) per ?granularity=month (default) or quarter, between
+    ?start and ?end (YYYY-MM, default the current year). Reads the maintained monthly totals.
+    """
+    granularity = request.args.get('granularity', 'month')
+    year = get_vn_time().year
+    start = request.args.get('start', f'{year}-01')[:7]
+    end = request.args.get('end', f'{year}-12')[:7]
+    try:
+        rows = db.session.query(FinancePeriodTotal.period, FinancePeriodTotal.metric, FinancePeriodTotal.amount)\
+            .filter(FinancePeriodTotal.period.between(start, end)).all()
+
+        def bucket(period):
+            if granularity == 'quarter':
+                y, m = period.split('-')
+                return f"{y}-Q{(int(m) - 1) // 3 + 1}"
+            return period
+
+        periods = {}
+        for period, metric, amount in rows:
+            totals = periods.setdefault(bucket(period), {})
+            totals[metric] = totals.get(metric, 0) + (amount or 0)
+
+        def statement(label, t):
+            revenue, cogs = t.get('revenue', 0), t.get('cogs', 0)
+            expenses = {m.split(':', 1)[1]: v for m, v in t.items() if m.startswith('expense:')}
+            gross = revenue - cogs
+            total_expenses = sum(expenses.values())
+            cash_net = t.get('cash_in', 0) - t.get('cash_out', 0)
+            bank_net = t.get('bank_in', 0) - t.get('bank_out', 0)
+            return {
+                'period': label,
+                'revenue': revenue,
+                'cogs': cogs,
+                'gross_margin': gross,
+                'gross_margin_pct': round(gross / revenue * 100, 2) if revenue else None,
+                'expenses': expenses,
+                'total_expenses': total_expenses,
+                'other_income': t.get('other_income', 0),
+                'net_profit': gross - total_expenses + t.get('other_income', 0),
+                'purchases': t.get('purchases', 0),
+                'cash_flow': {
+                    'cash_in': t.get('cash_in', 0), 'cash_out': t.get('cash_out', 0), 'cash_net': cash_net,
+                    'bank_in': t.get('bank_in', 0), 'bank_out': t.get('bank_out', 0), 'bank_net': bank_net,
+                    'net': cash_net + bank_net
+                }
+            }
+
+        grand = {}
+        for t in periods.values():
+            for metric, amount in t.items():
+                grand[metric] = grand.get(metric, 0) + amount
+        return jsonify({
+            'granularity': granularity,
+            'items': [statement(label, periods[label]) for label in sorted(periods)],
+            'total': statement('total', grand)
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+SERIES_GRANULARITIES = ('hour', 'day', 'week', 'month')
+
+def series_bucket(when, granularity):
+    """Start of the hour / day / week (Monday) / month holding `when`."""
+    if granularity == 'hour':
+        return when.replace(minute=0, second=0, microsecond=0)
+    day = when.date() if isinstance(when, datetime) else when
+    if granularity == 'week':
+        return day - timedelta(days=day.weekday())
+    if granularity == 'month':
+        return day.replace(day=1)
+    return day
+
+def series_next(bucket, granularity):
+    if granularity == 'hour':
+        return bucket + timedelta(hours=1)
+    if granularity == 'week':
+        return bucket + timedelta(days=7)
+    if granularity == 'month':
+        return (bucket + timedelta(days=32)).replace(day=1)
+    return bucket + timedelta(days=1)
+
+@app.route('/api/reports/sales-series', methods=['GET'])
+def report_sales_series():
+    """
+    Revenue, cost, profit, quantity and order count per ?granularity=hour|day|week|month between
+    ?start_date and ?end_date (whole days, default the last 30), read from the sales rollups.
+    ?type=Sale (default) or Purchase; ?product_id / ?brand narrow it to products (day and up).
+    """
+    granularity = request.args.get('granularity', 'day')
+    order_type = request.args.get('type', 'Sale')
+    product_id = request.args.get('product_id', type=int)
+    brand = request.args.get('brand')
+    try:
+        if granularity not in SERIES_GRANULARITIES:
+            return jsonify({'error': 'granularity phải là hour, day, week hoặc month'}), 400
+        today = get_vn_time().date()
+        end = date.fromisoformat(request.args['end_date'][:10]) if request.args.get('end_date') else today
+        start = date.fromisoformat(request.args['start_date'][:10]) if request.args.get('start_date') else end - timedelta(days=29)
+        if start > end:
+            return jsonify({'error': 'Khoảng thời gian không hợp lệ'}), 400
+        if granularity == 'hour' and (end - start).days > 31:
+            return jsonify({'error': 'Theo giờ chỉ xem được tối đa 31 ngày'}), 400
+
+        values = lambda model: [db.func.sum(model.revenue), db.func.sum(model.cost),
+                                db.func.sum(model.quantity), db.func.sum(model.order_count)]
+        if product_id or brand:
+            if granularity == 'hour':
+                return jsonify({'error': 'Theo sản phẩm / thương hiệu chỉ xem được theo ngày trở lên'}), 400
+            query = db.session.query(ProductSalesDaily.day, *values(ProductSalesDaily))\
+                .filter(ProductSalesDaily.type == order_type, ProductSalesDaily.day.between(start, end))
+            if product_id:
+                query = query.filter(ProductSalesDaily.product_id == product_id)
+            if brand:
+                query = query.join(Product, Product.id == ProductSalesDaily.product_id).filter(Product.brand == brand)
+            rows = query.group_by(ProductSalesDaily.day).all()
+        else:
+            rows = db.session.query(SalesHourly.hour, *values(SalesHourly))\
+                .filter(SalesHourly.type == order_type,
+                        SalesHourly.hour >= datetime.combine(start, datetime.min.time()),
+                        SalesHourly.hour < datetime.combine(end + timedelta(days=1), datetime.min.time()))\
+                .group_by(SalesHourly.hour).all()
+
+        buckets = {}
+        for when, revenue, cost, quantity, orders in rows:
+            b = buckets.setdefault(series_bucket(when, granularity), [0, 0, 0, 0])
+            b[0] += revenue or 0
+            b[1] += cost or 0
+            b[2] += quantity or 0
+            b[3] += orders or 0
+
+        def point(label, revenue, cost, quantity, orders):
+            return {'period': label, 'revenue': revenue, 'cost': cost, 'profit': revenue - cost,
+                    'quantity': quantity, 'order_count': int(orders)}
+
+        items = []
+        bucket = series_bucket(datetime.combine(start, datetime.min.time()), granularity)
+        last = series_bucket(datetime.combine(end, datetime.max.time()), granularity)
+        while bucket <= last:
+            label = bucket.strftime('%Y-%m-%d %H:00') if granularity == 'hour' else bucket.strftime('%Y-%m' if granularity == 'month' else '%Y-%m-%d')
+            items.append(point(label, *buckets.get(bucket, [0, 0, 0, 0])))
+            bucket = series_next(bucket, granularity)
+        totals = [sum(b[i] for b in buckets.values()) for i in range(4)]
+        return jsonify({
+            'granularity': granularity,
+            'start_date': start.isoformat(),
+            'end_date': end.isoformat(),
+            'items': items,
+            'total': point('total', *totals)
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/api/reports/sales-series/rebuild', methods=['POST'])
+def rebuild_sales_series():
+    """Recompute the sales rollups from the orders (e.g. after editing the database by hand)."""
+    try:
+        rebuild_sales_rollups()
+        db.session.commit()
+        return jsonify({'message': 'Đã tính lại dữ liệu doanh số', 'hours': SalesHourly.query.count()})
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/api/reports/inventory-turnover', methods=['GET'])
+def report_inventory_turnover():
+    """
+    Turnover and dead stock per product (or ?group_by=brand) from one grouped pass over the
+    stock journal: last sale date, units sold in the last 90/180/365 days, average stock over
+    ?period= days (opening + closing / 2) and turnover = sold / average stock.
+    ?dead_days=N keeps only stocked products with no sale in N days.
+    Also: search, brand, location_id, sort_by, sort_order, page, limit.
+    """
+    period = max(request.args.get('period', 365, type=int), 1)
+    dead_days = request.args.get('dead_days', type=int)
+    group_by = request.args.get('group_by', 'product')
+    search = request.args.get('search', '').lower()
+    brand = request.args.get('brand')
+    location_id = request.args.get('location_id', type=int)
+    sort_by = request.args.get('sort_by', 'turnover')
+    sort_order = request.args.get('sort_order', 'asc')
+    page = request.args.get('page', 1, type=int)
+    limit = request.args.get('limit', 50, type=int)
+
+    now = get_vn_time()
+    cutoff = lambda days: now - timedelta(days=days)
+    is_sale = db.and_(StockMovement.kind == 'Sale', StockMovement.reversal == False, StockMovement.quantity < 0)
+    sold = lambda days: db.func.sum(case((db.and_(StockMovement.kind == 'Sale', StockMovement.date >= cutoff(days)), -StockMovement.quantity), else_=0))
+    agg = db.session.query(
+        StockMovement.product_id.label('product_id'),
+        db.func.max(case((is_sale, StockMovement.date))).label('last_sale'),
+        sold(90).label('sold_90'),
+        sold(180).label('sold_180'),
+        sold(365).label('sold_365'),
+        sold(period).label('sold_period'),
+        db.func.sum(case((StockMovement.date >= cutoff(period), StockMovement.quantity), else_=0)).label('net_period')
+    )
+    if location_id:
+        agg = agg.filter(movement_location_filter(location_id))
+    agg = agg.group_by(StockMovement.product_id).subquery()
+
+    closing = db.func.coalesce(LocationStock.quantity, 0) if location_id else db.func.coalesce(Product.stock, 0)
+    opening = closing - db.func.coalesce(agg.c.net_period, 0)
+    avg_stock = (opening + closing) / 2.0
+    sold_period = db.func.coalesce(agg.c.sold_period, 0)
+
+    filters = [db.or_(Product.is_combo == False, Product.is_combo == None)]
+    if search:
+        s_norm = remove_accents(search)
+        filters.append(db.func.remove_accents(Product.name).ilike(f'%{s_norm}%') | Product.code.ilike(f'%{search}%'))
+    if brand:
+        filters.append(Product.brand == brand)
+    if dead_days:
+        filters += [closing > 0, db.or_(agg.c.last_sale == None, agg.c.last_sale < cutoff(dead_days))]
+
+    def with_joins(q):
+        q = q.select_from(Product).outerjoin(agg, agg.c.product_id == Product.id)
+        if location_id:
+            q = q.outerjoin(LocationStock, db.and_(LocationStock.product_id == Product.id, LocationStock.location_id == location_id))
+        return q.filter(*filters)
+
+    if group_by == 'brand':
+        brand_col = db.func.coalesce(Product.brand, '')
+        sum_avg = db.func.sum(avg_stock)
+        turnover = case((sum_avg > 0, db.func.sum(sold_period) / sum_avg), else_=None)
+        query = with_joins(db.session.query(
+            brand_col.label('brand'),
+            db.func.count(Product.id).label('products'),
+            db.func.max(agg.c.last_sale).label('last_sale'),
+            db.func.sum(db.func.coalesce(agg.c.sold_90, 0)).label('sold_90'),
+            db.func.sum(db.func.coalesce(agg.c.sold_180, 0)).label('sold_180'),
+            db.func.sum(db.func.coalesce(agg.c.sold_365, 0)).label('sold_365'),
+            db.func.sum(closing).label('stock'),
+            sum_avg.label('avg_stock'),
+            turnover.label('turnover'),
+            db.func.sum(closing * db.func.coalesce(Product.avg_cost, 0)).label('stock_value')
+        )).group_by(brand_col)
+        sort_map = {'brand': brand_col, 'last_sale': db.func.max(agg.c.last_sale), 'stock': db.func.sum(closing),
+                    'stock_value': db.func.sum(closing * db.func.coalesce(Product.avg_cost, 0)), 'turnover': turnover,
+                    'sold_90': db.func.sum(db.func.coalesce(agg.c.sold_90, 0)), 'sold_365': db.func.sum(db.func.coalesce(agg.c.sold_365, 0))}
+        keys = ['brand', 'products']
+    else:
+        turnover = case((avg_stock > 0, sold_period / avg_stock), else_=None)
+        # Rank inside the brand (1 = fastest mover) via a window function
+        brand_rank = db.func.rank().over(partition_by=Product.brand, order_by=turnover.desc())
+        query = with_joins(db.session.query(
+            Product.id.label('id'), Product.name.label('name'), Product.code.label('code'),
+            Product.unit.label('unit'), Product.brand.label('brand'),
+            agg.c.last_sale.label('last_sale'),
+            db.func.coalesce(agg.c.sold_90, 0).label('sold_90'),
+            db.func.coalesce(agg.c.sold_180, 0).label('sold_180'),
+            db.func.coalesce(agg.c.sold_365, 0).label('sold_365'),
+            closing.label('stock'),
+            avg_stock.label('avg_stock'),
+            turnover.label('turnover'),
+            (closing * db.func.coalesce(Product.avg_cost, 0)).label('stock_value'),
+            brand_rank.label('brand_rank')
+        ))
+        sort_map = {'name': Product.name, 'last_sale': agg.c.last_sale, 'stock': closing, 'turnover': turnover,
+                    'stock_value': closing * db.func.coalesce(Product.avg_cost, 0),
+                    'sold_90': agg.c.sold_90, 'sold_365': agg.c.sold_365}
+        keys = ['id', 'name', 'code', 'unit', 'brand', 'brand_rank']
+
+    sort_col = sort_map.get(sort_by, sort_map['turnover'])
+    # NULL turnover (no stock) / never sold always sort last
+    query = query.order_by((sort_col.desc() if sort_order == 'desc' else sort_col.asc()).nulls_last())
+    total = query.order_by(None).count()
+    rows = query.offset((page - 1) * limit).limit(limit).all()
+
+    def to_item(r):
+        item = {k: getattr(r, k) for k in keys}
+        item.update({
+            'last_sale': r.last_sale.isoformat() if isinstance(r.last_sale, datetime) else r.last_sale,
+            'days_since_sale': (now - r.last_sale).days if isinstance(r.last_sale, datetime) else None,
+            'sold_90': r.sold_90 or 0, 'sold_180': r.sold_180 or 0, 'sold_365': r.sold_365 or 0,
+            'stock': r.stock or 0, 'avg_stock': r.avg_stock or 0, 'turnover': r.turnover,
+            'stock_value': r.stock_value or 0
+        })
+        return item
+
+    return jsonify({
+        'period': period,
+        'items': [to_item(r) for r in rows],
+        'total': total,
+        'pages': (total + limit - 1) // limit,
+        'current_page': page
+    })
+
 @app.route('/api/reports/synthesis', methods=['GET'])
 def report_synthesis():
     r_type = request.args.get('type', 'Sale')  # Sale, Purchase
@@ -2895,8 +5679,10 @@ def restore_backup():
             # 1. Truncate all tables
             tables = [
                 '"order"', 'order_detail', 'cash_voucher', 'bank_transaction',
-                'customer_price', 'combo_item',
-                'product', 'partner', 'bank_account', 'print_template', 'app_setting'
+                'customer_price', 'combo_item', 'stock_movement', 'stock_checkpoint', 'product_lot', 'lot_allocation',
+                'location', 'location_stock', 'stock_transfer', 'stock_transfer_item', 'stocktake', 'stocktake_line',
+                'partner_ledger_entry', 'partner_debt_cycle', 'cash_daily_balance', 'finance_period_total', 'shift',
+                'sales_hourly', 'product_sales_daily', 'dashboard_counter', 'reconcile_dirty', 'product', 'partner', 'bank_account', 'print_template', 'app_setting'
             ]
             stmt = f"TRUNCATE TABLE {', '.join(tables)} RESTART IDENTITY CASCADE;"
             db.session.execute(db.text(stmt))
@@ -2907,6 +5693,7 @@ def restore_backup():
             valid_partners = set()
             valid_orders = set()
             valid_accounts = set()
+            valid_lots = set()
 
             def import_table(sqlite_table, model, check_fks=None):
                 # check_fks: dict of { 'column_name': valid_ids_set }
@@ -2942,6 +5729,7 @@ def restore_backup():
                         if sqlite_table == 'partner': valid_partners.add(data['id'])
                         if sqlite_table == 'order': valid_orders.add(data['id'])
                         if sqlite_table == 'bank_account': valid_accounts.add(data['id'])
+                        if sqlite_table == 'product_lot': valid_lots.add(data['id'])
                     
                     db.session.flush()
                 except Exception as ex:
@@ -2950,9 +5738,11 @@ def restore_backup():
 
             import_table('app_setting', AppSetting)
             import_table('bank_account', BankAccount)
+            import_table('location', Location)
             import_table('partner', Partner)
             import_table('product', Product)
             import_table('print_template', PrintTemplate)
+            import_table('shift', Shift)
             
             import_table('order', Order, {'partner_id': valid_partners})
             
@@ -2961,6 +5751,15 @@ def restore_backup():
             import_table('customer_price', CustomerPrice, {'partner_id': valid_partners, 'product_id': valid_products})
             import_table('cash_voucher', CashVoucher, {'partner_id': valid_partners, 'order_id': valid_orders})
             import_table('bank_transaction', BankTransaction, {'account_id': valid_accounts, 'partner_id': valid_partners, 'order_id': valid_orders})
+            import_table('stock_movement', StockMovement, {'product_id': valid_products})
+            import_table('stock_checkpoint', StockCheckpoint, {'product_id': valid_products})
+            import_table('product_lot', ProductLot, {'product_id': valid_products})
+            import_table('lot_allocation', LotAllocation, {'lot_id': valid_lots})
+            import_table('location_stock', LocationStock, {'product_id': valid_products})
+            import_table('stock_transfer', StockTransfer)
+            import_table('stock_transfer_item', StockTransferItem, {'product_id': valid_products})
+            import_table('stocktake', Stocktake)
+            import_table('stocktake_line', StocktakeLine, {'product_id': valid_products})
             
             # 3. Reset Sequences
             def reset_seq(table, seq_name=None):
@@ -2986,7 +5785,10 @@ def restore_backup():
             # pg_get_serial_sequence is safer but tricky with quotes in sqlalchemy text()
             # Let's try explicit pg_get_serial_sequence approach
             
-            for t in ['order_detail', 'combo_item', 'customer_price', 'cash_voucher', 'bank_transaction']:
+            for t in ['order_detail', 'combo_item', 'customer_price', 'cash_voucher', 'bank_transaction', 'stock_movement', 'stock_checkpoint', 'product_lot', 'lot_allocation',
+                      'location', 'location_stock', 'stock_transfer', 'stock_transfer_item', 'stocktake', 'stocktake_line',
+                      'partner_ledger_entry', 'partner_debt_cycle', 'cash_daily_balance', 'finance_period_total', 'shift',
+                      'sales_hourly', 'product_sales_daily', 'dashboard_counter', 'reconcile_dirty']:
                 reset_seq(t)
                 
             # Retry Order sequence robustly
@@ -2999,6 +5801,14 @@ def restore_backup():
             conn.close()
             if os.path.exists(temp_db_path):
                 os.remove(temp_db_path)
+            # Backups taken before lots / locations existed; ledger and cash book are always rebuilt
+            backfill_product_lots()
+            backfill_location_stock()
+            backfill_partner_ledger()
+            backfill_cash_days()
+            backfill_bank_balances()
+            backfill_period_totals()
+            backfill_sales_rollups()
 
         else:
             # SQLite Mode
@@ -3034,7 +5844,10 @@ def reset_database():
             # But include all business data tables
             tables = [
                 '"order"', 'order_detail', 'cash_voucher', 'bank_transaction',
-                'customer_price', 'combo_item',
+                'customer_price', 'combo_item', 'stock_movement', 'stock_checkpoint', 'product_lot', 'lot_allocation',
+                'location_stock', 'stock_transfer', 'stock_transfer_item', 'stocktake', 'stocktake_line', # locations themselves are kept, like settings
+                'partner_ledger_entry', 'partner_debt_cycle', 'cash_daily_balance', 'finance_period_total', 'shift',
+                'sales_hourly', 'product_sales_daily', 'dashboard_counter', 'reconcile_dirty',
                 'product', 'partner', 'bank_account', 'print_template'
             ]
             
@@ -3057,10 +5870,28 @@ def reset_database():
             
             # 4. Product dependencies
             ComboItem.query.delete()
+            StockMovement.query.delete()
+            StockCheckpoint.query.delete()
+            LotAllocation.query.delete()
+            ProductLot.query.delete()
+            LocationStock.query.delete()
+            StockTransferItem.query.delete()
+            StockTransfer.query.delete()
+            StocktakeLine.query.delete()
+            Stocktake.query.delete()
 
             CustomerPrice.query.delete()
+            PartnerLedgerEntry.query.delete()
+            PartnerDebtCycle.query.delete()
+            CashDailyBalance.query.delete()
+            FinancePeriodTotal.query.delete()
+            SalesHourly.query.delete()
+            ProductSalesDaily.query.delete()
+            DashboardCounter.query.delete()
+            ReconcileDirty.query.delete()
             
             # 5. Core Entities
+            Shift.query.delete()
             Product.query.delete()
             Partner.query.delete()
             BankAccount.query.delete()
@@ -3081,6 +5912,169 @@ def optimize_db():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# --- Reconciliation ---
+# Stored running totals (Partner.debt_balance, BankAccount.balance, Product.stock) are
+# recomputed from their source documents with one grouped query per table.
+
+def mark_reconcile_dirty(kind, ids):
+    """Queue partners / bank accounts / products whose stored total was just written."""
+    ids = {i for i in ids if i}
+    if not ids:
+        return
+    queued = {r[0] for r in db.session.query(ReconcileDirty.entity_id)
+              .filter(ReconcileDirty.kind == kind, ReconcileDirty.entity_id.in_(ids))}
+    if ids - queued:
+        db.session.bulk_insert_mappings(ReconcileDirty, [{'kind': kind, 'entity_id': i} for i in ids - queued])
+
+def expected_partner_balances(partner_ids=None):
+    """Debt orders (Sale +, Purchase -) and vouchers (Receipt -, Payment +) per partner, as posted."""
+    orders = db.session.query(Order.partner_id, db.func.sum(
+        case((Order.type == 'Sale', Order.total_amount), else_=-Order.total_amount)))\
+        .filter(Order.payment_method == 'Debt', Order.partner_id != None)
+    vouchers = db.session.query(CashVoucher.partner_id, db.func.sum(
+        case((CashVoucher.type == 'Receipt', -CashVoucher.amount), (CashVoucher.type == 'Payment', CashVoucher.amount), else_=0)))\
+        .filter(CashVoucher.partner_id != None)
+    if partner_ids is not None:
+        orders = orders.filter(Order.partner_id.in_(partner_ids))
+        vouchers = vouchers.filter(CashVoucher.partner_id.in_(partner_ids))
+    balances = {}
+    for query, partner_col in ((orders, Order.partner_id), (vouchers, CashVoucher.partner_id)):
+        for partner_id, total in query.group_by(partner_col):
+            balances[partner_id] = balances.get(partner_id, 0) + (total or 0)
+    return balances
+
+def expected_bank_balances(account_ids=None):
+    query = db.session.query(BankAccount.id, BankAccount.opening_balance + db.func.coalesce(db.func.sum(
+        case((BankTransaction.type == 'Deposit', BankTransaction.amount),
+             (BankTransaction.type == 'Withdrawal', -BankTransaction.amount), else_=0)), 0))\
+        .outerjoin(BankTransaction, BankTransaction.account_id == BankAccount.id)
+    if account_ids is not None:
+        query = query.filter(BankAccount.id.in_(account_ids))
+    return {account_id: total or 0 for account_id, total in query.group_by(BankAccount.id, BankAccount.opening_balance)}
+
+def expected_product_stock(product_ids=None):
+    """
+    Order history (Purchase +, Sale -, combos as their current components) plus the stock
+    changes that belong to no order (opening, edits, imports, stocktakes). Orders are read
+    from their lines, not from the stock journal the Posting writes alongside Product.stock;
+    'Reconcile' rows only realign that journal and are left out.
+    """
+    sign = case((Order.type == 'Purchase', 1), (Order.type == 'Sale', -1), else_=0)
+    not_combo = db.or_(Product.is_combo == False, Product.is_combo == None)
+    simple = db.session.query(OrderDetail.product_id, db.func.sum(sign * OrderDetail.quantity))\
+        .join(Order, Order.id == OrderDetail.order_id)\
+        .join(Product, Product.id == OrderDetail.product_id).filter(not_combo)
+    combos = db.session.query(ComboItem.product_id, db.func.sum(sign * OrderDetail.quantity * ComboItem.quantity))\
+        .select_from(OrderDetail)\
+        .join(Order, Order.id == OrderDetail.order_id)\
+        .join(Product, Product.id == OrderDetail.product_id)\
+        .join(ComboItem, ComboItem.combo_id == Product.id).filter(Product.is_combo == True)
+    manual = db.session.query(StockMovement.product_id, db.func.sum(StockMovement.quantity))\
+        .filter(StockMovement.order_id == None, StockMovement.kind != 'Reconcile')
+    products = db.session.query(Product.id).filter(not_combo)
+    if product_ids is not None:
+        simple = simple.filter(OrderDetail.product_id.in_(product_ids))
+        combos = combos.filter(ComboItem.product_id.in_(product_ids))
+        manual = manual.filter(StockMovement.product_id.in_(product_ids))
+        products = products.filter(Product.id.in_(product_ids))
+    stock = {product_id: 0 for product_id, in products}
+    for query, product_col in ((simple, OrderDetail.product_id), (combos, ComboItem.product_id), (manual, StockMovement.product_id)):
+        for product_id, total in query.group_by(product_col):
+            if product_id in stock:
+                stock[product_id] += total or 0
+    return {product_id: int(round(total)) for product_id, total in stock.items()}
+
+def align_product_stock(product_id, expected):
+    """
+    Bring Product.stock, the locations' total, the lots' total and the journal's total to
+    the expected quantity. Location and lot differences land on the default location and
+    on first-expiry lots, the journal gets one 'Reconcile' row.
+    """
+    product = db.session.get(Product, product_id)
+    product.stock = expected
+    totals = lambda column, model: db.session.query(db.func.coalesce(db.func.sum(column), 0))\
+        .filter(model.product_id == product_id).scalar()
+    location_id = default_location_id()
+    diff = expected - totals(LocationStock.quantity, LocationStock)
+    if diff and location_id:
+        adjust_location_stock(product, location_id, diff)
+    diff = expected - totals(ProductLot.quantity, ProductLot)
+    if diff > 0:
+        receive_lot(product, diff)
+    elif diff < 0:
+        consume_lots(product_id, -diff)
+    diff = expected - totals(StockMovement.quantity, StockMovement)
+    if diff:
+        db.session.add(StockMovement(product=product, date=get_vn_time(), quantity=diff, kind='Reconcile',
+                                     note='Đối soát tồn kho', location_id=location_id))
+
+@app.route('/api/reconcile', methods=['POST'])
+def reconcile():
+    """
+    Compare stored debt, bank and stock totals with their source documents and list the mismatches.
+    incremental=true only checks what was written since the previous run (every Posting and
+    every direct balance / stock edit queues its partners, accounts and products).
+    fix=true corrects them in the same transaction: debts and bank balances are overwritten
+    (and the partner ledger / running balances rebuilt), products get their stock, location
+    stock, lots and journal brought to the expected quantity together.
+    """
+    data = request.json or {}
+    fix = bool(data.get('fix'))
+    incremental = bool(data.get('incremental'))
+    try:
+        last_dirty = db.session.query(db.func.max(ReconcileDirty.id)).scalar() or 0
+        partner_ids = account_ids = product_ids = None
+        if incremental:
+            dirty = lambda kind: [r[0] for r in db.session.query(ReconcileDirty.entity_id).filter(
+                ReconcileDirty.kind == kind, ReconcileDirty.id <= last_dirty).distinct()]
+            partner_ids, account_ids, product_ids = dirty('partner'), dirty('bank'), dirty('product')
+
+        def compare(model, column, expected, ids, label):
+            query = db.session.query(model.id, label, column)
+            if ids is not None:
+                query = query.filter(model.id.in_(ids))
+            if model is Product:
+                query = query.filter(db.or_(Product.is_combo == False, Product.is_combo == None))
+            return [{'id': row_id, 'name': name, 'stored': stored or 0, 'expected': expected.get(row_id, 0),
+                     'diff': expected.get(row_id, 0) - (stored or 0)}
+                    for row_id, name, stored in query if abs(expected.get(row_id, 0) - (stored or 0)) >= 0.5]
+
+        partners = compare(Partner, Partner.debt_balance, expected_partner_balances(partner_ids), partner_ids, Partner.name)
+        accounts = compare(BankAccount, BankAccount.balance, expected_bank_balances(account_ids), account_ids, BankAccount.bank_name)
+        products = compare(Product, Product.stock, expected_product_stock(product_ids), product_ids, Product.name)
+
+        # Everything queued up to now has been checked
+        ReconcileDirty.query.filter(ReconcileDirty.id <= last_dirty).delete(synchronize_session=False)
+        if fix:
+            for model, column, rows in ((Partner, 'debt_balance', partners), (BankAccount, 'balance', accounts)):
+                if rows:
+                    table = model.__table__
+                    db.session.execute(table.update().where(table.c.id == bindparam('_id')).values({column: bindparam('_value')}),
+                                       [{'_id': r['id'], '_value': r['expected']} for r in rows])
+            if partners:
+                rebuild_partner_ledger([r['id'] for r in partners])
+            if accounts:
+                rebuild_bank_balances([r['id'] for r in accounts])
+            for r in products:
+                align_product_stock(r['id'], r['expected'])
+            ReconcileDirty.query.delete(synchronize_session=False)
+            invalidate_kpis('debt', 'low_stock', 'expiry')
+        db.session.commit()
+        return jsonify({
+            'partners': partners,
+            'bank_accounts': accounts,
+            'products': products,
+            'checked': {
+                'partners': len(partner_ids) if partner_ids is not None else Partner.query.count(),
+                'bank_accounts': len(account_ids) if account_ids is not None else BankAccount.query.count(),
+                'products': len(product_ids) if product_ids is not None else Product.query.count()
+            },
+            'fixed': fix
+        })
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
+
 @app.route('/api/db-stats', methods=['GET'])
 def db_stats():
     try:
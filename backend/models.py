@@ -34,15 +34,18 @@ class Product(db.Model):
     unit = db.Column(db.String(20), nullable=True)
     secondary_unit = db.Column(db.String(20)) # Quy cách phụ (vd: Thùng)
     multiplier = db.Column(db.Float, default=1) # VD: 1 thùng = 20 chai
-    cost_price = db.Column(db.Float, default=0)
+    cost_price = db.Column(db.Float, default=0) # Giá nhập gần nhất / giá vốn nhập tay
+    avg_cost = db.Column(db.Float, default=0) # Giá vốn bình quân gia quyền, maintained by Posting
     sale_price = db.Column(db.Float, default=0)
-    stock = db.Column(db.Integer, default=0)
+    stock = db.Column(db.Integer, default=0) # Total across all locations (see LocationStock)
     expiry_date = db.Column(db.String(50)) # Hạn sử dụng
     active_ingredient = db.Column(db.String(255)) # Hoạt chất
     brand = db.Column(db.String(100)) # Hãng / Thương hiệu
     is_combo = db.Column(db.Boolean, default=False)
     
-    def to_dict(self):
+    def to_dict(self, stock_map=None):
+        # stock_map: {product_id: quantity} for one location, preloaded by the caller
+        stock = self.stock if stock_map is None else stock_map.get(self.id, 0)
         d = {
             'id': self.id,
             'name': self.name,
@@ -51,25 +54,30 @@ class Product(db.Model):
             'secondary_unit': self.secondary_unit,
             'multiplier': self.multiplier,
             'cost_price': self.cost_price,
+            'avg_cost': self.avg_cost,
             'sale_price': self.sale_price,
-            'stock': self.stock,
+            'stock': stock,
             'expiry_date': self.expiry_date,
             'active_ingredient': self.active_ingredient,
             'brand': self.brand,
             'is_combo': self.is_combo,
-            'current_stock': self.stock
+            'current_stock': stock
         }
         
         if self.is_combo and hasattr(self, 'combo_items') and self.combo_items:
             # Dynamically calculate for combos
             total_cost = 0
+            total_avg_cost = 0
             stocks = []
             for item in self.combo_items:
                 if item.product:
                     total_cost += (item.product.cost_price or 0) * (item.quantity or 0)
-                    stocks.append((item.product.stock or 0) // (item.quantity or 1))
+                    total_avg_cost += (item.product.avg_cost or 0) * (item.quantity or 0)
+                    item_stock = item.product.stock if stock_map is None else stock_map.get(item.product_id, 0)
+                    stocks.append((item_stock or 0) // (item.quantity or 1))
             
             d['cost_price'] = total_cost
+            d['avg_cost'] = total_avg_cost
             d['stock'] = min(stocks) if stocks else 0
             d['current_stock'] = d['stock'] # For combos, current_stock is the dynamic one
             
@@ -104,7 +112,7 @@ class Partner(db.Model):
     cccd = db.Column(db.String(20))
     phone = db.Column(db.String(20))
     address = db.Column(db.String(200))
-    debt_balance = db.Column(db.Float, default=0)
+    debt_balance = db.Column(db.Float, default=0, index=True) # top debtors read this index
 
     def to_dict(self):
         return {
@@ -128,6 +136,7 @@ class CashVoucher(db.Model):
     type = db.Column(db.String(50), default='Payment', index=True) # Payment to Supplier, Expense, etc.
     source = db.Column(db.String(50), default='manual', index=True) # 'manual' or 'settlement'
     order_id = db.Column(db.Integer, db.ForeignKey('order.id'), nullable=True)
+    shift_id = db.Column(db.Integer, db.ForeignKey('shift.id'), nullable=True, index=True)
     
     partner = db.relationship('Partner', backref=db.backref('vouchers', lazy='selectin'))
     order = db.relationship('Order', foreign_keys=[order_id])
@@ -143,7 +152,8 @@ class CashVoucher(db.Model):
             'type': self.type,
             'source': self.source,
             'order_id': self.order_id,
-            'order_display_id': self.order.display_id if self.order else None
+            'order_display_id': self.order.display_id if self.order else None,
+            'shift_id': self.shift_id
         }
 
 class Order(db.Model):
@@ -151,6 +161,7 @@ class Order(db.Model):
     date = db.Column(db.DateTime, default=utc_now, index=True)
     partner_id = db.Column(db.Integer, db.ForeignKey('partner.id'), nullable=True, index=True)
     total_amount = db.Column(db.Float, default=0)
+    total_cost = db.Column(db.Float, default=0) # Sum of detail quantity x unit_cost, captured when written
     payment_method = db.Column(db.String(50)) # 'Cash', 'Debt', etc.
     type = db.Column(db.String(20), index=True) # 'Sale' or 'Purchase'
     note = db.Column(db.String(500))
@@ -158,6 +169,15 @@ class Order(db.Model):
     old_debt = db.Column(db.Float, default=0)
     display_id = db.Column(db.String(50), index=True)
     status = db.Column(db.String(20), default='Pending', index=True) # 'Pending', 'Completed'
+    is_opening_balance = db.Column(db.Boolean, default=False, nullable=False) # Nợ đầu kỳ (NODAU)
+    location_id = db.Column(db.Integer, db.ForeignKey('location.id'), nullable=True) # NULL = default location
+    shift_id = db.Column(db.Integer, db.ForeignKey('shift.id'), nullable=True, index=True)
+
+    __table_args__ = (
+        # Hot paths (History, Dashboard, Reports) filter on type + opening flag and range on date
+        db.Index('ix_order_type_opening_date', 'type', 'is_opening_balance', 'date'),
+        db.Index('ix_order_partner_opening_date', 'partner_id', 'is_opening_balance', 'date'),
+    )
     
     partner = db.relationship('Partner', backref=db.backref('orders', lazy='selectin'))
     details = db.relationship('OrderDetail', backref='order', cascade='all, delete-orphan', lazy='selectin')
@@ -172,12 +192,16 @@ class Order(db.Model):
             'partner_address': self.partner.address if self.partner else '',
             'partner_phone': self.partner.phone if self.partner else '',
             'total_amount': self.total_amount,
+            'total_cost': self.total_cost,
             'amount_paid': self.amount_paid,
             'payment_method': self.payment_method,
             'type': self.type,
             'note': self.note,
             'old_debt': self.old_debt,
             'status': self.status,
+            'is_opening_balance': bool(self.is_opening_balance),
+            'location_id': self.location_id,
+            'shift_id': self.shift_id,
             'details': [d.to_dict() for d in self.details]
         }
 
@@ -188,6 +212,13 @@ class OrderDetail(db.Model):
     product_name_override = db.Column(db.String(200)) # To store custom spec/name
     quantity = db.Column(db.Integer, nullable=False)
     price = db.Column(db.Float, nullable=False)
+    # Snapshots taken when the order is written, so history does not drift with the product
+    unit_cost = db.Column(db.Float) # Sale: avg cost (combos exploded), Purchase: purchase price
+    product_name = db.Column(db.String(200))
+    product_unit = db.Column(db.String(20))
+    # Purchase lines: the lot received (Số lô / Hạn dùng); empty means the product's default expiry
+    lot_code = db.Column(db.String(50))
+    lot_expiry = db.Column(db.Date)
 
     product = db.relationship('Product', lazy='selectin')
 
@@ -196,13 +227,15 @@ class OrderDetail(db.Model):
         return {
             'id': self.id,
             'product_id': self.product_id,
-            'product_name': self.product_name_override or (self.product.name if self.product else 'Sản phẩm đã xóa'),
-            'product_unit': self.product.unit if self.product else 'ĐV',
+            'product_name': self.product_name_override or self.product_name or (self.product.name if self.product else 'Sản phẩm đã xóa'),
+            'product_unit': self.product_unit or (self.product.unit if self.product else 'ĐV'),
             'secondary_unit': self.product.secondary_unit if self.product else '',
             'multiplier': self.product.multiplier if self.product else 1,
             'quantity': self.quantity,
             'price': self.price,
-            'cost_price': p_dict.get('cost_price', 0),
+            'lot_code': self.lot_code,
+            'lot_expiry': self.lot_expiry.isoformat() if self.lot_expiry else None,
+            'cost_price': self.unit_cost if self.unit_cost is not None else p_dict.get('avg_cost', 0),
             'stock': p_dict.get('current_stock', 0),
             'active_ingredient': p_dict.get('active_ingredient', ''),
             'is_combo': self.product.is_combo if self.product else False,
@@ -259,6 +292,7 @@ class BankAccount(db.Model):
     account_number = db.Column(db.String(50), nullable=False)
     account_holder = db.Column(db.String(100))
     balance = db.Column(db.Float, default=0)
+    opening_balance = db.Column(db.Float, default=0) # balance not explained by transactions
     created_at = db.Column(db.DateTime, default=utc_now)
 
     def to_dict(self):
@@ -280,11 +314,17 @@ class BankTransaction(db.Model):
     note = db.Column(db.String(500))
     partner_id = db.Column(db.Integer, db.ForeignKey('partner.id'), nullable=True) # Optional link to partner
     order_id = db.Column(db.Integer, db.ForeignKey('order.id'), nullable=True)
+    balance_after = db.Column(db.Float) # account balance after this row in (date, id) order
+    shift_id = db.Column(db.Integer, db.ForeignKey('shift.id'), nullable=True, index=True)
     
     account = db.relationship('BankAccount', backref=db.backref('transactions', cascade='all, delete-orphan'))
     partner = db.relationship('Partner')
     order = db.relationship('Order')
 
+    __table_args__ = (
+        db.Index('ix_bank_transaction_account_date', 'account_id', 'date', 'id'),
+    )
+
     def to_dict(self):
         return {
             'id': self.id,
@@ -295,5 +335,416 @@ class BankTransaction(db.Model):
             'type': self.type,
             'note': self.note,
             'partner_name': self.partner.name if self.partner else None,
+            'order_id': self.order_id,
+            'balance_after': self.balance_after,
+            'shift_id': self.shift_id
+        }
+
+class StockMovement(db.Model):
+    # Append-only inventory journal: one row per stock change, never updated in place.
+    # Reversals (deleted / edited orders) are written as new rows with reversal=True.
+    id = db.Column(db.Integer, primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    date = db.Column(db.DateTime, default=utc_now, nullable=False)
+    quantity = db.Column(db.Float, nullable=False) # + in / - out
+    kind = db.Column(db.String(20), nullable=False) # 'Sale', 'Purchase', 'Edit', 'Import', 'Stocktake', 'Opening'
+    reversal = db.Column(db.Boolean, default=False)
+    order_id = db.Column(db.Integer, nullable=True) # No FK: history must survive order deletion
+    ref = db.Column(db.String(50)) # Order display_id at the time of posting
+    partner_name = db.Column(db.String(100))
+    combo_id = db.Column(db.Integer, nullable=True) # Set when exploded from a combo sale
+    price = db.Column(db.Float, default=0)
+    note = db.Column(db.String(200))
+    location_id = db.Column(db.Integer, nullable=True) # NULL = default location
+
+    product = db.relationship('Product')
+
+    __table_args__ = (
+        db.Index('ix_stock_movement_product_date', 'product_id', 'date', 'id'),
+        db.Index('ix_stock_movement_kind_date', 'kind', 'date'), # sales velocity / turnover windows
+    )
+
+    KIND_LABELS = {
+        'Sale': 'Bán hàng',
+        'Purchase': 'Nhập hàng',
+        'Edit': 'Sửa tồn kho',
+        'Import': 'Nhập Excel',
+        'Stocktake': 'Kiểm kho',
+        'Opening': 'Tồn đầu kỳ',
+        'Transfer': 'Chuyển kho'
+    }
+
+    def to_dict(self):
+        label = self.KIND_LABELS.get(self.kind, self.kind)
+        if self.combo_id:
+            label = f"{'Bán' if self.kind == 'Sale' else 'Nhập'} Combo ({self.note})"
+        if self.reversal:
+            label = f"Hoàn tác - {label}"
+        return {
+            'id': self.id,
+            'date': self.date.isoformat(),
+            'display_id': self.ref,
+            'order_id': self.order_id,
+            'partner_name': self.partner_name,
+            'type': label,
+            'kind': self.kind,
+            'reversal': bool(self.reversal),
+            'quantity_change': self.quantity,
+            'price': self.price,
+            'location_id': self.location_id
+        }
+
+class StockCheckpoint(db.Model):
+    # Month-end stock snapshot per product, built from StockMovement.
+    # Stock at any date = nearest checkpoint + movements since (at most one month).
+    id = db.Column(db.Integer, primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    period_end = db.Column(db.Date, nullable=False) # Last day of the month
+    quantity = db.Column(db.Float, default=0)
+
+    __table_args__ = (
+        db.UniqueConstraint('period_end', 'product_id', name='uq_stock_checkpoint_period_product'),
+    )
+
+class ProductLot(db.Model):
+    # One batch of a product with its own expiry. Sales consume lots first-expiry-first-out;
+    # the sum of a product's lots follows Product.stock.
+    id = db.Column(db.Integer, primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    lot_code = db.Column(db.String(50)) # Số lô
+    expiry_date = db.Column(db.Date) # Hạn dùng, NULL = không hạn (allocated last)
+    quantity = db.Column(db.Float, default=0)
+    received_date = db.Column(db.DateTime, default=utc_now)
+    order_id = db.Column(db.Integer, nullable=True) # Purchase that brought the lot in
+
+    product = db.relationship('Product')
+
+    __table_args__ = (
+        db.Index('ix_product_lot_product_expiry', 'product_id', 'expiry_date'),
+    )
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'product_id': self.product_id,
+            'product_name': self.product.name if self.product else None,
+            'lot_code': self.lot_code,
+            'expiry_date': self.expiry_date.isoformat() if self.expiry_date else None,
+            'quantity': self.quantity,
+            'received_date': self.received_date.isoformat() if self.received_date else None,
             'order_id': self.order_id
         }
+
+class LotAllocation(db.Model):
+    # What an order did to each lot (- consumed, + received), so deleting or editing
+    # the order puts exactly those quantities back.
+    id = db.Column(db.Integer, primary_key=True)
+    order_id = db.Column(db.Integer, nullable=False, index=True)
+    lot_id = db.Column(db.Integer, db.ForeignKey('product_lot.id'), nullable=False)
+    product_id = db.Column(db.Integer, nullable=False)
+    quantity = db.Column(db.Float, nullable=False)
+
+    lot = db.relationship('ProductLot')
+
+class Location(db.Model):
+    # Kho / cửa hàng. Exactly one is the default: orders and stock edits without a location land there.
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)
+    is_default = db.Column(db.Boolean, default=False)
+    note = db.Column(db.String(200))
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'is_default': bool(self.is_default),
+            'note': self.note
+        }
+
+class LocationStock(db.Model):
+    # Stock of one product at one location; Product.stock is the maintained total of these rows.
+    id = db.Column(db.Integer, primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    location_id = db.Column(db.Integer, db.ForeignKey('location.id'), nullable=False)
+    quantity = db.Column(db.Float, default=0)
+
+    product = db.relationship('Product')
+
+    __table_args__ = (
+        db.UniqueConstraint('product_id', 'location_id', name='uq_location_stock_product_location'),
+    )
+
+class StockTransfer(db.Model):
+    # Phiếu chuyển kho
+    id = db.Column(db.Integer, primary_key=True)
+    display_id = db.Column(db.String(50))
+    date = db.Column(db.DateTime, default=utc_now, index=True)
+    from_location_id = db.Column(db.Integer, db.ForeignKey('location.id'), nullable=False)
+    to_location_id = db.Column(db.Integer, db.ForeignKey('location.id'), nullable=False)
+    note = db.Column(db.String(500))
+
+    from_location = db.relationship('Location', foreign_keys=[from_location_id])
+    to_location = db.relationship('Location', foreign_keys=[to_location_id])
+    items = db.relationship('StockTransferItem', backref='transfer', cascade='all, delete-orphan', lazy='selectin')
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'display_id': self.display_id or str(self.id),
+            'date': self.date.isoformat(),
+            'from_location_id': self.from_location_id,
+            'from_location_name': self.from_location.name if self.from_location else None,
+            'to_location_id': self.to_location_id,
+            'to_location_name': self.to_location.name if self.to_location else None,
+            'note': self.note,
+            'items': [i.to_dict() for i in self.items]
+        }
+
+class StockTransferItem(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    transfer_id = db.Column(db.Integer, db.ForeignKey('stock_transfer.id'), nullable=False, index=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    quantity = db.Column(db.Float, nullable=False)
+
+    product = db.relationship('Product', lazy='selectin')
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'product_id': self.product_id,
+            'product_name': self.product.name if self.product else 'Sản phẩm đã xóa',
+            'product_unit': self.product.unit if self.product else '',
+            'quantity': self.quantity
+        }
+
+class Stocktake(db.Model):
+    # Phiếu kiểm kho: counts are collected while Draft, then applied once on finalize
+    id = db.Column(db.Integer, primary_key=True)
+    display_id = db.Column(db.String(50))
+    location_id = db.Column(db.Integer, db.ForeignKey('location.id'), nullable=False)
+    status = db.Column(db.String(20), default='Draft') # 'Draft', 'Completed'
+    note = db.Column(db.String(500))
+    created_at = db.Column(db.DateTime, default=utc_now)
+    completed_at = db.Column(db.DateTime)
+
+    location = db.relationship('Location')
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'display_id': self.display_id or str(self.id),
+            'location_id': self.location_id,
+            'location_name': self.location.name if self.location else None,
+            'status': self.status,
+            'note': self.note,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'completed_at': self.completed_at.isoformat() if self.completed_at else None
+        }
+
+class StocktakeLine(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    stocktake_id = db.Column(db.Integer, db.ForeignKey('stocktake.id'), nullable=False)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    counted = db.Column(db.Float, default=0)
+    # Frozen on finalize; while Draft the variance is computed live against LocationStock
+    system_qty = db.Column(db.Float)
+    variance = db.Column(db.Float)
+
+    __table_args__ = (
+        db.UniqueConstraint('stocktake_id', 'product_id', name='uq_stocktake_line_product'),
+    )
+
+class PartnerLedgerEntry(db.Model):
+    # Sổ chi tiết công nợ: one row per Debt order / voucher, written by the Posting.
+    # balance_after is the running balance in (date, id) order, kept current on back-dated writes.
+    id = db.Column(db.Integer, primary_key=True)
+    partner_id = db.Column(db.Integer, db.ForeignKey('partner.id'), nullable=False)
+    date = db.Column(db.DateTime, nullable=False)
+    source = db.Column(db.String(10), nullable=False) # 'Order', 'Voucher'
+    order_id = db.Column(db.Integer, nullable=True, index=True) # No FK: rows are removed with their document
+    voucher_id = db.Column(db.Integer, nullable=True, index=True)
+    ref = db.Column(db.String(50))
+    description = db.Column(db.String(500))
+    amount = db.Column(db.Float, default=0) # + partner owes more, - partner owes less
+    balance_after = db.Column(db.Float, default=0)
+
+    __table_args__ = (
+        db.Index('ix_partner_ledger_partner_date', 'partner_id', 'date', 'id'),
+    )
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'date': self.date.isoformat(),
+            'ref_id': self.ref,
+            'desc': self.description,
+            'type': self.source,
+            'order_id': self.order_id,
+            'voucher_id': self.voucher_id,
+            'amount': self.amount,
+            'increase': self.amount if self.amount > 0 else 0,
+            'decrease': -self.amount if self.amount < 0 else 0,
+            'running_balance': self.balance_after
+        }
+
+class PartnerDebtCycle(db.Model):
+    # Kỳ công nợ: opens on the Debt order that moves the balance off zero, closes on the
+    # ledger entry that brings it back. Positions are (date, ledger entry id) pairs.
+    id = db.Column(db.Integer, primary_key=True)
+    partner_id = db.Column(db.Integer, db.ForeignKey('partner.id'), nullable=False)
+    start_date = db.Column(db.DateTime, nullable=False)
+    start_entry_id = db.Column(db.Integer, nullable=False)
+    end_date = db.Column(db.DateTime, nullable=True) # NULL while the debt is still open
+    end_entry_id = db.Column(db.Integer, nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_partner_debt_cycle_partner_start', 'partner_id', 'start_date', 'start_entry_id'),
+    )
+
+    def to_dict(self):
+        return {
+            'start_date': self.start_date.isoformat(),
+            'end_date': self.end_date.isoformat() if self.end_date else None,
+            'status': 'Đã tất toán' if self.end_date else 'Đang còn nợ'
+        }
+
+class CashDailyBalance(db.Model):
+    # Sổ quỹ tiền mặt checkpoint: cash in/out of one day and the closing balance after it.
+    # Kept current by the Posting; back-dated entries shift the closing of later days.
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, unique=True, nullable=False)
+    inflow = db.Column(db.Float, default=0)
+    outflow = db.Column(db.Float, default=0)
+    closing = db.Column(db.Float, default=0)
+
+    def to_dict(self):
+        return {
+            'day': self.day.isoformat(),
+            'inflow': self.inflow,
+            'outflow': self.outflow,
+            'closing': self.closing
+        }
+
+class FinancePeriodTotal(db.Model):
+    # Monthly totals behind the P&L / cash-flow statement, kept current by the Posting.
+    # metric: revenue, cogs, purchases, other_income, expense:<voucher type>,
+    # cash_in, cash_out, bank_in, bank_out
+    id = db.Column(db.Integer, primary_key=True)
+    period = db.Column(db.String(7), nullable=False) # 'YYYY-MM'
+    metric = db.Column(db.String(50), nullable=False)
+    amount = db.Column(db.Float, default=0)
+
+    __table_args__ = (
+        db.UniqueConstraint('period', 'metric', name='uq_finance_period_metric'),
+    )
+
+class Shift(db.Model):
+    # Ca thu ngân: opened with a cash float by one user on one terminal. Orders, vouchers and
+    # bank transactions created while it is open point to it; the totals below are kept
+    # current by the Posting, so the X/Z report is a read of this row.
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer) # no FK: users are kept out of backup/restore
+    cashier = db.Column(db.String(100)) # display name when the shift was opened
+    terminal = db.Column(db.String(50))
+    opened_at = db.Column(db.DateTime, default=utc_now)
+    closed_at = db.Column(db.DateTime, nullable=True) # NULL = open
+    opening_float = db.Column(db.Float, default=0)
+    counted_cash = db.Column(db.Float, nullable=True)
+    note = db.Column(db.String(500))
+
+    sales_count = db.Column(db.Integer, default=0)
+    sales_cash = db.Column(db.Float, default=0)
+    sales_transfer = db.Column(db.Float, default=0)
+    sales_debt = db.Column(db.Float, default=0)
+    sales_other = db.Column(db.Float, default=0) # 'Pending' and anything else
+    purchases = db.Column(db.Float, default=0)
+    cash_in = db.Column(db.Float, default=0)
+    cash_out = db.Column(db.Float, default=0)
+    bank_in = db.Column(db.Float, default=0)
+    bank_out = db.Column(db.Float, default=0)
+
+    __table_args__ = (
+        db.Index('ix_shift_terminal_closed', 'terminal', 'closed_at'),
+    )
+
+    @property
+    def expected_cash(self):
+        return (self.opening_float or 0) + (self.cash_in or 0) - (self.cash_out or 0)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'user_id': self.user_id,
+            'cashier': self.cashier,
+            'terminal': self.terminal,
+            'opened_at': self.opened_at.isoformat(),
+            'closed_at': self.closed_at.isoformat() if self.closed_at else None,
+            'status': 'Đã đóng' if self.closed_at else 'Đang mở',
+            'opening_float': self.opening_float or 0,
+            'note': self.note,
+            'sales_count': self.sales_count or 0,
+            'sales': {
+                'Cash': self.sales_cash or 0,
+                'Transfer': self.sales_transfer or 0,
+                'Debt': self.sales_debt or 0,
+                'Other': self.sales_other or 0,
+                'total': (self.sales_cash or 0) + (self.sales_transfer or 0) + (self.sales_debt or 0) + (self.sales_other or 0)
+            },
+            'purchases': self.purchases or 0,
+            'cash_in': self.cash_in or 0,
+            'cash_out': self.cash_out or 0,
+            'bank_in': self.bank_in or 0,
+            'bank_out': self.bank_out or 0,
+            'expected_cash': self.expected_cash,
+            'counted_cash': self.counted_cash,
+            'difference': self.counted_cash - self.expected_cash if self.counted_cash is not None else None
+        }
+
+class SalesHourly(db.Model):
+    # Order-level rollup per hour and order type (opening balances excluded), kept current by the
+    # Posting. Day / week / month series and the dashboard sum these rows instead of orders.
+    id = db.Column(db.Integer, primary_key=True)
+    hour = db.Column(db.DateTime, nullable=False) # start of the hour
+    type = db.Column(db.String(20), nullable=False) # 'Sale' or 'Purchase'
+    revenue = db.Column(db.Float, default=0) # order totals
+    cost = db.Column(db.Float, default=0) # captured total_cost
+    quantity = db.Column(db.Float, default=0)
+    order_count = db.Column(db.Integer, default=0)
+
+    __table_args__ = (
+        db.UniqueConstraint('hour', 'type', name='uq_sales_hourly_hour_type'),
+    )
+
+class ProductSalesDaily(db.Model):
+    # Same rollup per day and product (brand is taken from the product when read).
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, nullable=False)
+    type = db.Column(db.String(20), nullable=False)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False, index=True)
+    revenue = db.Column(db.Float, default=0)
+    cost = db.Column(db.Float, default=0)
+    quantity = db.Column(db.Float, default=0)
+    order_count = db.Column(db.Integer, default=0) # orders with this product
+
+    __table_args__ = (
+        db.UniqueConstraint('day', 'type', 'product_id', name='uq_product_sales_daily'),
+    )
+
+class DashboardCounter(db.Model):
+    # Dashboard KPIs (receivable, payable, low_stock, expired, near_expiry) kept current on write.
+    # A missing row means "unknown": the dashboard recomputes it on its next read.
+    id = db.Column(db.Integer, primary_key=True)
+    key = db.Column(db.String(50), unique=True, nullable=False)
+    value = db.Column(db.Float, default=0)
+    as_of = db.Column(db.Date, nullable=True) # day the expiry counts refer to
+
+class ReconcileDirty(db.Model):
+    # Partners / bank accounts / products whose stored totals were written since the last
+    # reconcile run; incremental reconcile checks exactly these. Duplicates are harmless.
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20), nullable=False) # 'partner', 'bank', 'product'
+    entity_id = db.Column(db.Integer, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_reconcile_dirty_kind_entity', 'kind', 'entity_id'),
+    )
@@ -0,0 +1,43 @@
+import os
+import sys
+import tempfile
+
+import pytest
+from sqlalchemy import event
+
+# The app connects at import time: point it at a throw-away SQLite file first
+_db_dir = tempfile.mkdtemp(prefix='lyangpos-test-')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(_db_dir, 'test.db')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as lyang  # noqa: E402
+
+
+@pytest.fixture
+def client():
+    c = lyang.app.test_client()
+    r = c.post('/api/reset-database', json={'password': 'admin.reset'})
+    assert r.status_code == 200, r.get_data(as_text=True)
+    yield c
+    with lyang.app.app_context():
+        lyang.db.session.remove()
+
+
+@pytest.fixture
+def ok():
+    def check(response, codes=(200, 201)):
+        assert response.status_code in codes, (response.status_code, response.get_data(as_text=True)[:500])
+        return response.json
+    return check
+
+
+@pytest.fixture
+def sql():
+    """Statements run against the database while the test holds this list."""
+    statements = []
+    with lyang.app.app_context():
+        engine = lyang.db.engine
+    listener = lambda conn, cursor, statement, *args: statements.append(statement)
+    event.listen(engine, 'before_cursor_execute', listener)
+    yield statements
+    event.remove(engine, 'before_cursor_execute', listener)
@@ -0,0 +1,18 @@
+from conftest import lyang
+
+
+def aging(client, ok):
+    return {r['partner_id']: (r['name'], r['total']) for r in ok(client.get('/api/reports/debt-aging'))['items']}
+
+
+def test_aging_follows_a_partner_merge(client, ok):
+    product = ok(client.post('/api/products', json={'name': 'A', 'stock': 10, 'sale_price': 20}))
+    target = ok(client.post('/api/partners', json={'name': 'A'}))
+    source = ok(client.post('/api/partners', json={'name': 'B'}))
+    for partner in (target, source):
+        ok(client.post('/api/orders', json={'partner_id': partner['id'], 'type': 'Sale', 'payment_method': 'Debt',
+                                             'details': [{'product_id': product['id'], 'quantity': 1, 'price': 20}]}))
+    assert aging(client, ok) == {target['id']: ('A', 20), source['id']: ('B', 20)}
+
+    ok(client.post('/api/partners/merge', json={'target_id': target['id'], 'source_ids': [source['id']]}))
+    assert aging(client, ok) == {target['id']: ('A', 40)}
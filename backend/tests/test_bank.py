@@ -0,0 +1,62 @@
+import io
+from datetime import timedelta
+
+from conftest import lyang
+
+
+def test_statement_pages_by_cursor_with_running_balances(client, ok):
+    account = ok(client.post('/api/bank-accounts', json={'bank_name': 'VCB', 'account_number': '1', 'balance': 1000}))
+    for amount, t_type in ((100, 'Deposit'), (50, 'Withdrawal'), (200, 'Deposit'), (30, 'Withdrawal'), (10, 'Deposit')):
+        ok(client.post('/api/bank-transactions', json={'account_id': account['id'], 'amount': amount, 'type': t_type}))
+    start = lyang.get_vn_time().replace(hour=9, minute=0, second=0, microsecond=0) - timedelta(days=5)
+    with lyang.app.app_context():
+        # Spread over days in posting order (the running balances stay valid); the last two share a timestamp
+        for i, t in enumerate(lyang.BankTransaction.query.order_by(lyang.BankTransaction.id)):
+            t.date = start + timedelta(days=min(i, 3))
+        lyang.db.session.commit()
+
+    seen, cursor = [], None
+    while True:
+        page = ok(client.get(f"/api/bank-accounts/{account['id']}/statement", query_string={'limit': 2, **({'cursor': cursor} if cursor else {})}))
+        seen += [(t['amount'], t['balance_after']) for t in page['items']]
+        cursor = page['next_cursor']
+        if not cursor:
+            break
+    assert seen == [(10, 1230), (30, 1220), (200, 1250), (50, 1050), (100, 1100)]
+    assert page['balance'] == 1230
+
+    as_of = lambda day: ok(client.get(f"/api/bank-accounts/{account['id']}/statement",
+                                      query_string={'limit': 1, 'as_of': (start + timedelta(days=day)).date().isoformat()}))['balance_as_of']
+    assert [as_of(-1), as_of(0), as_of(2), as_of(3)] == [1000, 1100, 1250, 1230]
+
+
+def test_statement_import_matches_by_amount_date_and_reference(client, ok):
+    account = ok(client.post('/api/bank-accounts', json={'bank_name': 'VCB', 'account_number': '1', 'balance': 0}))
+    product = ok(client.post('/api/products', json={'name': 'A', 'stock': 10, 'sale_price': 300}))
+    order = ok(client.post('/api/orders', json={'type': 'Sale', 'payment_method': 'Transfer', 'bank_account_id': account['id'],
+                                                'details': [{'product_id': product['id'], 'quantity': 1, 'price': 300}]}))
+    first, second = (ok(client.post('/api/bank-transactions', json={'account_id': account['id'], 'amount': 500, 'type': 'Deposit'}))
+                     for _ in range(2))
+    today = lyang.get_vn_time().date()
+    statement = '\n'.join([
+        'Ngày,Số tiền,Nội dung',
+        f"{today.isoformat()},300,CK thanh toan {order['display_id']}",
+        f"{today.isoformat()},500,Nop tien",
+        f"{today.isoformat()},500,Nop tien #{second['id']}",
+        f"{today.isoformat()},-200,Rut tien",
+        f"{(today - timedelta(days=10)).isoformat()},300,Khach chuyen",
+    ])
+    upload = lambda **form: ok(client.post(f"/api/bank-accounts/{account['id']}/statement/import", content_type='multipart/form-data',
+                                           data={'file': (io.BytesIO(statement.encode()), 'sao_ke.csv'), **form}))
+
+    result = upload()
+    with lyang.app.app_context():
+        order_tx = lyang.BankTransaction.query.filter_by(order_id=order['id']).one().id
+    assert sorted((m['row'], m['transaction_id']) for m in result['matched']) == [(2, order_tx), (4, second['id'])]
+    assert [(a['row'], a['candidates']) for a in result['ambiguous']] == [(3, [first['id'], second['id']])]
+    assert sorted(u['row'] for u in result['unmatched']) == [5, 6] # no such withdrawal; outside the date window
+    assert result['created'] == 0
+
+    assert upload(create_missing='true')['created'] == 2
+    with lyang.app.app_context():
+        assert lyang.db.session.get(lyang.BankAccount, account['id']).balance == 300 + 1000 - 200 + 300
@@ -0,0 +1,50 @@
+from datetime import timedelta
+
+from conftest import lyang
+
+
+def assert_counters_fresh():
+    with lyang.app.app_context():
+        stored = {r.key: r.value for r in lyang.DashboardCounter.query}
+        fresh = {**lyang.debt_kpis(), **lyang.low_stock_kpis(), **lyang.expiry_kpis()}
+        assert set(stored) == set(fresh)
+        assert all(abs(stored[key] - fresh[key]) < 1e-6 for key in fresh), (stored, fresh)
+
+
+def test_counters_follow_postings(client, ok):
+    product = ok(client.post('/api/products', json={'name': 'A', 'stock': 1, 'cost_price': 10, 'sale_price': 15, 'multiplier': 1}))
+    customer = ok(client.post('/api/partners', json={'name': 'K'}))
+    supplier = ok(client.post('/api/partners', json={'name': 'S', 'is_customer': False, 'is_supplier': True}))
+    ok(client.get('/api/dashboard-stats'))
+    today = lyang.get_vn_time().date()
+    line = lambda quantity, **lot: {'product_id': product['id'], 'quantity': quantity, 'price': 8, **lot}
+
+    purchase = ok(client.post('/api/orders', json={'type': 'Purchase', 'payment_method': 'Debt', 'partner_id': supplier['id'], 'details': [
+        line(2, lot_code='L1', lot_expiry=(today - timedelta(days=5)).isoformat()),
+        line(2, lot_code='L2', lot_expiry=(today - timedelta(days=2)).isoformat()),
+        line(3, lot_code='L3', lot_expiry=(today + timedelta(days=10)).isoformat())]}))
+    assert_counters_fresh()
+    # Drains the first expired lot only: the product stays expired
+    sale = ok(client.post('/api/orders', json={'type': 'Sale', 'payment_method': 'Debt', 'partner_id': customer['id'],
+                                                'details': [line(3)]}))
+    assert_counters_fresh()
+    # Drains the rest of the expired lots and part of the near one
+    ok(client.put(f"/api/orders/{sale['id']}", json={'type': 'Sale', 'payment_method': 'Debt', 'partner_id': customer['id'],
+                                                      'details': [line(6)]}))
+    assert_counters_fresh()
+    ok(client.post('/api/vouchers', json={'partner_id': customer['id'], 'amount': 100, 'type': 'Receipt'}))
+    assert_counters_fresh()
+    ok(client.delete(f"/api/orders/{sale['id']}"))
+    ok(client.delete(f"/api/orders/{purchase['id']}"))
+    assert_counters_fresh()
+
+
+def test_checkout_counts_nothing_for_the_dashboard(client, ok, sql):
+    product = ok(client.post('/api/products', json={'name': 'A', 'stock': 100, 'sale_price': 15}))
+    ok(client.get('/api/dashboard-stats'))
+    sql.clear()
+    ok(client.post('/api/orders', json={'type': 'Sale', 'payment_method': 'Cash',
+                                         'details': [{'product_id': product['id'], 'quantity': 1, 'price': 15}]}))
+    assert not [s for s in sql if 'count(' in s.lower() and 'product_lot' in s]
+    assert not [s for s in sql if 'dashboard_counter' in s]
+    assert_counters_fresh()
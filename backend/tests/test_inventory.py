@@ -0,0 +1,88 @@
+from datetime import timedelta
+
+from conftest import lyang
+
+
+def test_stock_as_of_reads_and_posting_closes_months(client, ok):
+    product = ok(client.post('/api/products', json={'name': 'A', 'stock': 10, 'sale_price': 20}))
+    last_month = lyang.get_vn_time().replace(day=1) - timedelta(days=3)
+    with lyang.app.app_context():
+        # The opening movement belongs to last month
+        lyang.StockMovement.query.filter_by(product_id=product['id']).update({'date': last_month})
+        lyang.db.session.commit()
+
+    as_of = ok(client.get('/api/inventory/stock-as-of', query_string={'date': last_month.date().isoformat()}))
+    assert as_of['items'][0]['stock'] == 10
+    with lyang.app.app_context():
+        assert lyang.StockCheckpoint.query.count() == 0
+
+    ok(client.post('/api/orders', json={'type': 'Sale', 'payment_method': 'Cash',
+                                         'details': [{'product_id': product['id'], 'quantity': 4, 'price': 20}]}))
+    with lyang.app.app_context():
+        checkpoint = lyang.StockCheckpoint.query.one()
+        assert (checkpoint.period_end, checkpoint.quantity) == (lyang.month_end(last_month.date()), 10)
+    today = ok(client.get('/api/inventory/stock-as-of'))
+    assert today['items'][0]['stock'] == 6
+
+
+def test_empty_month_still_closes(client, ok):
+    product = ok(client.post('/api/products', json={'name': 'A', 'stock': 5, 'sale_price': 20}))
+    ok(client.post('/api/orders', json={'type': 'Sale', 'payment_method': 'Cash',
+                                         'details': [{'product_id': product['id'], 'quantity': 5, 'price': 20}]}))
+    last_month = lyang.get_vn_time().replace(day=1) - timedelta(days=3)
+    with lyang.app.app_context():
+        # Stocked and sold out last month: every balance at its end is zero
+        lyang.StockMovement.query.update({'date': last_month})
+        lyang.db.session.commit()
+
+    ok(client.post('/api/orders', json={'type': 'Purchase', 'payment_method': 'Cash',
+                                         'details': [{'product_id': product['id'], 'quantity': 3, 'price': 10}]}))
+    with lyang.app.app_context():
+        checkpoint = lyang.StockCheckpoint.query.one()
+        assert (checkpoint.period_end, checkpoint.quantity) == (lyang.month_end(last_month.date()), 0)
+        assert not lyang.ensure_stock_checkpoints(lyang.get_vn_time().date())
+    as_of = ok(client.get('/api/inventory/stock-as-of', query_string={'date': last_month.date().isoformat()}))
+    assert as_of['items'][0]['stock'] == 0
+    assert ok(client.get('/api/inventory/stock-as-of'))['items'][0]['stock'] == 3
+
+
+def test_average_cost_blends_purchases_and_values_stock(client, ok):
+    product = ok(client.post('/api/products', json={'name': 'A', 'stock': 10, 'cost_price': 10, 'sale_price': 30}))
+    purchase = lambda quantity, price: ok(client.post('/api/orders', json={'type': 'Purchase', 'payment_method': 'Cash', 'details': [
+        {'product_id': product['id'], 'quantity': quantity, 'price': price}]}))
+    avg_cost = lambda: ok(client.get('/api/inventory/valuation'))['items'][0]['avg_cost']
+
+    late = purchase(10, 20)
+    assert avg_cost() == 15
+    ok(client.delete(f"/api/orders/{late['id']}")) # taking the lot back restores the old average
+    assert avg_cost() == 10
+
+    purchase(10, 20)
+    ok(client.post('/api/orders', json={'type': 'Sale', 'payment_method': 'Cash', 'details': [
+        {'product_id': product['id'], 'quantity': 5, 'price': 30}]}))
+    valuation = ok(client.get('/api/inventory/valuation'))
+    assert valuation['items'][0]['avg_cost'] == 15 # sales leave it unchanged
+    assert (valuation['total_quantity'], valuation['total_value']) == (15, 225)
+    with lyang.app.app_context():
+        assert lyang.db.session.get(lyang.Product, product['id']).cost_price == 20 # last purchase price, as before
+
+
+def test_transfer_moves_stock_between_locations(client, ok):
+    shop = ok(client.get('/api/locations'))[0]
+    store = ok(client.post('/api/locations', json={'name': 'Kho'}))
+    part = ok(client.post('/api/products', json={'name': 'A', 'stock': 10, 'cost_price': 1, 'sale_price': 2}))
+    ok(client.post('/api/products', json={'name': 'Kit', 'is_combo': True, 'sale_price': 5,
+                                          'combo_items': [{'product_id': part['id'], 'quantity': 2}]}))
+    stock_at = lambda location: {p['name']: p['stock'] for p in ok(client.get('/api/products', query_string={'location_id': location['id']}))}
+
+    transfer = ok(client.post('/api/stock-transfers', json={'from_location_id': shop['id'], 'to_location_id': store['id'],
+                                                            'items': [{'product_id': part['id'], 'quantity': 6}]}))
+    assert stock_at(shop) == {'A': 4, 'Kit': 2}
+    assert stock_at(store) == {'A': 6, 'Kit': 3}
+    with lyang.app.app_context():
+        assert lyang.db.session.get(lyang.Product, part['id']).stock == 10 # the total does not move
+        assert sorted(m.quantity for m in lyang.StockMovement.query.filter_by(kind='Transfer')) == [-6, 6]
+
+    ok(client.delete(f"/api/stock-transfers/{transfer['id']}"))
+    assert stock_at(shop) == {'A': 10, 'Kit': 5}
+    assert stock_at(store) == {'A': 0, 'Kit': 0}
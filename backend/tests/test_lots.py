@@ -0,0 +1,42 @@
+from datetime import timedelta
+
+from conftest import lyang
+
+
+def lots(client, ok, product):
+    return {l['lot_code']: l['quantity'] for l in ok(client.get(f"/api/products/{product['id']}/lots", query_string={'all': 'true'}))}
+
+
+def test_sales_draw_first_expiry_first_out(client, ok):
+    product = ok(client.post('/api/products', json={'name': 'A', 'stock': 0, 'cost_price': 10, 'sale_price': 20}))
+    today = lyang.get_vn_time().date()
+    receive = lambda code, days: {'product_id': product['id'], 'quantity': 5, 'price': 10, 'lot_code': code,
+                                  'lot_expiry': (today + timedelta(days=days)).isoformat() if days else None}
+    ok(client.post('/api/orders', json={'type': 'Purchase', 'payment_method': 'Cash', 'details': [
+        receive('LATE', 60), receive('NONE', None), receive('SOON', 10)]}))
+    sell = lambda quantity: {'type': 'Sale', 'payment_method': 'Cash', 'details': [{'product_id': product['id'], 'quantity': quantity, 'price': 20}]}
+
+    sale = ok(client.post('/api/orders', json=sell(7)))
+    assert lots(client, ok, product) == {'SOON': 0, 'LATE': 3, 'NONE': 5}
+    ok(client.put(f"/api/orders/{sale['id']}", json=sell(2))) # the edit gives the lots back first
+    assert lots(client, ok, product) == {'SOON': 3, 'LATE': 5, 'NONE': 5}
+    ok(client.delete(f"/api/orders/{sale['id']}"))
+    assert lots(client, ok, product) == {'SOON': 5, 'LATE': 5, 'NONE': 5}
+
+
+def test_removing_a_partly_sold_receipt_takes_the_rest_elsewhere(client, ok):
+    product = ok(client.post('/api/products', json={'name': 'A', 'stock': 0, 'cost_price': 10, 'sale_price': 20}))
+    soon = (lyang.get_vn_time().date() + timedelta(days=5)).isoformat()
+    purchase = lambda code, expiry: ok(client.post('/api/orders', json={'type': 'Purchase', 'payment_method': 'Cash', 'details': [
+        {'product_id': product['id'], 'quantity': 4, 'price': 10, 'lot_code': code, 'lot_expiry': expiry}]}))
+    purchase('OLD', None)
+    fresh = purchase('NEW', soon)
+    ok(client.post('/api/orders', json={'type': 'Sale', 'payment_method': 'Cash', 'details': [
+        {'product_id': product['id'], 'quantity': 3, 'price': 20}]}))
+    assert lots(client, ok, product) == {'NEW': 1, 'OLD': 4}
+
+    ok(client.delete(f"/api/orders/{fresh['id']}"))
+    assert lots(client, ok, product) == {'NEW': 0, 'OLD': 1}
+    with lyang.app.app_context():
+        assert lyang.db.session.get(lyang.Product, product['id']).stock == 1
+        assert lyang.LotAllocation.query.count() == 2 # the old receipt and the sale
@@ -0,0 +1,93 @@
+from conftest import lyang
+
+
+def test_merge_adds_balances_and_keeps_string_target(client, ok):
+    target = ok(client.post('/api/partners', json={'name': 'A'}))
+    source = ok(client.post('/api/partners', json={'name': 'B', 'debt_balance': 40}))
+    # Debt entered by hand, outside any order or voucher
+    ok(client.put(f"/api/partners/{target['id']}", json={'debt_balance': 100}))
+
+    merged = ok(client.post('/api/partners/merge', json={'target_id': str(target['id']), 'source_ids': [source['id']]}))
+    assert merged['partner']['id'] == target['id'] and merged['merged'] == 1
+    assert merged['partner']['debt_balance'] == 140
+    with lyang.app.app_context():
+        assert lyang.db.session.get(lyang.Partner, target['id']).debt_balance == 140
+        assert lyang.db.session.get(lyang.Partner, source['id']) is None
+        assert lyang.Order.query.filter_by(partner_id=target['id']).count() == 1
+
+
+def test_merge_rejects_target_among_sources(client, ok):
+    target = ok(client.post('/api/partners', json={'name': 'A'}))
+    source = ok(client.post('/api/partners', json={'name': 'B'}))
+    ok(client.post('/api/partners/merge', json={'target_id': str(target['id']), 'source_ids': [source['id'], target['id']]}), (400,))
+    with lyang.app.app_context():
+        assert lyang.Partner.query.count() == 2
+
+
+def test_merge_moves_ledger_and_refreshes_reports(client, ok):
+    product = ok(client.post('/api/products', json={'name': 'SP', 'stock': 10, 'sale_price': 20}))
+    target = ok(client.post('/api/partners', json={'name': 'A'}))
+    source = ok(client.post('/api/partners', json={'name': 'B'}))
+    for partner in (target, source):
+        ok(client.post('/api/orders', json={'partner_id': partner['id'], 'type': 'Sale', 'payment_method': 'Debt',
+                                             'details': [{'product_id': product['id'], 'quantity': 1, 'price': 20}]}))
+    ok(client.post('/api/vouchers', json={'partner_id': source['id'], 'amount': 5, 'type': 'Receipt'}))
+    # Fill the report caches before the merge
+    ok(client.get('/api/reports/debt-aging'))
+    ok(client.get('/api/reports/customer-rfm'))
+
+    merged = ok(client.post('/api/partners/merge', json={'target_id': target['id'], 'source_ids': [source['id']]}))
+    assert (merged['partner']['id'], merged['partner']['name'], merged['partner']['debt_balance']) == (target['id'], 'A', 35)
+    with lyang.app.app_context():
+        entries = lyang.PartnerLedgerEntry.query.order_by(lyang.PartnerLedgerEntry.date, lyang.PartnerLedgerEntry.id).all()
+        assert {e.partner_id for e in entries} == {target['id']} and len(entries) == 3
+        assert entries[-1].balance_after == 35
+        assert lyang.db.session.get(lyang.Partner, target['id']).debt_balance == 35
+
+    aging = ok(client.get('/api/reports/debt-aging'))['items']
+    assert [(r['partner_id'], r['total']) for r in aging] == [(target['id'], 35)]
+    rfm = ok(client.get('/api/reports/customer-rfm'))['items']
+    assert [(r['partner_id'], r['frequency']) for r in rfm] == [(target['id'], 2)]
+
+
+def _debt_orders(client, ok, partner, totals, order_type='Sale'):
+    product = ok(client.post('/api/products', json={'name': f'SP-{order_type}', 'stock': 100, 'cost_price': 1, 'sale_price': 1}))
+    return [ok(client.post('/api/orders', json={'type': order_type, 'payment_method': 'Debt', 'partner_id': partner['id'],
+                                                'details': [{'product_id': product['id'], 'quantity': 1, 'price': total}]}))
+            for total in totals]
+
+
+def test_settle_pays_oldest_first_and_keeps_the_rest(client, ok):
+    customer = ok(client.post('/api/partners', json={'name': 'KH'}))
+    first, second, third = _debt_orders(client, ok, customer, (50, 30, 40))
+
+    result = ok(client.post(f"/api/partners/{customer['id']}/settle", json={'amount': 65}), (201,))
+    assert [(o['id'], o['paid'], o['status']) for o in result['orders']] == [(first['id'], 50, 'Completed'), (second['id'], 15, 'Pending')]
+    assert (result['unallocated'], result['debt_balance']) == (0, 55)
+
+    # Overpaying closes every open order and leaves the surplus as an unlinked voucher
+    result = ok(client.post(f"/api/partners/{customer['id']}/settle", json={'amount': 60}), (201,))
+    assert [(o['id'], o['paid']) for o in result['orders']] == [(second['id'], 15), (third['id'], 40)]
+    assert (result['unallocated'], result['debt_balance']) == (5, -5)
+    with lyang.app.app_context():
+        vouchers = lyang.CashVoucher.query.filter_by(source='settlement').order_by(lyang.CashVoucher.id).all()
+        assert [(v.order_id, v.amount) for v in vouchers] == [
+            (first['id'], 50), (second['id'], 15), (second['id'], 15), (third['id'], 40), (None, 5)]
+        assert all(o.amount_paid == o.total_amount for o in lyang.Order.query)
+
+
+def test_settle_selected_orders_and_supplier_payments(client, ok):
+    customer = ok(client.post('/api/partners', json={'name': 'KH'}))
+    supplier = ok(client.post('/api/partners', json={'name': 'NCC', 'is_supplier': True, 'is_customer': False}))
+    old, new = _debt_orders(client, ok, customer, (50, 30))
+    purchase, = _debt_orders(client, ok, supplier, (80,), 'Purchase')
+
+    result = ok(client.post(f"/api/partners/{customer['id']}/settle", json={'amount': 30, 'order_ids': [new['id']]}), (201,))
+    assert [(o['id'], o['status']) for o in result['orders']] == [(new['id'], 'Completed')]
+    # A receipt never settles purchases; the supplier is paid with type=Payment
+    assert ok(client.post(f"/api/partners/{supplier['id']}/settle", json={'amount': 10}), (201,))['orders'] == []
+    result = ok(client.post(f"/api/partners/{supplier['id']}/settle", json={'amount': 30, 'type': 'Payment'}), (201,))
+    assert [(o['id'], o['amount_paid']) for o in result['orders']] == [(purchase['id'], 30)]
+    ok(client.post(f"/api/partners/{customer['id']}/settle", json={'amount': 0}), (400,))
+    with lyang.app.app_context():
+        assert lyang.db.session.get(lyang.Order, old['id']).amount_paid in (0, None)
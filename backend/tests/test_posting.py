@@ -0,0 +1,58 @@
+import pytest
+from sqlalchemy import event
+
+from conftest import lyang
+
+
+@pytest.fixture
+def commits():
+    """Transactions committed while the test holds this list."""
+    done = []
+    with lyang.app.app_context():
+        engine = lyang.db.engine
+    listener = lambda conn: done.append(conn)
+    event.listen(engine, 'commit', listener)
+    yield done
+    event.remove(engine, 'commit', listener)
+
+
+def test_each_action_commits_once(client, ok, sql, commits):
+    product = ok(client.post('/api/products', json={'name': 'A', 'stock': 100, 'cost_price': 10, 'sale_price': 20}))
+    customer = ok(client.post('/api/partners', json={'name': 'KH'}))
+    bank = ok(client.post('/api/bank-accounts', json={'bank_name': 'VCB', 'account_number': '1', 'balance': 0}))
+    line = [{'product_id': product['id'], 'quantity': 5, 'price': 20}]
+
+    # (partner balance UPDATEs, action)
+    actions = [
+        (1, lambda: client.post('/api/orders', json={'type': 'Sale', 'payment_method': 'Debt', 'partner_id': customer['id'],
+                                                     'amount_paid': 30, 'details': line})),
+        (0, lambda: client.post('/api/orders', json={'type': 'Sale', 'payment_method': 'Transfer', 'partner_id': customer['id'],
+                                                     'bank_account_id': bank['id'], 'details': line})),
+        (1, lambda: client.post('/api/vouchers', json={'partner_id': customer['id'], 'amount': 20, 'type': 'Receipt'})),
+        (0, lambda: client.post('/api/bank-transactions', json={'account_id': bank['id'], 'amount': 15, 'type': 'Withdrawal'})),
+    ]
+    for partner_updates, action in actions:
+        sql.clear()
+        commits.clear()
+        ok(action())
+        assert len(commits) == 1
+        assert len([s for s in sql if s.startswith('UPDATE partner ')]) == partner_updates
+
+    with lyang.app.app_context():
+        assert lyang.db.session.get(lyang.Partner, customer['id']).debt_balance == 100 - 30 - 20
+        assert lyang.db.session.get(lyang.BankAccount, bank['id']).balance == 100 - 15
+        assert lyang.db.session.get(lyang.Product, product['id']).stock == 90
+
+
+def test_delete_reverses_in_one_commit(client, ok, commits):
+    product = ok(client.post('/api/products', json={'name': 'A', 'stock': 10, 'cost_price': 10, 'sale_price': 20}))
+    customer = ok(client.post('/api/partners', json={'name': 'KH'}))
+    order = ok(client.post('/api/orders', json={'type': 'Sale', 'payment_method': 'Debt', 'partner_id': customer['id'], 'amount_paid': 15,
+                                                'details': [{'product_id': product['id'], 'quantity': 2, 'price': 20}]}))
+    commits.clear()
+    ok(client.delete(f"/api/orders/{order['id']}"))
+    assert len(commits) == 1
+    with lyang.app.app_context():
+        assert lyang.db.session.get(lyang.Partner, customer['id']).debt_balance == 0
+        assert lyang.db.session.get(lyang.Product, product['id']).stock == 10
+        assert lyang.CashVoucher.query.count() == 0
@@ -0,0 +1,78 @@
+from conftest import lyang
+
+
+def test_deleting_settlement_voucher_keeps_order_debt(client, ok):
+    product = ok(client.post('/api/products', json={'name': 'A', 'stock': 10, 'cost_price': 10, 'sale_price': 20}))
+    customer = ok(client.post('/api/partners', json={'name': 'KH'}))
+    order = ok(client.post('/api/orders', json={
+        'partner_id': customer['id'], 'type': 'Sale', 'payment_method': 'Debt', 'amount_paid': 30,
+        'details': [{'product_id': product['id'], 'quantity': 5, 'price': 20}]}))
+    with lyang.app.app_context():
+        voucher = lyang.CashVoucher.query.filter_by(order_id=order['id'], source='settlement').one()
+        voucher_id = voucher.id
+    ok(client.delete(f'/api/vouchers/{voucher_id}'))
+
+    with lyang.app.app_context():
+        stored = lyang.db.session.get(lyang.Order, order['id'])
+        assert stored.payment_method == 'Debt'
+        assert stored.amount_paid == 0
+        assert lyang.db.session.get(lyang.Partner, customer['id']).debt_balance == 100
+
+    report = ok(client.post('/api/reconcile', json={}))
+    assert report['partners'] == [] and report['products'] == []
+    ok(client.post('/api/reconcile', json={'fix': True}))
+    with lyang.app.app_context():
+        assert lyang.db.session.get(lyang.Partner, customer['id']).debt_balance == 100
+
+
+def test_incremental_sees_direct_debt_edit(client, ok):
+    customer = ok(client.post('/api/partners', json={'name': 'KH'}))
+    ok(client.post('/api/reconcile', json={}))
+    ok(client.put(f"/api/partners/{customer['id']}", json={'debt_balance': 500}))
+
+    report = ok(client.post('/api/reconcile', json={'incremental': True}))
+    assert [p['id'] for p in report['partners']] == [customer['id']]
+    assert ok(client.post('/api/reconcile', json={'incremental': True}))['checked']['partners'] == 0
+
+
+def test_stock_fix_moves_locations_and_journal(client, ok):
+    product = ok(client.post('/api/products', json={'name': 'A', 'stock': 10, 'cost_price': 10, 'sale_price': 20}))
+    ok(client.post('/api/orders', json={'type': 'Sale', 'payment_method': 'Cash',
+                                         'details': [{'product_id': product['id'], 'quantity': 3, 'price': 20}]}))
+    with lyang.app.app_context():
+        # Drift every stored figure away from the order history
+        pid = product['id']
+        lyang.db.session.get(lyang.Product, pid).stock = 4
+        lyang.LocationStock.query.filter_by(product_id=pid).first().quantity = 5
+        lyang.db.session.add(lyang.StockMovement(product_id=pid, quantity=2, kind='Sale', order_id=999))
+        lyang.db.session.commit()
+
+    report = ok(client.post('/api/reconcile', json={'fix': True}))
+    assert [(p['stored'], p['expected']) for p in report['products']] == [(4, 7)]
+    with lyang.app.app_context():
+        db, pid = lyang.db, product['id']
+        total = lambda model: db.session.query(db.func.sum(model.quantity)).filter(model.product_id == pid).scalar()
+        assert lyang.db.session.get(lyang.Product, pid).stock == 7
+        assert total(lyang.LocationStock) == total(lyang.ProductLot) == total(lyang.StockMovement) == 7
+    assert ok(client.post('/api/reconcile', json={}))['products'] == []
+
+
+def test_legacy_pending_orders_keep_their_debt(client, ok):
+    product = ok(client.post('/api/products', json={'name': 'A', 'stock': 10, 'cost_price': 10, 'sale_price': 20}))
+    customer = ok(client.post('/api/partners', json={'name': 'KH'}))
+    order = ok(client.post('/api/orders', json={'partner_id': customer['id'], 'type': 'Sale', 'payment_method': 'Debt',
+                                                 'details': [{'product_id': product['id'], 'quantity': 5, 'price': 20}]}))
+    with lyang.app.app_context():
+        # What the old voucher delete left behind, before the ledger tables existed
+        stored = lyang.db.session.get(lyang.Order, order['id'])
+        stored.payment_method, stored.amount_paid = 'Pending', 0
+        lyang.PartnerDebtCycle.query.delete()
+        lyang.PartnerLedgerEntry.query.delete()
+        lyang.db.session.commit()
+
+    lyang.run_migrations()
+    ok(client.post('/api/reconcile', json={'fix': True}))
+    with lyang.app.app_context():
+        assert lyang.db.session.get(lyang.Order, order['id']).payment_method == 'Debt'
+        assert lyang.db.session.get(lyang.Partner, customer['id']).debt_balance == 100
+        assert lyang.PartnerLedgerEntry.query.filter_by(order_id=order['id']).one().amount == 100
@@ -0,0 +1,180 @@
+from datetime import timedelta
+
+from conftest import lyang
+
+
+def sale(client, ok, partner, product, amount, days_ago=0):
+    order = ok(client.post('/api/orders', json={
+        'type': 'Sale', 'payment_method': 'Cash', 'partner_id': partner['id'], 'amount_paid': amount,
+        'details': [{'product_id': product['id'], 'quantity': 1, 'price': amount}]}))
+    if days_ago:
+        # Orders are always dated now; age this one for the report only
+        with lyang.app.app_context():
+            stored = lyang.db.session.get(lyang.Order, order['id'])
+            stored.date -= timedelta(days=days_ago)
+            lyang.db.session.commit()
+    return order
+
+
+def rfm(client, ok):
+    return {r['partner_id']: r for r in ok(client.get('/api/reports/customer-rfm'))['items']}
+
+
+def test_rfm_single_recent_customer_is_not_churned(client, ok):
+    product = ok(client.post('/api/products', json={'name': 'A', 'stock': 100, 'sale_price': 10}))
+    customer = ok(client.post('/api/partners', json={'name': 'KH'}))
+    sale(client, ok, customer, product, 10)
+
+    row = rfm(client, ok)[customer['id']]
+    assert (row['r'], row['f'], row['m']) == (5, 5, 5)
+    assert row['segment'] == 'VIP'
+
+
+def test_rfm_ties_share_a_score(client, ok):
+    product = ok(client.post('/api/products', json={'name': 'A', 'stock': 100, 'sale_price': 10}))
+    customers = [ok(client.post('/api/partners', json={'name': f'KH{i}'})) for i in range(6)]
+    for i, customer in enumerate(customers):
+        sale(client, ok, customer, product, 10 if i < 3 else 100 * i, days_ago=0 if i < 3 else 30 * i)
+
+    rows = rfm(client, ok)
+    tied = [rows[c['id']] for c in customers[:3]]
+    assert len({(r['r'], r['f'], r['m']) for r in tied}) == 1
+    assert tied[0]['r'] == 5
+    assert rows[customers[-1]['id']]['r'] == 1 and rows[customers[-1]['id']]['m'] == 5
+
+
+def test_cash_book_pages_match_full_book(client, ok):
+    product = ok(client.post('/api/products', json={'name': 'A', 'stock': 100, 'sale_price': 10}))
+    for i in range(3):
+        ok(client.post('/api/orders', json={'type': 'Sale', 'payment_method': 'Cash', 'amount_paid': 10 * (i + 1),
+                                            'details': [{'product_id': product['id'], 'quantity': 1, 'price': 10 * (i + 1)}]}))
+        ok(client.post('/api/vouchers', json={'amount': 5, 'type': 'Payment', 'note': f'Chi {i}'}))
+
+    full = ok(client.get('/api/cash-book'))
+    pages, cursor = [], None
+    while True:
+        page = ok(client.get('/api/cash-book', query_string={'limit': 4, **({'cursor': cursor} if cursor else {})}))
+        pages.extend(page['items'])
+        assert (page['inflow'], page['outflow'], page['closing_balance']) == (full['inflow'], full['outflow'], full['closing_balance'])
+        cursor = page['next_cursor']
+        if not cursor:
+            break
+    assert pages == full['items']
+    assert full['closing_balance'] == 60 - 15
+
+
+def test_rfm_follows_partner_changes(client, ok):
+    product = ok(client.post('/api/products', json={'name': 'A', 'stock': 100, 'sale_price': 10}))
+    a, b, c = (ok(client.post('/api/partners', json={'name': name})) for name in ('A', 'B', 'C'))
+    sale(client, ok, a, product, 10)
+    moved = sale(client, ok, b, product, 10)
+    assert set(rfm(client, ok)) == {a['id'], b['id']}
+
+    ok(client.put(f"/api/orders/{moved['id']}", json={'type': 'Sale', 'payment_method': 'Cash', 'partner_id': c['id'], 'amount_paid': 10,
+                                                      'details': [{'product_id': product['id'], 'quantity': 1, 'price': 10}]}))
+    assert set(rfm(client, ok)) == {a['id'], c['id']}
+
+    ok(client.post('/api/partners/merge', json={'target_id': a['id'], 'source_ids': [c['id']]}))
+    rows = rfm(client, ok)
+    assert set(rows) == {a['id']} and rows[a['id']]['frequency'] == 2
+
+
+def test_sale_lines_keep_their_cost_name_and_unit(client, ok):
+    part = ok(client.post('/api/products', json={'name': 'Part', 'unit': 'Chai', 'stock': 10, 'cost_price': 4, 'sale_price': 6}))
+    combo = ok(client.post('/api/products', json={'name': 'Kit', 'unit': 'Bộ', 'is_combo': True, 'sale_price': 20,
+                                                  'combo_items': [{'product_id': part['id'], 'quantity': 3}]}))
+    order = ok(client.post('/api/orders', json={'type': 'Sale', 'payment_method': 'Cash', 'details': [
+        {'product_id': part['id'], 'quantity': 1, 'price': 6}, {'product_id': combo['id'], 'quantity': 1, 'price': 20}]}))
+
+    # Renaming the product and a dearer purchase must not rewrite the past sale
+    ok(client.put(f"/api/products/{part['id']}", json={'name': 'Part v2', 'unit': 'Thùng'}))
+    ok(client.post('/api/orders', json={'type': 'Purchase', 'payment_method': 'Cash', 'details': [
+        {'product_id': part['id'], 'quantity': 6, 'price': 12}]}))
+
+    lines = {d['product_id']: d for d in ok(client.get(f"/api/orders/{order['id']}"))['details']}
+    assert (lines[part['id']]['product_name'], lines[part['id']]['product_unit'], lines[part['id']]['cost_price']) == ('Part', 'Chai', 4)
+    assert lines[combo['id']]['cost_price'] == 12 # combo cost exploded over its parts at sale time
+    report = {r['id']: r for r in ok(client.get('/api/reports/products'))}
+    assert (report[part['id']]['name'], report[part['id']]['cost'], report[part['id']]['profit']) == ('Part', 4, 2)
+    assert (report[combo['id']]['cost'], report[combo['id']]['profit']) == (12, 8)
+
+
+def test_reorder_suggestions_follow_velocity_and_last_supplier(client, ok):
+    first, second = (ok(client.post('/api/partners', json={'name': name, 'is_supplier': True, 'is_customer': False})) for name in ('S1', 'S2'))
+    a = ok(client.post('/api/products', json={'name': 'A', 'stock': 0, 'cost_price': 8, 'sale_price': 10}))
+    b = ok(client.post('/api/products', json={'name': 'B', 'stock': 0, 'cost_price': 5, 'sale_price': 7, 'multiplier': 6}))
+    ok(client.post('/api/products', json={'name': 'C', 'stock': 0, 'cost_price': 1, 'sale_price': 2})) # never sold
+    buy = lambda supplier, product, quantity, price: ok(client.post('/api/orders', json={
+        'type': 'Purchase', 'payment_method': 'Cash', 'partner_id': supplier['id'],
+        'details': [{'product_id': product['id'], 'quantity': quantity, 'price': price}]}))
+    sell = lambda product, quantity: ok(client.post('/api/orders', json={'type': 'Sale', 'payment_method': 'Cash', 'details': [
+        {'product_id': product['id'], 'quantity': quantity, 'price': 10}]}))
+    buy(first, a, 20, 8)
+    buy(second, a, 20, 9)
+    buy(first, b, 17, 5)
+    sell(a, 30)
+    sell(b, 10)
+    old = sell(b, 5)
+    with lyang.app.app_context():
+        # Outside the 30-day window, inside the 90-day one
+        lyang.StockMovement.query.filter_by(order_id=old['id']).update({'date': lyang.get_vn_time() - timedelta(days=60)})
+        lyang.db.session.commit()
+
+    result = ok(client.get('/api/inventory/reorder', query_string={'window': 30, 'windows': '90', 'cover_days': 30, 'lead_days': 0}))
+    carts = {g['supplier_name']: [(i['product_name'], i['quantity'], i['price'], i['sold']) for i in g['cart']] for g in result['groups']}
+    assert carts == {
+        'S2': [('A', 20, 9, {'30': 30, '90': 30})], # 10 on hand for 30 sold a month
+        'S1': [('B', 12, 5, {'30': 10, '90': 15})], # 8 short of cover, rounded up to whole packs of 6
+    }
+
+
+def test_turnover_and_dead_stock(client, ok):
+    products = {name: ok(client.post('/api/products', json={'name': name, 'stock': stock, 'cost_price': 1, 'sale_price': 2, 'brand': brand}))
+                for name, stock, brand in (('A', 20, 'X'), ('B', 8, 'X'), ('C', 6, 'Y'))}
+    sell = lambda name, quantity: ok(client.post('/api/orders', json={'type': 'Sale', 'payment_method': 'Cash', 'details': [
+        {'product_id': products[name]['id'], 'quantity': quantity, 'price': 2}]}))
+    sell('A', 10)
+    old = sell('C', 2)
+    with lyang.app.app_context():
+        lyang.StockMovement.query.filter_by(order_id=old['id']).update({'date': lyang.get_vn_time() - timedelta(days=200)})
+        lyang.db.session.commit()
+
+    report = ok(client.get('/api/reports/inventory-turnover', query_string={'sort_by': 'turnover', 'sort_order': 'desc'}))
+    rows = [(r['name'], r['sold_90'], r['sold_365'], r['stock'], r['avg_stock'], r['turnover']) for r in report['items']]
+    # Average stock is (opening + closing) / 2 over the year; every product opened at 0 inside it
+    assert rows == [('A', 10, 10, 10, 5, 2), ('C', 0, 2, 4, 2, 1), ('B', 0, 0, 8, 4, 0)]
+    assert {r['name']: r['brand_rank'] for r in report['items']} == {'A': 1, 'B': 2, 'C': 1}
+
+    dead = ok(client.get('/api/reports/inventory-turnover', query_string={'dead_days': 90, 'sort_by': 'name'}))
+    assert [(r['name'], r['days_since_sale']) for r in dead['items']] == [('B', None), ('C', 200)]
+    page = ok(client.get('/api/reports/inventory-turnover', query_string={'sort_by': 'name', 'page': 2, 'limit': 2}))
+    assert (page['total'], page['pages'], [r['name'] for r in page['items']]) == (3, 2, ['C'])
+
+
+def test_financial_statement_totals(client, ok):
+    product = ok(client.post('/api/products', json={'name': 'A', 'stock': 100, 'cost_price': 4, 'sale_price': 10}))
+    customer = ok(client.post('/api/partners', json={'name': 'KH'}))
+    bank = ok(client.post('/api/bank-accounts', json={'bank_name': 'VCB', 'account_number': '1', 'balance': 0}))
+    order = lambda order_type, method, quantity, **extra: ok(client.post('/api/orders', json={
+        'type': order_type, 'payment_method': method, **extra, 'details': [{'product_id': product['id'], 'quantity': quantity, 'price': 10}]}))
+    order('Sale', 'Cash', 10)
+    order('Sale', 'Debt', 5, partner_id=customer['id'])
+    order('Purchase', 'Cash', 3)
+    ok(client.post('/api/vouchers', json={'amount': 15, 'type': 'Payment', 'note': 'Tiền điện'}))
+    ok(client.post('/api/vouchers', json={'amount': 5, 'type': 'Receipt', 'note': 'Thu khác'}))
+    ok(client.post('/api/vouchers', json={'partner_id': customer['id'], 'amount': 20, 'type': 'Receipt'})) # debt, not income
+    ok(client.post('/api/bank-transactions', json={'account_id': bank['id'], 'amount': 70, 'type': 'Deposit'}))
+    ok(client.post('/api/bank-transactions', json={'account_id': bank['id'], 'amount': 20, 'type': 'Withdrawal'}))
+
+    now = lyang.get_vn_time()
+    month = ok(client.get('/api/reports/financial-statement'))
+    assert [i['period'] for i in month['items']] == [now.strftime('%Y-%m')]
+    total = month['total']
+    assert (total['revenue'], total['cogs'], total['gross_margin'], total['gross_margin_pct']) == (150, 60, 90, 60.0)
+    assert (total['expenses'], total['other_income'], total['net_profit'], total['purchases']) == ({'Payment': 15}, 5, 80, 30)
+    assert total['cash_flow'] == {'cash_in': 125, 'cash_out': 45, 'cash_net': 80, 'bank_in': 70, 'bank_out': 20, 'bank_net': 50, 'net': 130}
+
+    quarter = ok(client.get('/api/reports/financial-statement', query_string={'granularity': 'quarter'}))
+    assert [(i['period'], i['net_profit']) for i in quarter['items']] == [(f"{now.year}-Q{(now.month - 1) // 3 + 1}", 80)]
+    empty = ok(client.get('/api/reports/financial-statement', query_string={'start': f'{now.year - 1}-01', 'end': f'{now.year - 1}-12'}))
+    assert empty['items'] == [] and empty['total']['revenue'] == 0
@@ -0,0 +1,19 @@
+from conftest import lyang
+
+
+def test_checkout_upserts_each_rollup_once(client, ok, sql):
+    a = ok(client.post('/api/products', json={'name': 'A', 'stock': 100, 'cost_price': 10, 'sale_price': 15}))
+    b = ok(client.post('/api/products', json={'name': 'B', 'stock': 100, 'cost_price': 20, 'sale_price': 25}))
+    line = lambda product, quantity, price: {'product_id': product['id'], 'quantity': quantity, 'price': price}
+    ok(client.post('/api/orders', json={'type': 'Sale', 'payment_method': 'Cash', 'details': [line(a, 1, 15)]}))
+
+    sql.clear()
+    ok(client.post('/api/orders', json={'type': 'Sale', 'payment_method': 'Cash', 'details': [line(a, 2, 15), line(b, 1, 25)]}))
+    for table in ('sales_hourly', 'product_sales_daily'):
+        assert len([s for s in sql if table in s]) == 1, table
+
+    series = ok(client.get('/api/reports/sales-series', query_string={'granularity': 'day'}))
+    assert (series['total']['revenue'], series['total']['quantity'], series['total']['order_count']) == (70, 4, 2)
+    with lyang.app.app_context():
+        per_product = {r.product_id: (r.quantity, r.order_count) for r in lyang.ProductSalesDaily.query}
+    assert per_product == {a['id']: (3, 2), b['id']: (1, 1)}
@@ -0,0 +1,52 @@
+def _sale(client, ok, product, quantity):
+    return ok(client.post('/api/orders', json={'type': 'Sale', 'payment_method': 'Cash', 'details': [
+        {'product_id': product['id'], 'quantity': quantity, 'price': 10}]}))
+
+
+def test_closed_shift_report_is_final(client, ok):
+    a = ok(client.post('/api/products', json={'name': 'A', 'stock': 100, 'cost_price': 5, 'sale_price': 10}))
+    first = ok(client.post('/api/shifts/open', json={'cashier': 'An', 'opening_float': 0}))
+    sale = _sale(client, ok, a, 2)
+    z = ok(client.post(f"/api/shifts/{first['id']}/close", json={'counted_cash': 20}))
+    assert (z['expected_cash'], z['difference'], z['sales_count']) == (20, 0, 1)
+
+    ok(client.delete(f"/api/orders/{sale['id']}")) # no shift open: the refund belongs to none
+    report = ok(client.get(f"/api/shifts/{first['id']}/report"))
+    assert (report['expected_cash'], report['sales']['Cash'], report['sales_count']) == (20, 20, 1)
+
+    second = ok(client.post('/api/shifts/open', json={'cashier': 'Bình', 'opening_float': 50}))
+    late = _sale(client, ok, a, 3)
+    ok(client.post(f"/api/shifts/{second['id']}/close", json={'counted_cash': 80}))
+    third = ok(client.post('/api/shifts/open', json={'cashier': 'An'}))
+    ok(client.put(f"/api/orders/{late['id']}", json={'type': 'Sale', 'payment_method': 'Cash', 'details': [
+        {'product_id': a['id'], 'quantity': 1, 'price': 10}]}))
+
+    assert ok(client.get(f"/api/shifts/{first['id']}/report"))['expected_cash'] == 20
+    closed = ok(client.get(f"/api/shifts/{second['id']}/report"))
+    assert (closed['expected_cash'], closed['sales']['Cash'], closed['difference']) == (80, 30, 0)
+    current = ok(client.get(f"/api/shifts/{third['id']}/report"))
+    assert (current['expected_cash'], current['sales']['Cash'], current['sales_count']) == (-20, -20, 0)
+
+
+def test_shift_report_splits_sales_and_money(client, ok):
+    a = ok(client.post('/api/products', json={'name': 'A', 'stock': 100, 'cost_price': 5, 'sale_price': 10}))
+    customer = ok(client.post('/api/partners', json={'name': 'KH'}))
+    bank = ok(client.post('/api/bank-accounts', json={'bank_name': 'VCB', 'account_number': '1', 'balance': 0}))
+    shift = ok(client.post('/api/shifts/open', json={'cashier': 'An', 'terminal': 'Q1', 'opening_float': 100}))
+    ok(client.post('/api/shifts/open', json={'terminal': 'Q1'}), (400,)) # one open shift per terminal
+    assert ok(client.get('/api/shifts/current', query_string={'terminal': 'Q1'}))['id'] == shift['id']
+
+    line = [{'product_id': a['id'], 'quantity': 3, 'price': 10}]
+    ok(client.post('/api/orders', json={'type': 'Sale', 'payment_method': 'Cash', 'terminal': 'Q1', 'details': line}))
+    ok(client.post('/api/orders', json={'type': 'Sale', 'payment_method': 'Transfer', 'bank_account_id': bank['id'], 'terminal': 'Q1', 'details': line}))
+    ok(client.post('/api/orders', json={'type': 'Sale', 'payment_method': 'Debt', 'partner_id': customer['id'], 'terminal': 'Q1', 'details': line}))
+    ok(client.post('/api/vouchers', json={'amount': 12, 'type': 'Payment', 'note': 'Chi vặt', 'terminal': 'Q1'}))
+
+    x = ok(client.get(f"/api/shifts/{shift['id']}/report"))
+    assert (x['status'], x['sales_count'], x['sales']) == ('Đang mở', 3, {'Cash': 30, 'Transfer': 30, 'Debt': 30, 'Other': 0, 'total': 90})
+    assert (x['cash_in'], x['cash_out'], x['bank_in'], x['expected_cash']) == (30, 12, 30, 118)
+
+    z = ok(client.post(f"/api/shifts/{shift['id']}/close", json={'counted_cash': 110}))
+    assert (z['status'], z['counted_cash'], z['difference']) == ('Đã đóng', 110, -8)
+    ok(client.post(f"/api/shifts/{shift['id']}/close", json={'counted_cash': 110}), (400,))
+    assert ok(client.get('/api/shifts/current', query_string={'terminal': 'Q1'})) is None
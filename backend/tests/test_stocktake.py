@@ -0,0 +1,56 @@
+from conftest import lyang
+
+
+def _stocktake(client, ok, products, counted):
+    st = ok(client.post('/api/stocktakes', json={}))
+    ok(client.post(f"/api/stocktakes/{st['id']}/counts", json={'items': [
+        {'product_id': p['id'], 'quantity': counted} for p in products]}))
+    return st
+
+
+def test_finalize_moves_stock_and_lots(client, ok):
+    a = ok(client.post('/api/products', json={'name': 'A', 'stock': 10, 'cost_price': 10, 'sale_price': 15}))
+    b = ok(client.post('/api/products', json={'name': 'B', 'stock': 10, 'cost_price': 20, 'sale_price': 25}))
+    st = ok(client.post('/api/stocktakes', json={}))
+    ok(client.post(f"/api/stocktakes/{st['id']}/counts", json={'items': [
+        {'product_id': a['id'], 'quantity': 4}, {'product_id': b['id'], 'quantity': 13}]}))
+    done = ok(client.post(f"/api/stocktakes/{st['id']}/finalize", json={}))
+    assert (done['status'], done['adjusted']) == ('Completed', 2)
+
+    with lyang.app.app_context():
+        stock = {p.id: p.stock for p in lyang.Product.query}
+        lots = dict(lyang.db.session.query(lyang.ProductLot.product_id, lyang.db.func.sum(lyang.ProductLot.quantity))
+                    .group_by(lyang.ProductLot.product_id))
+        moved = {m.product_id: m.quantity for m in lyang.StockMovement.query.filter_by(kind='Stocktake')}
+    assert stock == {a['id']: 4, b['id']: 13}
+    assert lots == {a['id']: 4, b['id']: 13}
+    assert moved == {a['id']: -6, b['id']: 3}
+
+
+def test_finalize_statements_do_not_grow_with_lines(client, ok, sql):
+    def statements(n):
+        products = [ok(client.post('/api/products', json={'name': f'P{n}-{i}', 'stock': 10, 'cost_price': 1, 'sale_price': 2}))
+                    for i in range(n)]
+        st = _stocktake(client, ok, products[::2], 12) # half gain, half lose
+        ok(client.post(f"/api/stocktakes/{st['id']}/counts", json={'items': [
+            {'product_id': p['id'], 'quantity': 7} for p in products[1::2]]}))
+        sql.clear()
+        ok(client.post(f"/api/stocktakes/{st['id']}/finalize", json={}))
+        return len(sql)
+
+    assert statements(30) == statements(4)
+
+
+def test_finalize_can_zero_what_was_not_counted(client, ok):
+    counted = ok(client.post('/api/products', json={'name': 'A', 'stock': 5, 'cost_price': 1, 'sale_price': 2}))
+    missing = ok(client.post('/api/products', json={'name': 'B', 'stock': 3, 'cost_price': 1, 'sale_price': 2}))
+    st = _stocktake(client, ok, [counted], 5)
+    done = ok(client.post(f"/api/stocktakes/{st['id']}/finalize", json={'zero_uncounted': True}))
+    assert done['adjusted'] == 1
+
+    with lyang.app.app_context():
+        assert lyang.db.session.get(lyang.Product, missing['id']).stock == 0
+        assert lyang.db.session.get(lyang.Product, counted['id']).stock == 5
+    lines = {i['product_id']: (i['system_qty'], i['variance']) for i in ok(client.get(f"/api/stocktakes/{st['id']}"))['items']}
+    assert lines == {counted['id']: (5, 0), missing['id']: (3, -3)} # frozen at finalize
+    ok(client.post(f"/api/stocktakes/{st['id']}/finalize", json={}), (400,))
@@ -17,6 +17,7 @@ import Portal from '../components/Portal';
 export default function BankManager() {
     const [accounts, setAccounts] = useState([]);
     const [transactions, setTransactions] = useState([]);
+    const [nextCursor, setNextCursor] = useState(null);
     const [selectedAccount, setSelectedAccount] = useState(null);
     const [loading, setLoading] = useState(false);
     const [toast, setToast] = useState(null);
@@ -72,8 +73,9 @@ export default function BankManager() {
     const fetchTransactions = async (accountId) => {
         setLoading(true);
         try {
-            const res = await axios.get('/api/bank-transactions', { params: { account_id: accountId } });
-            setTransactions(res.data);
+            const res = await axios.get(`/api/bank-accounts/${accountId}/statement`);
+            setTransactions(res.data.items || []);
+            setNextCursor(res.data.next_cursor);
         } catch (err) {
             console.error(err);
         } finally {
@@ -81,6 +83,17 @@ export default function BankManager() {
         }
     };
 
+    const loadMoreTransactions = async () => {
+        if (!selectedAccount || !nextCursor) return;
+        try {
+            const res = await axios.get(`/api/bank-accounts/${selectedAccount.id}/statement`, { params: { cursor: nextCursor } });
+            setTransactions(prev => [...prev, ...(res.data.items || [])]);
+            setNextCursor(res.data.next_cursor);
+        } catch (err) {
+            console.error(err);
+        }
+    };
+
     const filteredTransactions = React.useMemo(() => {
         return transactions.filter(t => {
             const matchesSearch = (t.note || '').toLowerCase().includes(searchTerm.toLowerCase()) ||
@@ -392,12 +405,20 @@ export default function BankManager() {
                                                 )}>
                                                     {t.type === 'Deposit' ? '+' : '-'}{formatNumber(t.amount)}
                                                 </div>
+                                                {t.balance_after != null && (
+                                                    <div className="text-[10px] font-bold text-slate-400">Số dư: {formatNumber(t.balance_after)}</div>
+                                                )}
                                             </td>
                                         </m.tr>
                                     ))
                                 )}
                             </tbody>
                         </table>
+                        {!loading && nextCursor && (
+                            <button onClick={loadMoreTransactions} className="w-full py-4 text-[10px] font-black uppercase tracking-widest text-blue-500 hover:bg-blue-50 dark:hover:bg-slate-800/40 transition-colors">
+                                Tải thêm
+                            </button>
+                        )}
                     </div>
                 </m.div>
             )}
@@ -533,6 +533,32 @@ export default function Purchase() {
 
     const handleRemoveHeld = (id) => setHeldPurchases(heldPurchases.filter(h => h.id !== id));
 
+    // Reorder suggestions arrive grouped by last supplier, one held cart per supplier
+    const handleLoadReorder = async () => {
+        try {
+            const res = await axios.get('/api/inventory/reorder');
+            const time = new Date().toLocaleTimeString('vi-VN', { hour: '2-digit', minute: '2-digit' });
+            const carts = res.data.groups.map((g, idx) => ({
+                id: Date.now() + idx,
+                cart: g.cart,
+                partner: g.partner,
+                total: g.total,
+                time,
+                note: `Gợi ý nhập hàng - ${g.supplier_name}`,
+                paymentMethod: posMode === 'Wholesale' ? 'Pending' : 'Cash',
+                editOrderId: null
+            }));
+            if (carts.length === 0) {
+                setToast({ message: "Chưa có sản phẩm cần nhập thêm.", type: "success" });
+                return;
+            }
+            setHeldPurchases([...carts, ...heldPurchases]);
+            setIsHeldSidebarOpen(true);
+        } catch (err) {
+            setToast({ message: err.response?.data?.error || "Lỗi khi tính gợi ý nhập hàng", type: "error" });
+        }
+    };
+
     const filteredProducts = useMemo(() => {
         const s = searchTerm.toLowerCase();
         if (!s) return products.slice(0, 10);
@@ -793,6 +819,17 @@ export default function Purchase() {
                                 <span className="hidden lg:inline text-xs uppercase">Đơn Tạm</span>
                             </m.button>
 
+                            <m.button
+                                whileTap={{ scale: 0.95 }}
+                                transition={{ type: "spring", stiffness: 400, damping: 17 }}
+                                onClick={handleLoadReorder}
+                                className="relative p-2.5 bg-white/80 dark:bg-slate-800/80 backdrop-blur-sm text-muted dark:text-gray-400 rounded-xl hover:bg-[#d4a574]/20 dark:hover:bg-slate-700 transition-all font-bold flex items-center gap-2 border-2 border-[#d4a574]/20 shadow-sm hover:shadow-md"
+                                title="Gợi ý nhập hàng theo tốc độ bán"
+                            >
+                                <TrendingUp size={20} />
+                                <span className="hidden lg:inline text-xs uppercase">Gợi ý nhập</span>
+                            </m.button>
+
                             <div className="flex bg-white/80 dark:bg-slate-800/80 backdrop-blur-sm rounded-xl overflow-hidden shadow-sm border-2 border-[#d4a574]/20">
                                 <m.button
                                     whileTap={{ scale: 0.9 }}
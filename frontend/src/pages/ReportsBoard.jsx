@@ -126,7 +126,7 @@ export default function ReportsBoard() {
 
         orders.forEach(order => {
             if (order.type !== 'Sale') return;
-            if (order.display_id === 'NODAU' || order.display_id === '#NODAU') return;
+            if (order.is_opening_balance) return;
 
             order.details.forEach(detail => {
                 const prod = products.find(p => p.id === detail.product_id);
@@ -167,7 +167,7 @@ export default function ReportsBoard() {
         const dailyData = {};
         orders.forEach(order => {
             if (order.type !== 'Sale') return;
-            if (order.display_id === 'NODAU' || order.display_id === '#NODAU') return;
+            if (order.is_opening_balance) return;
             // Date format YYYY-MM-DD
             const date = order.date.split('T')[0];
             if (!dailyData[date]) dailyData[date] = { revenue: 0, profit: 0 };
@@ -229,7 +229,7 @@ export default function ReportsBoard() {
 
         orders.forEach(order => {
             if (order.type !== 'Sale') return;
-            if (order.display_id === 'NODAU' || order.display_id === '#NODAU') return;
+            if (order.is_opening_balance) return;
             if (!order.partner_id) return; // Skip walk-in
 
             const partner = partners.find(p => p.id === order.partner_id);
@@ -263,7 +263,7 @@ export default function ReportsBoard() {
 
         orders.forEach(order => {
             if (order.type !== 'Purchase') return;
-            if (order.display_id === 'NODAU' || order.display_id === '#NODAU') return;
+            if (order.is_opening_balance) return;
 
             const partner = partners.find(p => p.id === order.partner_id);
             if (searchTerm && !partner?.name.toLowerCase().includes(searchTerm.toLowerCase())) return;
@@ -309,7 +309,7 @@ export default function ReportsBoard() {
         const reportMap = new Map(report.map(i => [i.id, i]));
 
         orders.forEach(order => {
-            if (order.display_id === 'NODAU' || order.display_id === '#NODAU') return;
+            if (order.is_opening_balance) return;
             order.details.forEach(d => {
                 const item = reportMap.get(d.product_id);
                 if (!item) return;
@@ -338,7 +338,7 @@ export default function ReportsBoard() {
         const soldProductIds = new Set();
         orders.forEach(order => {
             if (order.type === 'Sale') {
-                if (order.display_id === 'NODAU' || order.display_id === '#NODAU') return;
+                if (order.is_opening_balance) return;
                 order.details.forEach(d => soldProductIds.add(d.product_id));
             }
         });
@@ -364,7 +364,7 @@ export default function ReportsBoard() {
 
         orders.forEach(order => {
             if (order.type !== 'Sale') return;
-            if (order.display_id === 'NODAU' || order.display_id === '#NODAU') return;
+            if (order.is_opening_balance) return;
             order.details.forEach(detail => {
                 const prod = products.find(p => p.id === detail.product_id);
                 const brand = prod?.brand || 'Khác';
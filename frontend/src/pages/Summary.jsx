@@ -394,6 +394,7 @@ const PartnerLedger = ({ onEditOrder }) => {
     const [partners, setPartners] = useState([]);
     const [selectedPartner, setSelectedPartner] = useState(null);
     const [ledger, setLedger] = useState([]);
+    const [nextCursor, setNextCursor] = useState(null);
     const [loading, setLoading] = useState(false);
     const [search, setSearch] = useState('');
     const [stats, setStats] = useState({ customerDebt: 0, supplierDebt: 0 });
@@ -419,10 +420,29 @@ const PartnerLedger = ({ onEditOrder }) => {
         try {
             const res = await axios.get(`/api/partners/${p.id}/ledger`);
             setLedger(res.data.ledger || []);
+            setNextCursor(res.data.next_cursor);
         } catch (err) { console.error(err); }
         setLoading(false);
     };
 
+    const loadMore = async () => {
+        if (!selectedPartner || !nextCursor) return;
+        try {
+            const res = await axios.get(`/api/partners/${selectedPartner.id}/ledger`, { params: { cursor: nextCursor } });
+            setLedger(prev => [...prev, ...(res.data.ledger || [])]);
+            setNextCursor(res.data.next_cursor);
+        } catch (err) { console.error(err); }
+    };
+
+    // Ledger rows only carry the reference; the order itself is loaded when opened
+    const openEntry = async (row) => {
+        if (!row.order_id) return;
+        try {
+            const res = await axios.get(`/api/orders/${row.order_id}`);
+            onEditOrder(res.data);
+        } catch (err) { console.error(err); }
+    };
+
     return (
         <div className="h-full flex flex-col gap-4">
             <div className="grid grid-cols-1 md:grid-cols-2 gap-4 mb-2">
@@ -462,18 +482,23 @@ const PartnerLedger = ({ onEditOrder }) => {
                                     </thead>
                                     <tbody>
                                         {loading ? <tr><td colSpan="5" className="text-center p-10">Đang tải...</td></tr> : ledger.map((row, i) => (
-                                            <tr key={i} className="border-b border-gray-50 hover:bg-gray-50 transition-colors">
+                                            <tr key={row.id} className="border-b border-gray-50 hover:bg-gray-50 transition-colors">
                                                 <td className="p-3 text-xs">{new Date(row.date).toLocaleDateString('vi-VN')}</td>
-                                                <td className="p-3 font-bold text-[#2d5016] cursor-pointer" onClick={() => onEditOrder(row.obj)}>{row.ref_id}</td>
+                                                <td className="p-3 font-bold text-[#2d5016] cursor-pointer" onClick={() => openEntry(row)}>{row.ref_id}</td>
                                                 <td className="p-3 text-xs">{row.desc}</td>
                                                 <td className={`p-3 text-right font-bold ${row.type === 'Order' ? 'text-rose-600' : 'text-emerald-600'}`}>
-                                                    {row.type === 'Order' ? `+${row.obj.total_amount.toLocaleString()}` : `-${row.obj.amount.toLocaleString()}`}
+                                                    {row.increase ? `+${row.increase.toLocaleString()}` : `-${row.decrease.toLocaleString()}`}
                                                 </td>
                                                 <td className="p-3 text-right font-black">{row.running_balance.toLocaleString()}</td>
                                             </tr>
                                         ))}
                                     </tbody>
                                 </table>
+                                {!loading && nextCursor && (
+                                    <button onClick={loadMore} className="w-full mt-3 py-2 text-xs font-bold uppercase text-[#2d5016] rounded-xl border-2 border-[#d4a574]/30 hover:bg-[#d4a574]/10">
+                                        Tải thêm
+                                    </button>
+                                )}
                             </div>
                         </div>
                     ) : (
@@ -493,6 +518,7 @@ const InventoryJournal = ({ onEditOrder }) => {
     const [search, setSearch] = useState('');
     const [selectedProduct, setSelectedProduct] = useState(null);
     const [history, setHistory] = useState([]);
+    const [nextCursor, setNextCursor] = useState(null);
     const [loading, setLoading] = useState(false);
 
     useEffect(() => {
@@ -509,11 +535,21 @@ const InventoryJournal = ({ onEditOrder }) => {
         setLoading(true);
         try {
             const res = await axios.get(`/api/products/${p.id}/history`);
-            setHistory(res.data);
+            setHistory(res.data.items || []);
+            setNextCursor(res.data.next_cursor);
         } catch (err) { console.error(err); }
         setLoading(false);
     };
 
+    const loadMore = async () => {
+        if (!selectedProduct || !nextCursor) return;
+        try {
+            const res = await axios.get(`/api/products/${selectedProduct.id}/history`, { params: { cursor: nextCursor } });
+            setHistory(prev => [...prev, ...(res.data.items || [])]);
+            setNextCursor(res.data.next_cursor);
+        } catch (err) { console.error(err); }
+    };
+
     return (
         <div className="h-full flex gap-4 overflow-hidden">
             <div className="w-80 bg-white/60 dark:bg-slate-800/60 rounded-2xl border-2 border-[#d4a574]/30 flex flex-col overflow-hidden">
@@ -557,6 +593,11 @@ const InventoryJournal = ({ onEditOrder }) => {
                                     ))}
                                 </tbody>
                             </table>
+                            {!loading && nextCursor && (
+                                <button onClick={loadMore} className="w-full mt-3 py-2 text-xs font-bold uppercase text-[#2d5016] rounded-xl border-2 border-[#d4a574]/30 hover:bg-[#d4a574]/10">
+                                    Tải thêm
+                                </button>
+                            )}
                         </div>
                     </div>
                 ) : (